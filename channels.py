@@ -0,0 +1,113 @@
+from typing import Dict, Optional, Set
+
+import discord
+from discord.ext import commands
+
+from warmup import Warmup
+
+
+class _GuildChannels:
+    def __init__(self):
+        self.admin_channel_ids: Set[int] = set()
+        # Normally there's only one, but nothing stops a guild having two
+        # channels with the same name. The first one found is used.
+        self.log_channels: Dict[int, discord.abc.GuildChannel] = {}
+
+
+class ChannelIndex(commands.Cog):
+    """
+    Knows which channels are each guild's admin and log channels, by id, so
+    nothing has to compare channel names or search a guild's channels.
+
+    Guilds are indexed all at once by index_guilds (a warm-up phase, if
+    there's a Warmup), and by on_guild_join for guilds joined later. The
+    channel events keep the index up to date as channels are created,
+    renamed and deleted.
+    """
+
+    def __init__(self, admin_channel, log_channel=None, warmup: Optional[Warmup] = None):
+        self._admin_channel_name = admin_channel
+        self._log_channel_name = log_channel
+        # Every guild's admin channels, together, since every admin command
+        # checks its channel. Channel ids are unique across guilds.
+        self._admin_channel_ids: Set[int] = set()
+        self._guilds: Dict[int, _GuildChannels] = {}
+        if warmup is not None:
+            warmup.add_phase('channels', self.index_guilds)
+
+    async def index_guilds(self, guilds):
+        for g in guilds:
+            self._index_guild(g)
+            if self._log_channel_name is not None and self.log_channel(g.id) is None:
+                print(
+                    f"No channel with name {self._log_channel_name} in guild {g.name}. "
+                    "Flairs added or removed there will only be logged to stdout.")
+
+    def _index_guild(self, guild):
+        self._forget_guild(guild.id)
+        self._guilds[guild.id] = _GuildChannels()
+        for c in guild.channels:
+            self._add(c)
+
+    def _forget_guild(self, guild_id):
+        g = self._guilds.pop(guild_id, None)
+        if g is not None:
+            self._admin_channel_ids -= g.admin_channel_ids
+
+    def _add(self, channel):
+        g = self._guilds.get(channel.guild.id)
+        if g is None:
+            # It'll be indexed along with the rest of its guild.
+            return
+        if channel.name == self._admin_channel_name:
+            g.admin_channel_ids.add(channel.id)
+            self._admin_channel_ids.add(channel.id)
+        if channel.name == self._log_channel_name:
+            g.log_channels[channel.id] = channel
+
+    def _remove(self, channel):
+        g = self._guilds.get(channel.guild.id)
+        if g is None:
+            return
+        g.admin_channel_ids.discard(channel.id)
+        self._admin_channel_ids.discard(channel.id)
+        g.log_channels.pop(channel.id, None)
+
+    def is_admin_channel(self, channel) -> bool:
+        if channel.id in self._admin_channel_ids:
+            return True
+        guild = getattr(channel, 'guild', None)
+        if guild is not None and guild.id in self._guilds:
+            return False
+        # Messages can arrive before their guild is indexed, while the bot
+        # is starting up. (Direct messages have no name, and no guild.)
+        return getattr(channel, 'name', None) == self._admin_channel_name
+
+    def log_channel(self, guild_id) -> Optional[discord.abc.GuildChannel]:
+        g = self._guilds.get(guild_id)
+        if g is None:
+            return None
+        return next(iter(g.log_channels.values()), None)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        self._index_guild(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self._forget_guild(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel):
+        self._add(channel)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        # Renaming a channel can make it (or stop it being) the admin or log
+        # channel.
+        self._remove(before)
+        self._add(after)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        self._remove(channel)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from channels import ChannelIndex
+from flairs_test import ADMIN, LOG, FakeChannel, FakeGuild
+from warmup import Warmup
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def fake_guild(guild_id):
+    guild = FakeGuild(guild_id)
+    # Unlike FakeGuild's, real channel ids are unique across guilds.
+    for c in guild.channels:
+        c.id = hash((guild_id, c.name))
+    return guild
+
+
+def renamed(channel, name):
+    """Returns the channel as on_guild_channel_update's after would."""
+    after = FakeChannel(channel.guild, name)
+    after.id = channel.id
+    return after
+
+
+class TestChannelIndex(unittest.TestCase):
+    def setUp(self):
+        self.guild = fake_guild(1)
+        self.other = fake_guild(2)
+        self.index = ChannelIndex(ADMIN, LOG)
+        _run(self.index.index_guilds([self.guild, self.other]))
+
+    def test_finds_admin_and_log_channels(self):
+        self.assertTrue(self.index.is_admin_channel(self.guild.channel(ADMIN)))
+        self.assertFalse(self.index.is_admin_channel(self.guild.channel(LOG)))
+        self.assertIs(self.index.log_channel(1), self.guild.channel(LOG))
+        self.assertIs(self.index.log_channel(2), self.other.channel(LOG))
+        self.assertIsNone(self.index.log_channel(3))
+
+    def test_follows_channel_changes(self):
+        admin = self.guild.channel(ADMIN)
+        demoted = renamed(admin, 'general')
+        _run(self.index.on_guild_channel_update(admin, demoted))
+        self.assertFalse(self.index.is_admin_channel(demoted))
+
+        created = FakeChannel(self.guild, 'new-admin')
+        _run(self.index.on_guild_channel_create(created))
+        self.assertFalse(self.index.is_admin_channel(created))
+        promoted = renamed(created, ADMIN)
+        _run(self.index.on_guild_channel_update(created, promoted))
+        self.assertTrue(self.index.is_admin_channel(promoted))
+
+        _run(self.index.on_guild_channel_delete(promoted))
+        self.assertFalse(self.index.is_admin_channel(promoted))
+        _run(self.index.on_guild_channel_delete(self.guild.channel(LOG)))
+        self.assertIsNone(self.index.log_channel(1))
+        # The other guild's are untouched.
+        self.assertTrue(self.index.is_admin_channel(self.other.channel(ADMIN)))
+
+    def test_follows_guilds_joining_and_leaving(self):
+        _run(self.index.on_guild_remove(self.other))
+        self.assertIsNone(self.index.log_channel(2))
+        # Without its guild indexed, a channel can only be checked by name.
+        self.assertTrue(self.index.is_admin_channel(self.other.channel(ADMIN)))
+        self.other.channels[0].name = 'renamed'
+        self.assertFalse(self.index.is_admin_channel(self.other.channel('renamed')))
+
+        joined = fake_guild(3)
+        _run(self.index.on_guild_join(joined))
+        self.assertTrue(self.index.is_admin_channel(joined.channel(ADMIN)))
+        self.assertIs(self.index.log_channel(3), joined.channel(LOG))
+
+    def test_direct_messages_arent_admin_channels(self):
+        self.assertFalse(self.index.is_admin_channel(SimpleNamespace(id=99)))
+
+    def test_indexes_at_warm_up(self):
+        warmup = Warmup()
+        index = ChannelIndex(ADMIN, LOG, warmup)
+        _run(warmup.run([self.guild]))
+        self.assertEqual(list(warmup.timings), ['channels'])
+        self.assertIs(index.log_channel(1), self.guild.channel(LOG))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,22 @@
+import asyncio
 import io
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
+import aiohttp
 import discord
 from discord.ext import commands
 
+import metrics
+from channels import ChannelIndex
+from images import ImageNormalizer
+from messages import MESSAGE_SIZE_LIMIT, paginate
+from ratelimit import Limit, SummonLimiter
+from storage import Response
+from warmup import Warmup
+
 PREFIX = _p = '!'
 SUMMONING_KEY = '~'
 SAVE_COMMAND = f'{_p}save '
@@ -13,41 +25,190 @@ ADD_ALL_COMMAND = f'{_p}random-addall '
 LIST_COMMAND = f'{_p}list'
 DELETE_COMMAND = f'{_p}delete '
 HELP_COMMAND = f'{_p}help'
+STATS_COMMAND = f'{_p}stats'
+FIND_COMMAND = f'{_p}find '
+
+# Random responses can be made more or less likely than the others by adding a
+# weight to the keyword, like '!random-add keyword*3 response'.
+WEIGHT_SEPARATOR = '*'
+MAX_WEIGHT = 1000
+WEIGHT_ERROR = f"Sorry, weights have to be a number above 0 and no more than {MAX_WEIGHT}, like '{RANDOM_COMMAND} <keyword>{WEIGHT_SEPARATOR}3 <response content>'."
+
+# Room left at the top of every page of LIST_COMMAND's output, for the page
+# number.
+LIST_PAGE_HEADER_SIZE = 50
+# How many guilds' LIST_COMMAND pages are kept around.
+LIST_PAGES_CACHED_GUILDS = 64
+FIND_RESULTS_PER_PAGE = 10
+# How many did-you-mean suggestions a summon of a trigger that doesn't exist gets.
+SUMMON_SUGGESTIONS = 3
+
+# Attachments bigger than this aren't saved. Every summon uploads them again,
+# and they're held in memory while they're saved.
+MAX_ATTACHMENT_BYTES = 8 * 1024 * 1024
+ATTACHMENT_TIMEOUT_SECONDS = 30
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+ATTACHMENT_TOO_LARGE_ERROR = f"Sorry, that attachment is too big. I can only save ones up to {MAX_ATTACHMENT_BYTES // (1024 * 1024)}MB."
+DOWNLOAD_ERROR = "Sorry, I couldn't download that attachment. Try again in a bit?"
+
+# The admin commands, by the first word of the messages that run them. Admin
+# commands are only run from the admin channel.
+_ADMIN_COMMANDS = {
+    DELETE_COMMAND.strip(): 'delete',
+    SAVE_COMMAND.strip(): 'save',
+    ADD_ALL_COMMAND.strip(): 'random-addall',
+    RANDOM_COMMAND.strip(): 'random-add',
+    LIST_COMMAND.strip(): 'list',
+    STATS_COMMAND.strip(): 'stats',
+    FIND_COMMAND.strip(): 'find',
+    HELP_COMMAND.strip(): 'help',
+}
+# The first character of every message that isn't ignored.
+_FIRST_CHARS = {SUMMONING_KEY[0], PREFIX[0]}
+
+MESSAGE_SECONDS = metrics.histogram(
+    'newton_message_seconds', "Time taken to handle a message, by what it asked for.", ['branch'])
+_MESSAGE_SECONDS_BY_BRANCH = {
+    b: MESSAGE_SECONDS.labels(branch=b) for b in ['summon'] + list(_ADMIN_COMMANDS.values())}
+# Summons that went unanswered because of the limits, by which limit.
+SUMMONS_DROPPED = metrics.counter(
+    'newton_summons_dropped_total', "Summons that weren't answered because of rate limits, or because they were just answered.", ['reason'])
+# Summons of triggers that don't exist that got no did-you-mean reply because
+# of the limits, by which limit.
+SUGGESTIONS_DROPPED = metrics.counter(
+    'newton_suggestions_dropped_total', "Did-you-mean replies that weren't sent because of rate limits, or because they were just sent.", ['reason'])
+
+# The limits main.py runs with. A user can summon 5 times in a row, then once
+# every 5 seconds. A channel gets 10, then one a second, and a trigger gets 5,
+# then one every 2 seconds. A trigger summoned again in the same channel
+# within DEDUP_WINDOW_SECONDS of being answered is ignored.
+SUMMON_USER_LIMIT = Limit(per_second=0.2, burst=5)
+SUMMON_CHANNEL_LIMIT = Limit(per_second=1, burst=10)
+SUMMON_TRIGGER_LIMIT = Limit(per_second=0.5, burst=5)
+SUMMON_DEDUP_WINDOW_SECONDS = 3.0
+# Did-you-mean replies to summons of triggers that don't exist have limits of
+# their own, so typos don't use up anyone's summons. A user gets 3, then one
+# every 10 seconds, and a channel 5, then one every 5 seconds.
+SUGGESTION_USER_LIMIT = Limit(per_second=0.1, burst=3)
+SUGGESTION_CHANNEL_LIMIT = Limit(per_second=0.2, burst=5)
+
+# Messages that aren't for us are only counted. They are most messages, and
+# timing them would cost more than ignoring them does.
+_IGNORED_MESSAGES = metrics.counter(
+    'newton_messages_ignored_total', "Messages that weren't commands, or weren't allowed where they were sent.").labels()
+
+
+def _split_weight(command) -> Tuple[str, float, bool]:
+    """
+    Separates a keyword from its weight, if it has one. Returns the keyword,
+    the weight (1 by default) and true iff there's a keyword and the weight
+    is valid.
+    """
+    if WEIGHT_SEPARATOR not in command:
+        return command, 1.0, True
+    command, weight = command.rsplit(WEIGHT_SEPARATOR, 1)
+    if command == '':
+        return command, 1.0, False
+    try:
+        w = float(weight)
+    except ValueError:
+        return command, 1.0, False
+    # Written this way round so NaN isn't valid.
+    return command, w, 0 < w <= MAX_WEIGHT
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+async def _download(attachment: discord.Attachment, max_bytes: int, timeout: float) -> bytes:
+    """
+    Downloads the attachment a chunk at a time, giving up as soon as it turns
+    out to be bigger than max_bytes, or takes longer than timeout seconds.
+    """
+    chunks = []
+    size = 0
+    # Saves are rare enough that a session each is fine.
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        async with session.get(attachment.url) as resp:
+            resp.raise_for_status()
+            if resp.content_length is not None and resp.content_length > max_bytes:
+                raise AttachmentTooLarge()
+            async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise AttachmentTooLarge()
+                chunks.append(chunk)
+    # The only copy of the whole thing. The image is read from it, without
+    # copying, by images.py and by storage.
+    return b''.join(chunks)
 
-# The maximum number of characters that a message can be before discord rejects
-# the request.
-#
-# Most of the time we don't even check this, and just raise an exception (which
-# is then ignored) if discord rejects the message for being too long. This is
-# here for the special cases when we actually give a shit and want to make sure
-# the message is actually sent.
-MESSAGE_SIZE_LIMIT = 2000
+
+def _guild_id(message) -> Optional[int]:
+    return message.guild.id if message.guild is not None else None
+
+
+async def _send(channel, content, **kwargs):
+    return await metrics.discord_request('send', channel.send(content, **kwargs))
 
 
 class CommandSetter(commands.Cog):
-    def __init__(self, user, storage, admin_channel):
+    def __init__(self, user, storage, channels: ChannelIndex, summon_limiter: Optional[SummonLimiter] = None,
+                 image_normalizer: Optional[ImageNormalizer] = None, warmup: Optional[Warmup] = None,
+                 suggestion_limiter: Optional[SummonLimiter] = None):
         self._user = user
         self._db = storage
-        self._admin_channel = admin_channel
+        # Admin commands only work in the channels it says are admin channels.
+        self._channels = channels
+        # Summons, and did-you-mean replies to misses, are unlimited without
+        # these.
+        self._summon_limiter = summon_limiter
+        self._suggestion_limiter = suggestion_limiter
+        # Images are saved as uploaded without one.
+        self._image_normalizer = image_normalizer
+
+        # For each guild, the pages of LIST_COMMAND's output, and the (store
+        # version, hour) they were built for. Elapsed times are only shown to
+        # the hour, so the pages only need rebuilding when a command changes,
+        # or once an hour. Only the most recently listed guilds are kept.
+        self._list_pages_cache: 'OrderedDict[Optional[int], Tuple[object, List[str]]]' = OrderedDict()
+
+        self._handlers = {
+            'summon': self._summon,
+            'delete': self._delete,
+            'save': self._save,
+            'random-addall': self._add_all,
+            'random-add': self._random_add,
+            'list': self._list,
+            'stats': self._stats,
+            'find': self._find,
+            'help': self._help,
+        }
+
+        # Messages aren't held back without one.
+        self._warmup = warmup
+        if warmup is not None:
+            warmup.add_phase('commands', lambda guilds: self._db.warm_up([g.id for g in guilds]))
 
     @staticmethod
-    async def _extract_content(message: discord.Message) -> Tuple[str, str, Optional[discord.File], bool]:
+    def _extract_content(message: discord.Message) -> Tuple[str, str, Optional[discord.Attachment], bool]:
         """
         Attempts to extract trigger word, content and, image attachment from message
-        (in that order). Also returns true iff successful.
+        (in that order). Also returns true iff successful. The attachment
+        isn't downloaded, so malformed commands never cost a download.
         """
         # Only one attachment at a time is supported.
         if len(message.attachments) > 1:
             return "", "", None, False
 
         # Get attachment (we assume its an image), if applicable.
-        image = None
+        attachment = None
         if len(message.attachments) == 1:
-            image = await message.attachments[0].to_file()
+            attachment = message.attachments[0]
 
         # Must have content or image.
         strs = message.content.split(maxsplit=2)
-        if len(strs) < 3 and image is None:
+        if len(strs) < 3 and attachment is None:
             return "", "", None, False
 
         # Must have command.
@@ -57,129 +218,273 @@ class CommandSetter(commands.Cog):
         # It is possible to have an image attachment but no content.
         content = strs[2] if len(strs) > 2 else ""
         command = strs[1].lower()
-        return command, content, image, True
+        return command, content, attachment, True
+
+    async def _fetch_image(self, message, attachment: Optional[discord.Attachment]) -> Tuple[Optional[discord.File], Optional[int], bool]:
+        """
+        Downloads the attachment, and shrinks it if we can (see images.py).
+        Returns the image to save, its original size if it was shrunk, and
+        true iff successful. Tells the user what went wrong if not.
+        """
+        if attachment is None:
+            return None, None, True
+        # Discord tells us how big it is, so most oversized attachments are
+        # turned away without downloading any of them.
+        if attachment.size > MAX_ATTACHMENT_BYTES:
+            await _send(message.channel, ATTACHMENT_TOO_LARGE_ERROR)
+            return None, None, False
+        try:
+            data = await _download(attachment, MAX_ATTACHMENT_BYTES, ATTACHMENT_TIMEOUT_SECONDS)
+        except AttachmentTooLarge:
+            await _send(message.channel, ATTACHMENT_TOO_LARGE_ERROR)
+            return None, None, False
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            await _send(message.channel, DOWNLOAD_ERROR)
+            return None, None, False
+        image = discord.File(io.BytesIO(data), filename=attachment.filename)
+        if self._image_normalizer is None:
+            return image, None, True
+        image, original_size = await self._image_normalizer.normalize(image)
+        return image, original_size, True
+
+    async def _commands(self, message):
+        """Returns the commands for the guild the message was sent in."""
+        return await self._db.for_guild(_guild_id(message))
+
+    async def _list_pages(self, guild_id, db) -> List[str]:
+        """Returns LIST_COMMAND's output, split into messages short enough to send."""
+        key = (db.version, int(time.time() // (60**2)))
+        cached = self._list_pages_cache.get(guild_id)
+        if cached is not None and cached[0] == key:
+            self._list_pages_cache.move_to_end(guild_id)
+            return cached[1]
+
+        lines = []
+        for trigger, user, elapsed_seconds, responses in await db.list_commands():
+            elapsed = timedelta(seconds=round(elapsed_seconds))
+            line = f"**{SUMMONING_KEY}{trigger}**: last updated by {user} {elapsed.days} days and {elapsed.seconds//(60**2)} hours ago"
+            if responses > 1:
+                line += f" ({responses} responses)"
+            lines.append(line)
+
+        # Discord limits the number of characters that can be in a message.
+        # Split up if necessary.
+        pages = paginate(lines, MESSAGE_SIZE_LIMIT - LIST_PAGE_HEADER_SIZE)
+
+        self._list_pages_cache[guild_id] = (key, pages)
+        self._list_pages_cache.move_to_end(guild_id)
+        if len(self._list_pages_cache) > LIST_PAGES_CACHED_GUILDS:
+            self._list_pages_cache.popitem(last=False)
+        return pages
 
-    # TODO Now that I better understand discord.py, I desperately need to break these out into smaller commands.
     @commands.Cog.listener()
     async def on_message(self, message):
+        branch = self._branch(message)
+        if branch is None:
+            _IGNORED_MESSAGES.inc()
+            return
+        if self._warmup is not None and not self._warmup.is_ready():
+            await self._warmup.wait()
+        start = time.perf_counter()
+        try:
+            await self._handlers[branch](message)
+        finally:
+            _MESSAGE_SECONDS_BY_BRANCH[branch].observe(time.perf_counter() - start)
+
+    def _branch(self, message) -> Optional[str]:
+        """
+        Returns which handler the message is for, or None if it should be
+        ignored. Every message the bot can see comes through here, and nearly
+        all of them are chatter, so that case is decided by the first
+        character alone.
+        """
+        content = message.content
+        if content[:1] not in _FIRST_CHARS:
+            return None
+        if content.startswith(SUMMONING_KEY):
+            branch = 'summon'
+        else:
+            branch = _ADMIN_COMMANDS.get(content.split(maxsplit=1)[0])
+            if branch is None or not self._channels.is_admin_channel(message.channel):
+                return None
+
         # Ignore messages from ourself, otherwise we'll infinite loop.
         if message.author == self._user:
+            return None
+        return branch
+
+    async def _summon(self, message):
+        # Command is the first word, not including the summoning key
+        command = message.content.split()[0][len(SUMMONING_KEY):].lower()
+        # Messages like '~~this~~' are strikethrough, not summons.
+        if command == '' or command.startswith(SUMMONING_KEY):
+            return
+        db = await self._commands(message)
+        if command not in db:
+            await self._suggest(message, db, command)
             return
+        if self._summon_limiter is not None:
+            dropped = self._summon_limiter.check(message.author.id, message.channel.id, command)
+            if dropped is not None:
+                SUMMONS_DROPPED.labels(reason=dropped).inc()
+                return
+        content, image = await db.get(command)
+        if content != '' or image is not None:
+            await _send(message.channel, content, file=image)
 
+    async def _suggest(self, message, db, command):
+        if self._suggestion_limiter is not None:
+            dropped = self._suggestion_limiter.check(message.author.id, message.channel.id, command)
+            if dropped is not None:
+                SUGGESTIONS_DROPPED.labels(reason=dropped).inc()
+                return
+        suggestions = await db.suggest(command, SUMMON_SUGGESTIONS)
+        if len(suggestions) > 0:
+            await _send(message.channel, f"There's no '{SUMMONING_KEY}{command}'. Did you mean " +
+                        " or ".join(f"'{SUMMONING_KEY}{s}'" for s in suggestions) + "?")
 
-        if message.content.startswith(SUMMONING_KEY):
-            # Command is the first word, not including the summoning key
-            command = message.content.split()[0][len(SUMMONING_KEY):].lower()
-            content, image = self._db.get(command)
-            if content != '' or image is not None:
-                await message.channel.send(content, file=image)
+    async def _delete(self, message):
+        strs = message.content.split()
+        if len(strs) != 2:
+            await _send(message.channel, f"Sorry, bud. I need the format '{DELETE_COMMAND} <command>'.")
             return
+        command = strs[1].lower()
+        await (await self._commands(message)).delete(command)
+        await _send(message.channel, f"Got it! Will no longer respond to '{SUMMONING_KEY}{command}'.")
+        print(f"{datetime.now()}: {message.author.name} deleted '{command}'")
+
+    async def _save(self, message):
+        command, content, attachment, ok = CommandSetter._extract_content(message)
 
-        # Admin-only commands below this point.
-        if message.channel.name != self._admin_channel:
+        if not ok:
+            await _send(message.channel, f"Sorry, I need the format '{SAVE_COMMAND} <keyword> <response content>' and support no more than 1 image.")
+            return
+        image, original_size, ok = await self._fetch_image(message, attachment)
+        if not ok:
             return
 
-        if message.content.startswith(DELETE_COMMAND):
-            strs = message.content.split()
-            if len(strs) != 2:
-                await message.channel.send(f"Sorry, bud. I need the format '{DELETE_COMMAND} <command>'.")
-                return
-            command = strs[1].lower()
-            self._db.delete(command)
-            await message.channel.send(f"Got it! Will no longer respond to '{SUMMONING_KEY}{command}'.")
-            print(f"{datetime.now()}: {message.author.name} deleted '{command}'")
+        # If something is a random command (has multiple responses), don't
+        # automatically overwrite it.
+        db = await self._commands(message)
+        if not await db.overwrite(message.author.name, command, content, image, max_existing=1,
+                                  original_image_size=original_size):
+            await _send(message.channel,
+                "Sorry, {0}{1} is already a command with multiple responses. "
+                "If you're sure you want to overwrite it, delete it first with {2} {1})".format(
+                    SUMMONING_KEY, command, DELETE_COMMAND))
             return
 
-        if message.content.startswith(SAVE_COMMAND):
-            command, content, image, ok = await CommandSetter._extract_content(message)
+        response_msg = f"Got it! Will respond to '{SUMMONING_KEY}{command}' with '{content}'"
+        if image is not None:
+            response_msg += " and that image!"
 
-            if not ok:
-                await message.channel.send(f"Sorry, I need the format '{SAVE_COMMAND} <keyword> <response content>' and support no more than 1 image.")
-                return
+        await _send(message.channel, response_msg)
+        print(
+            f"{datetime.now()}: {message.author.name} set '{command}' to '{content}'. (Had image: {image is not None})")
 
-            # If something is a random command (has multiple responses), don't
-            # automatically overwrite it.
-            if self._db.count(command) > 1:
-                await message.channel.send(
-                    "Sorry, {0}{1} is already a command with multiple responses. "
-                    "If you're sure you want to overwrite it, delete it first with {2} {1})".format(
-                        SUMMONING_KEY, command, DELETE_COMMAND))
-                return
+    async def _add_all(self, message):
+        strs = message.content.split()
+        if len(strs) < 3:
+            await _send(message.channel, f"Sorry, I need the format '{RANDOM_COMMAND} <keyword> <response> <response> <response>...'.")
+            return
+        command, weight, ok = _split_weight(strs[1].lower())
+        if not ok:
+            await _send(message.channel, WEIGHT_ERROR)
+            return
+        content_words = strs[2:]
+        now = time.time()
+        db = await self._commands(message)
+        await db.save_many(
+            Response(now, message.author.name, command, w, weight) for w in content_words)
 
-            self._db.delete(command)
-            self._db.save(message.author.name, command, content, image)
+        c = await db.count(command)
+        await _send(message.channel, f"Got it! Will sometimes respond to '{SUMMONING_KEY}{command}' with one of those {len(content_words)} responses. ({c} total.)")
+        print(
+            f"{datetime.now()}: {message.author.name} added '{content_words}' to random command '{command}'")
 
-            response_msg = f"Got it! Will respond to '{SUMMONING_KEY}{command}' with '{content}'"
-            if image is not None:
-                response_msg += " and that image!"
+    async def _random_add(self, message):
+        command, content, attachment, ok = CommandSetter._extract_content(message)
+        if not ok:
+            await _send(message.channel, f"Sorry, I need the format '{RANDOM_COMMAND} <keyword> <response content>', and support no more than 1 image.")
+            return
+        command, weight, ok = _split_weight(command)
+        if not ok:
+            await _send(message.channel, WEIGHT_ERROR)
+            return
 
-            await message.channel.send(response_msg)
-            print(
-                f"{datetime.now()}: {message.author.name} set '{command}' to '{content}'. (Had image: {image is not None})")
+        image, original_size, ok = await self._fetch_image(message, attachment)
+        if not ok:
             return
+        db = await self._commands(message)
+        await db.save(message.author.name, command, content, image, weight=weight,
+                      original_image_size=original_size)
+        c = await db.count(command)
+        await _send(message.channel, f"Got it! Will sometimes respond to '{SUMMONING_KEY}{command}' with '{content}'. (one of {c} possible responses).")
+        print(
+            f"{datetime.now()}: {message.author.name} added '{content}' to random command '{command}'")
 
-        if message.content.startswith(ADD_ALL_COMMAND):
-            strs = message.content.split()
-            if len(strs) < 3:
-                await message.channel.send(f"Sorry, I need the format '{RANDOM_COMMAND} <keyword> <response> <response> <response>...'.")
-                return
-            command = strs[1].lower()
-            content_words = strs[2:]
-            for w in content_words:
-                self._db.save(message.author.name, command, w)
+    async def _list(self, message):
+        guild_id = _guild_id(message)
+        pages = await self._list_pages(guild_id, await self._db.for_guild(guild_id))
+        strs = message.content.split()
+        if len(strs) == 1:
+            for page in pages:
+                await _send(message.channel, page)
+            return
 
-            c = self._db.count(command)
-            await message.channel.send(f"Got it! Will sometimes respond to '{SUMMONING_KEY}{command}' with one of those {len(content_words)} responses. ({c} total.)")
-            print(
-                f"{datetime.now()}: {message.author.name} added '{content_words}' to random command '{command}'")
+        if len(strs) != 2 or not strs[1].isdigit() or not 1 <= int(strs[1]) <= len(pages):
+            await _send(message.channel, f"Sorry, I need the format '{LIST_COMMAND} [page]', where page is between 1 and {len(pages)}.")
             return
+        page = int(strs[1])
+        await _send(message.channel, f"Page {page} of {len(pages)}:\n{pages[page-1]}")
 
-        if message.content.startswith(RANDOM_COMMAND):
-            command, content, image, ok = await CommandSetter._extract_content(message)
-            if not ok:
-                await message.channel.send(f"Sorry, I need the format '{RANDOM_COMMAND} <keyword> <response content>', and support no more than 1 image.")
-                return
+    async def _stats(self, message):
+        # In a code block, so discord leaves the metric names alone.
+        for page in paginate(metrics.REGISTRY.summary() or ["Nothing recorded yet."],
+                             MESSAGE_SIZE_LIMIT - len("```\n\n```")):
+            await _send(message.channel, f"```\n{page}\n```")
+
+    async def _find(self, message):
+        strs = message.content.split()
+        page = 1
+        if len(strs) > 2 and strs[-1].isdigit():
+            page = int(strs.pop())
+        text = ' '.join(strs[1:])
+        if text == '' or page < 1:
+            await _send(message.channel, f"Sorry, I need the format '{FIND_COMMAND}<words> [page]'.")
+            return
+
+        db = await self._commands(message)
+        # One extra, to tell whether there's another page.
+        results = await db.search(text, FIND_RESULTS_PER_PAGE + 1, (page - 1) * FIND_RESULTS_PER_PAGE)
+        if len(results) == 0:
+            await _send(message.channel, f"Nothing matches '{text}'." if page == 1 else f"There's no page {page}.")
+            return
+
+        lines = [f"Page {page} of commands matching '{text}':"]
+        for r in results[:FIND_RESULTS_PER_PAGE]:
+            # Triggers found by name alone have no snippet.
+            line = f"**{SUMMONING_KEY}{r.trigger}**" + (f": {r.snippet}" if r.snippet else "")
+            if r.matches > 1:
+                line += f" ({r.matches} matching responses)"
+            lines.append(line)
+        if len(results) > FIND_RESULTS_PER_PAGE:
+            lines.append(f"For more, try '{FIND_COMMAND}{text} {page + 1}'.")
+        for p in paginate(lines, MESSAGE_SIZE_LIMIT):
+            await _send(message.channel, p)
 
-            self._db.save(message.author.name, command, content, image)
-            c = self._db.count(command)
-            await message.channel.send(f"Got it! Will sometimes respond to '{SUMMONING_KEY}{command}' with '{content}'. (one of {c} possible responses).")
-            print(
-                f"{datetime.now()}: {message.author.name} added '{content}' to random command '{command}'")
-            return
-
-        if message.content.startswith(LIST_COMMAND):
-            lines = []
-            for command in self._db.list_commands():
-                trigger, user, elapsed_seconds = command
-                elapsed = timedelta(seconds=round(elapsed_seconds))
-
-                lines.append(
-                    f"**{SUMMONING_KEY}{trigger}**: last updated by {user} {elapsed.days} days and {elapsed.seconds//(60**2)} hours ago")
-
-            # Discord limits the number of characters that can be in a message.
-            # Split up if necessary.
-            line_queue = []
-            total_chars = 0
-            for line in lines:
-                length = len(line)
-
-                # If this line would exceed the size limit, clear the queue
-                # by sending all the previous unsent lines.
-                if total_chars + length > MESSAGE_SIZE_LIMIT:
-                    await message.channel.send('\n'.join(line_queue))
-                    line_queue = []
-                    total_chars = 0
-                line_queue.append(line)
-                total_chars += length+1  # +1 is for the \n
-            await message.channel.send('\n'.join(line_queue))
-
-        if message.content.startswith(HELP_COMMAND):
-            await message.channel.send(
-                f"""
+    async def _help(self, message):
+        await _send(message.channel,
+            f"""
 Save a command: {SAVE_COMMAND} <keyword> <response content>
 Save a random command: {RANDOM_COMMAND} <keyword> <response content> ({ADD_ALL_COMMAND} to add each word as a separate response)
+Make a random response more (or less) likely: {RANDOM_COMMAND} <keyword>{WEIGHT_SEPARATOR}<weight> <response content>
 Use a command: {SUMMONING_KEY}<keyword>
 Delete a command: {DELETE_COMMAND} <keyword>
-List all commands: {LIST_COMMAND}
+List all commands: {LIST_COMMAND} [page]
+Search commands and their responses: {FIND_COMMAND}<words> [page]
+Show how long things are taking: {STATS_COMMAND}
 Save a flair setting: {PREFIX}set-flair <message ID> <emoji> <@role>
+Remove a flair setting: {PREFIX}remove-flair <message ID> <emoji>
+Catch roles up with reactions made while the bot was offline: {PREFIX}reconcile-flairs
 """)
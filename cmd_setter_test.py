@@ -1,16 +1,21 @@
 #!/usr/bin/env python3
 import asyncio
-import io
 import os
 import time
 import unittest
+from types import SimpleNamespace
 from typing import Optional, Tuple
-from unittest.mock import MagicMock, Mock
+from unittest.mock import MagicMock, Mock, patch
 
+import aiohttp
 import discord
+from aiohttp import web
 
 import cmd_setter
+from ratelimit import Limit, SummonLimiter
+from channels import ChannelIndex
 from storage import CmdStore
+from warmup import Warmup
 
 # Make sure this doesn't coincide with a sqlite db file that's really used.
 TEST_DB = 'test_db_please_ignore.db'
@@ -25,6 +30,8 @@ ADD_ALL = cmd_setter.ADD_ALL_COMMAND
 LIST = cmd_setter.LIST_COMMAND
 DELETE = cmd_setter.DELETE_COMMAND
 HELP = cmd_setter.HELP_COMMAND
+STATS = cmd_setter.STATS_COMMAND
+FIND = cmd_setter.FIND_COMMAND
 
 # TODO Testing flairs
 # make self.get_guild(_) return an object that returns an object with id when get_role(id) is called
@@ -40,14 +47,22 @@ class CommandSetterTest(unittest.TestCase):
         # it might not have been.
         if os.path.exists(TEST_DB):
             os.remove(TEST_DB)
-        db = CmdStore(TEST_DB)
+        self.db = CmdStore(TEST_DB)
+
+        # Attachments are "downloaded" from the mocks _attach_image makes.
+        downloads = patch('cmd_setter._download', _fake_download)
+        downloads.start()
+        self.addCleanup(downloads.stop)
 
         # Create a bot to test
         self.test_account = MagicMock(spec=discord.ClientUser)
+        self.channels = ChannelIndex(ADMIN)
         self.bot = MagicMock(wraps=cmd_setter.CommandSetter(
-            self.test_account, db, ADMIN))
+            self.test_account, self.db, self.channels))
 
     def tearDown(self):
+        self.db.close()
+
         # Remove our test db for cleanliness
         if os.path.exists(TEST_DB):
             os.remove(TEST_DB)
@@ -194,6 +209,55 @@ class TestCreateAndDeleteCommands(CommandSetterTest):
         self.assertEqual(image, returned_image.fp.read())
         self.assertEqual(image_name, returned_image.filename)
 
+    def test_doesnt_download_for_malformed_commands(self):
+        msg = message(f"{SAVE}", ADMIN)
+        attachment = _attach_image(msg, b"533190190")
+        self.send_check(msg, ["format"])
+        attachment.read.assert_not_called()
+
+        msg = message(f"{RANDOM}test*0 hi", ADMIN)
+        attachment = _attach_image(msg, b"533190190")
+        self.send_check(msg, ["weights"])
+        attachment.read.assert_not_called()
+
+    def test_rejects_oversized_attachments(self):
+        msg = message(f"{SAVE} test", ADMIN)
+        attachment = _attach_image(msg, b"533190190")
+        attachment.size = cmd_setter.MAX_ATTACHMENT_BYTES + 1
+        self.send_check(msg, ["too big"])
+        attachment.read.assert_not_called()
+
+        # Even if discord said it was small enough.
+        msg = message(f"{RANDOM}test", ADMIN)
+        _attach_image(msg, b"5" * (cmd_setter.MAX_ATTACHMENT_BYTES + 1)).size = 10
+        self.send_check(msg, ["too big"])
+
+        self.send_check(message(f"{SUMMON_KEY}test"), None)
+
+    def test_reports_failed_downloads(self):
+        msg = message(f"{SAVE} test", ADMIN)
+        attachment = _attach_image(msg, b"533190190")
+        attachment.read.side_effect = asyncio.TimeoutError
+        self.send_check(msg, ["couldn't download"])
+        self.send_check(message(f"{SUMMON_KEY}test"), None)
+
+    def test_survives_restart(self):
+        self.send_check(message(f"{SAVE} test I remember things", ADMIN), [])
+        self.send_check(message(f"{RANDOM} test2 me too", ADMIN), [])
+        self.send_check(message(f"{DELETE} test2", ADMIN), [])
+
+        # A fresh store has to rebuild its trigger index from the database.
+        self.db.close()
+        self.db = CmdStore(TEST_DB)
+        self.bot = MagicMock(wraps=cmd_setter.CommandSetter(
+            self.test_account, self.db, self.channels))
+
+        self.send_check(message(f"{SUMMON_KEY}test"), "I remember things")
+        # At most, test2 gets a suggestion to try test.
+        content, image = self.send(message(f"{SUMMON_KEY}test2"))
+        self.assertNotIn("me too", content or "")
+        self.assertIsNone(image)
+
     def test_ignores_unset_commands(self):
         # Use of the same "test" command name we use in the other tests is
         # intentional. Consider it a bonus sanity check to make sure we're
@@ -232,8 +296,41 @@ class TestListCommands(CommandSetterTest):
         r, _ = self.send(message(f"{LIST}", ADMIN))
         self.assertEqual(r.count("test1"), 1)
 
-    # TODO think up a decent way to test splitting up the response if too many
-    # commands have been added. Right now the effort doesn't seem worth it.
+    def test_counts_responses(self):
+        self.send_check(message(f"{ADD_ALL} test1 a b c", ADMIN), [])
+        self.send_check(message(f"{LIST}", ADMIN), ["test1", "3 responses"])
+
+    def test_pages(self):
+        # Enough commands to need a few pages.
+        for i in range(100):
+            _run(self.db.save("arbitrary_user", f"test{i:03}", "response"))
+
+        self.send_check(message(f"{LIST} 1", ADMIN), ["Page 1 of", "test000"])
+        r, _ = self.send(message(f"{LIST} 1", ADMIN))
+        self.assertNotIn("test099", r)
+        self.assertLessEqual(len(r), cmd_setter.MESSAGE_SIZE_LIMIT)
+
+        # Every command should be on exactly one page.
+        pages = int(r.split()[3].strip(':'))
+        listed = ''
+        for p in range(1, pages+1):
+            r, _ = self.send(message(f"{LIST} {p}", ADMIN))
+            listed += r
+        for i in range(100):
+            self.assertEqual(listed.count(f"test{i:03}"), 1)
+
+        self.send_check(message(f"{LIST} {pages+1}", ADMIN), ["Sorry", "page"])
+
+    def test_lists_changes(self):
+        self.send_check(message(f"{SAVE} test1 this is a test", ADMIN), [])
+        self.send_check(message(f"{LIST}", ADMIN), ["test1"])
+
+        # Listing again after a change shouldn't return stale results.
+        self.send_check(message(f"{SAVE} test2 this is a test", ADMIN), [])
+        self.send_check(message(f"{LIST}", ADMIN), ["test1", "test2"])
+        self.send_check(message(f"{DELETE} test1", ADMIN), [])
+        r, _ = self.send(message(f"{LIST}", ADMIN))
+        self.assertNotIn("test1", r)
 
 
 class TestRandomCommands(CommandSetterTest):
@@ -287,6 +384,32 @@ class TestRandomCommands(CommandSetterTest):
         self.assertGreater(totals["3"], 10)
         self.assertGreater(totals["4"], 10)
 
+    def test_weighted(self):
+        self.send_check(message(f"{RANDOM} test*9 common", ADMIN), [])
+        self.send_check(message(f"{RANDOM} test rare", ADMIN), [])
+
+        totals = {"common": 0, "rare": 0}
+        for i in range(100):
+            r, _ = self.send(message(f"{SUMMON_KEY}test"))
+            totals[r] += 1
+
+        # Expect about 90 common responses.
+        self.assertGreater(totals["common"], 70)
+        self.assertGreater(totals["rare"], 0)
+
+    def test_rejects_bad_weights(self):
+        for weight in ("0", "-1", "lots", "nan", "1e9"):
+            self.send_check(message(f"{RANDOM} test*{weight} response", ADMIN),
+                            ["Sorry", "weight"])
+            self.send_check(message(f"{ADD_ALL} test*{weight} a b", ADMIN),
+                            ["Sorry", "weight"])
+
+    def test_rejects_weights_without_keywords(self):
+        self.send_check(message(f"{RANDOM} *3 response", ADMIN), ["Sorry", "<keyword>"])
+        self.send_check(message(f"{ADD_ALL} *3 a b", ADMIN), ["Sorry", "<keyword>"])
+        self.assertEqual(_run(self.db.count('')), 0)
+        self.send_check(message(f"{SUMMON_KEY}test"), None)
+
     def test_attempt_overwrite_to_single(self):
         # Attempt to overwrite a random command with a single command.
         self.send_check(message(f"{RANDOM} test a response", ADMIN), [])
@@ -348,6 +471,206 @@ class TestHelp(CommandSetterTest):
         self.assertIsNone(image)
 
 
+class TestAdminChannel(CommandSetterTest):
+    def setUp(self):
+        super().setUp()
+        self.admin = SimpleNamespace(id=1, name=ADMIN)
+        self.general = SimpleNamespace(id=2, name='general')
+        self.guild = SimpleNamespace(id=10, name='guild', channels=[self.admin, self.general])
+        self.admin.guild = self.general.guild = self.guild
+        _run(self.channels.index_guilds([self.guild]))
+
+    def help_in(self, channel):
+        m = message(HELP)
+        m.channel.id, m.channel.name, m.channel.guild = channel.id, channel.name, channel.guild
+        resp, _ = self.send(m)
+        return resp
+
+    def test_notices_renamed_channels(self):
+        self.assertIsNotNone(self.help_in(self.admin))
+        self.assertIsNone(self.help_in(self.general))
+
+        # The admin channel renamed, and another channel renamed to take its place.
+        renamed = SimpleNamespace(id=1, name='renamed', guild=self.guild)
+        _run(self.channels.on_guild_channel_update(self.admin, renamed))
+        self.assertIsNone(self.help_in(renamed))
+        promoted = SimpleNamespace(id=2, name=ADMIN, guild=self.guild)
+        _run(self.channels.on_guild_channel_update(self.general, promoted))
+        self.assertIsNotNone(self.help_in(promoted))
+
+    def test_needs_whole_command(self):
+        resp, _ = self.send(message(f"{HELP}me", ADMIN))
+        self.assertIsNone(resp)
+
+
+class TestWarmup(CommandSetterTest):
+    def test_holds_messages_until_warmed_up(self):
+        warmup = Warmup()
+        self.bot = MagicMock(wraps=cmd_setter.CommandSetter(
+            self.test_account, self.db, self.channels, warmup=warmup))
+        _run(self.db.save("arbitrary_user", "a", "response a"))
+        m = message(f"{SUMMON_KEY}a")
+        m.channel.send.return_value = empty_future()
+
+        async def main():
+            summon = asyncio.ensure_future(self.bot.on_message(m))
+            await asyncio.sleep(0.01)
+            self.assertFalse(m.channel.send.called)
+            await warmup.run([SimpleNamespace(id=1)])
+            await summon
+        _run(main())
+        m.channel.send.assert_called_once()
+        self.assertEqual(list(warmup.timings), ['commands'])
+
+
+class TestSummonLimits(CommandSetterTest):
+    def setUp(self):
+        super().setUp()
+        self.now = 0.0
+        limiter = SummonLimiter(per_user=Limit(per_second=1, burst=2),
+                                dedup_window=5, clock=lambda: self.now)
+        suggestion_limiter = SummonLimiter(per_user=Limit(per_second=1, burst=1), clock=lambda: self.now)
+        self.bot = MagicMock(wraps=cmd_setter.CommandSetter(
+            self.test_account, self.db, self.channels, limiter, suggestion_limiter=suggestion_limiter))
+        _run(self.db.save("arbitrary_user", "a", "response a"))
+        _run(self.db.save("arbitrary_user", "b", "response b"))
+        _run(self.db.save("arbitrary_user", "hello", "hi"))
+
+    def summon(self, trigger, user_id=1, channel_id=1):
+        m = message(f"{SUMMON_KEY}{trigger}")
+        m.author.id = user_id
+        m.channel.id = channel_id
+        resp, _ = self.send(m)
+        return resp
+
+    def test_collapses_repeats(self):
+        dropped = cmd_setter.SUMMONS_DROPPED.labels(reason='duplicate')
+        before = dropped.value
+        self.assertEqual(self.summon("a", user_id=1), "response a")
+        self.assertIsNone(self.summon("a", user_id=2))
+        self.assertEqual(self.summon("a", user_id=2, channel_id=2), "response a")
+        self.assertEqual(dropped.value, before + 1)
+
+        self.now = 5
+        self.assertEqual(self.summon("a", user_id=3), "response a")
+
+    def test_limits_users(self):
+        self.assertEqual(self.summon("a", channel_id=1), "response a")
+        self.assertEqual(self.summon("b", channel_id=1), "response b")
+        self.assertIsNone(self.summon("a", channel_id=2))
+        self.assertEqual(self.summon("a", user_id=2, channel_id=2), "response a")
+
+        self.now = 1
+        self.assertEqual(self.summon("b", channel_id=2), "response b")
+
+    def test_misses_dont_use_up_summons(self):
+        dropped = cmd_setter.SUMMONS_DROPPED.labels(reason='user')
+        suggestions_dropped = cmd_setter.SUGGESTIONS_DROPPED.labels(reason='user')
+        before, suggestions_before = dropped.value, suggestions_dropped.value
+        self.assertIsNone(self.summon(f"{SUMMON_KEY}struck{SUMMON_KEY}{SUMMON_KEY}"))
+        self.assertIsNone(self.summon(f"{SUMMON_KEY}struck again{SUMMON_KEY}{SUMMON_KEY}"))
+        self.assertIn("Did you mean", self.summon("helo"))
+        self.assertIsNone(self.summon("hell"))
+        self.assertIsNone(self.summon("xyz"))
+
+        self.assertEqual(self.summon("a"), "response a")
+        self.assertEqual(self.summon("b"), "response b")
+        self.assertEqual(dropped.value, before)
+        self.assertEqual(suggestions_dropped.value, suggestions_before + 2)
+
+
+class TestDownload(unittest.TestCase):
+    """Downloads from a local server, in place of discord's CDN."""
+
+    def setUp(self):
+        async def serve(request):
+            size = int(request.match_info['size'])
+            resp = web.StreamResponse()
+            await resp.prepare(request)
+            for _ in range(size // 1000):
+                await resp.write(b'x' * 1000)
+            return resp
+
+        async def stall(request):
+            await asyncio.sleep(1)
+            return web.Response(body=b'too late')
+
+        app = web.Application()
+        app.router.add_get('/bytes/{size}', serve)
+        app.router.add_get('/stall', stall)
+        self.runner = web.AppRunner(app)
+        _run(self.runner.setup())
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        _run(site.start())
+        self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    def tearDown(self):
+        _run(self.runner.cleanup())
+
+    def download(self, path, max_bytes=10000, timeout=5):
+        attachment = MagicMock(spec=discord.Attachment)
+        attachment.url = self.url + path
+        return _run(cmd_setter._download(attachment, max_bytes, timeout))
+
+    def test_downloads(self):
+        self.assertEqual(self.download('/bytes/5000'), b'x' * 5000)
+
+    def test_stops_at_max_bytes(self):
+        with self.assertRaises(cmd_setter.AttachmentTooLarge):
+            self.download('/bytes/1000000')
+
+    def test_times_out(self):
+        with self.assertRaises(asyncio.TimeoutError):
+            self.download('/stall', timeout=0.1)
+
+    def test_raises_on_errors(self):
+        with self.assertRaises(aiohttp.ClientResponseError):
+            self.download('/missing')
+
+
+class TestFind(CommandSetterTest):
+    def test_finds_triggers_and_responses(self):
+        self.send_check(message(f"{SAVE} cat meow", ADMIN), [])
+        self.send_check(message(f"{ADD_ALL} pets cat dog cat", ADMIN), [])
+        self.send_check(message(f"{FIND}cat", ADMIN),
+                        ["**~cat**: meow", "**~pets**: **cat** (2 matching responses)"])
+        self.send_check(message(f"{FIND}giraffe", ADMIN), "Nothing matches 'giraffe'.")
+        self.send_check(message(f"{FIND}cat", "arbitrary-channel"), None)
+
+    def test_pages(self):
+        for i in range(cmd_setter.FIND_RESULTS_PER_PAGE + 2):
+            self.send_check(message(f"{SAVE} t{i} matches", ADMIN), [])
+        first, _ = self.send(message(f"{FIND}matches", ADMIN))
+        self.assertEqual(first.count("matches"), cmd_setter.FIND_RESULTS_PER_PAGE + 2)
+        self.assertIn(f"{FIND}matches 2", first)
+        second, _ = self.send(message(f"{FIND}matches 2", ADMIN))
+        self.assertEqual(second.count("**~t"), 2)
+        self.assertNotIn(f"{FIND}matches 3", second)
+        self.send_check(message(f"{FIND}matches 3", ADMIN), "There's no page 3.")
+
+    def test_suggests_on_misses(self):
+        self.send_check(message(f"{SAVE} hello hi", ADMIN), [])
+        self.send_check(message(f"{SUMMON_KEY}helo"), ["Did you mean", "~hello"])
+        self.assertIsNone(self.send(message(f"{SUMMON_KEY}xyz"))[0])
+        # Strikethrough.
+        self.assertIsNone(self.send(message(f"{SUMMON_KEY}{SUMMON_KEY}hello{SUMMON_KEY}{SUMMON_KEY}"))[0])
+
+
+class TestStats(CommandSetterTest):
+    def test_stats(self):
+        self.send_check(message(f"{SUMMON_KEY}test"), None)
+        self.send_check(message(STATS, ADMIN),
+                        ['newton_message_seconds{branch="summon"}',
+                         'newton_storage_seconds{method="CmdStore.get"}', "p99"])
+
+    def test_stats_doesnt_work_outside_admin_channel(self):
+        self.send_check(message(STATS), None)
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
 # We can set this as a return value to make mock functions behave as if they
 # are async functions
 def empty_future():
@@ -374,12 +697,20 @@ def message(text, channel='arbitrary-channel'):
 
 # Wraps image in a "discord.Attachment", and adds it to the "discord.Message" (actually mocks).
 def _attach_image(msg: discord.Message, image: bytes, filename: str='file.png'):
-    file_obj = discord.File(io.BytesIO(image), filename)
-
     attachment = MagicMock(spec=discord.Attachment)
-    attachment.to_file = MagicMock(return_value=future(file_obj))
+    attachment.filename = filename
+    attachment.size = len(image)
+    attachment.read = MagicMock(side_effect=lambda: future(image))
 
     msg.attachments = [attachment]
+    return attachment
+
+
+async def _fake_download(attachment, max_bytes, timeout):
+    data = await attachment.read()
+    if len(data) > max_bytes:
+        raise cmd_setter.AttachmentTooLarge()
+    return data
 
 
 if __name__ == '__main__':
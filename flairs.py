@@ -1,39 +1,215 @@
 
+import asyncio
 import discord
+import time
 
+from collections import OrderedDict
 from discord.ext import commands
 from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+import metrics
+from channels import ChannelIndex
+from log_sink import LOG_FLUSH_INTERVAL_SECONDS, LogSink
+from reconcile import ReconcileReport, Reconciler
+from warmup import Warmup
+
+# How long to wait for more reactions from a member before actually editing
+# their roles. Anything they do in that window goes out as a single edit.
+ROLE_EDIT_DELAY_SECONDS = 1.0
+
+# How many members MemberCache remembers fetching, and for how long.
+# Role edits are computed from the member's roles, so a cached member must not
+# be kept long enough to go meaningfully stale.
+MEMBER_CACHE_SIZE = 1000
+MEMBER_CACHE_TTL_SECONDS = 60
+
+REACTION_SECONDS = metrics.histogram(
+    'newton_reaction_seconds', "Time taken to handle a reaction event.", ['event'])
+_REACTION_ADD_SECONDS = REACTION_SECONDS.labels(event='add')
+_REACTION_REMOVE_SECONDS = REACTION_SECONDS.labels(event='remove')
+
+
+class MemberCache:
+    """
+    Looks up guild members while making as few API calls as possible.
+
+    Checks discord.py's own member cache (kept up to date by the gateway)
+    first, then members we've recently fetched or been handed by events, and
+    only then asks discord.
+    """
+
+    def __init__(self, max_size=MEMBER_CACHE_SIZE, ttl=MEMBER_CACHE_TTL_SECONDS, clock=time.monotonic):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._clock = clock
+        # Maps (guild id, user id) to (expiry time, member), least recently
+        # used first.
+        self._members: OrderedDict = OrderedDict()
+
+        self.gateway_hits = 0
+        self.hits = 0
+        self.misses = 0
+
+    def remember(self, member: discord.Member):
+        key = (member.guild.id, member.id)
+        self._members[key] = (self._clock() + self._ttl, member)
+        self._members.move_to_end(key)
+        while len(self._members) > self._max_size:
+            self._members.popitem(last=False)
+
+    def forget(self, guild_id, user_id):
+        self._members.pop((guild_id, user_id), None)
+
+    def from_gateway(self, guild: discord.Guild, user_id: int) -> Optional[discord.Member]:
+        """Returns the gateway's copy of the member, which is always up to date, if it has one."""
+        member = guild.get_member(user_id)
+        if member is not None:
+            self.gateway_hits += 1
+        return member
+
+    async def get(self, guild: discord.Guild, user_id: int) -> discord.Member:
+        member = self.from_gateway(guild, user_id)
+        if member is not None:
+            return member
+
+        key = (guild.id, user_id)
+        entry = self._members.get(key)
+        if entry is not None:
+            expiry, member = entry
+            if expiry > self._clock():
+                self.hits += 1
+                self._members.move_to_end(key)
+                return member
+            del self._members[key]
+
+        self.misses += 1
+        member = await metrics.discord_request('fetch_member', guild.fetch_member(user_id))
+        self.remember(member)
+        return member
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'gateway_hits': self.gateway_hits,
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._members),
+        }
+
+
+class _PendingRoleEdit:
+    """The role changes we've been asked to make to one member, but haven't yet."""
+
+    def __init__(self, guild, user_id):
+        self.guild = guild
+        self.user_id = user_id
+        # Only set if an event gave us the member for free.
+        self.member: Optional[discord.Member] = None
+        # Maps role ids to whether the member should end up with that role.
+        # Later reactions overwrite earlier ones, so adding and then removing
+        # a role cancels out.
+        self.wanted: Dict[int, bool] = {}
+        self.roles = {}
+        self.reasons = []
+        self.task: Optional[asyncio.Task] = None
+
+    def want(self, role, add, reason):
+        self.wanted[role.id] = add
+        self.roles[role.id] = role
+        if reason not in self.reasons:
+            self.reasons.append(reason)
+
+
+class _RoleEditLock:
+    """Held while a member's roles are edited. Dropped once nobody's waiting for it."""
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
 
 
 class Flairs(commands.Cog):
 
-    def __init__(self, flair_store, bot, admin_channel, log_channel):
+    def __init__(self, flair_store, bot, channels: ChannelIndex, role_edit_delay=ROLE_EDIT_DELAY_SECONDS, member_cache=None, log_flush_interval=LOG_FLUSH_INTERVAL_SECONDS,
+                 warmup: Optional[Warmup] = None, reconcile_on_ready=True):
         self._db = flair_store
         self._bot = bot
-        self._log_channel_name = log_channel
-        self._admin_channel_name = admin_channel
-        self._log_channels_by_guild_id = {}
+        self._members = member_cache if member_cache is not None else MemberCache()
+        # Knows the admin channels, and where to log.
+        self._channels = channels
+        self._log_sink = LogSink(channels.log_channel, interval=log_flush_interval)
+        self._role_edit_delay = role_edit_delay
+        self._pending_role_edits: Dict[Tuple[int, int], _PendingRoleEdit] = {}
+        # Edits may send a member's whole list of roles, so two at once for
+        # the same member (like a reaction's and reconciling's) could undo
+        # each other. Each member's edits are made one at a time instead.
+        self._role_edit_locks: Dict[Tuple[int, int], _RoleEditLock] = {}
+
+        # Maps (message id, reaction id) pairs to the ids of the roles that
+        # reacting with them grants. Every reaction anywhere triggers our
+        # listeners, so this lets us skip the database for the vast majority
+        # that aren't on flair messages.
+        # Kept in sync by set_flair and remove_flair, and by load_flairs for
+        # changes made elsewhere.
+        self._roles_by_reaction: Dict[Tuple[str, str], List[str]] = {}
+        self._flair_message_ids: Set[str] = set()
+
+        # Without one, on_ready loads everything itself, and reactions aren't
+        # held back meanwhile.
+        self._warmup = warmup
+        if warmup is not None:
+            warmup.add_phase('flairs', lambda guilds: self.load_flairs())
+
+        # Catches roles up with reactions missed while the bot was offline,
+        # in the background every time it connects, and when asked to. Only
+        # being asked to looks through every channel for flair messages, or
+        # takes roles away.
+        self._reconciler = Reconciler(bot, self._apply_reconciled_roles)
+        self._reconcile_on_ready = reconcile_on_ready
 
     @commands.Cog.listener()
     async def on_ready(self):
-        # Register our log channels.
-        # We can't do this in __init__ because we may not be logged in then.
-        for g in self._bot.guilds:
-            log_channel = None
-            for c in g.channels:
-                if c.name == self._log_channel_name:
-                    log_channel = c
-            if log_channel is None:
-                print(
-                    f"No channel with name {self._log_channel_name} in guild {g.name}. "
-                    "Flairs added or removed there will only be logged to stdout.")
-                continue
-            self._log_channels_by_guild_id[g.id] = log_channel
+        if self._warmup is None:
+            await self.load_flairs()
+        self._log_sink.start()
+        if self._reconcile_on_ready:
+            asyncio.ensure_future(self._reconcile_in_background())
+
+    async def _reconcile_in_background(self):
+        await self._warmed_up()
+        try:
+            await self.reconcile()
+        except Exception as e:
+            print(f"Failed to catch roles up with reactions: {e}")
+
+    async def reconcile(self, sweep=False, remove=False) -> ReconcileReport:
+        """
+        Catches roles up with any reactions the bot missed (see reconcile.py).
+        Flair messages whose channels aren't known yet are only looked for if
+        sweep is true, and roles are only taken away if remove is true.
+        """
+        # Flairs set or removed elsewhere (like by another shard) count too.
+        await self.load_flairs()
+        report = await self._reconciler.run(self._roles_by_reaction, sweep, remove)
+        print(report.summary())
+        return report
+
+    async def load_flairs(self):
+        """(Re)reads which reactions grant which roles from the database."""
+        roles_by_reaction = {}
+        for message_id, reaction_id, role_id in await self._db.list_flair_messages():
+            roles_by_reaction.setdefault(
+                (str(message_id), str(reaction_id)), []).append(str(role_id))
+        self._roles_by_reaction = roles_by_reaction
+        self._flair_message_ids = {m for m, _ in roles_by_reaction}
+
+    def cog_unload(self):
+        asyncio.ensure_future(self._log_sink.stop())
 
     # Ignore any commands that aren't from the admin channel.
     # Does not apply to listeners.
     def bot_check(self, ctx):
-        return ctx.message.channel.name == self._admin_channel_name
+        return self._channels.is_admin_channel(ctx.message.channel)
 
     @commands.command(name="debug-flair")
     async def debug_flair(self, ctx, reaction):
@@ -51,9 +227,31 @@ class Flairs(commands.Cog):
         print(g)
         m = await ctx.fetch_message(message_id)
 
+    @commands.command(name="debug-member-cache")
+    async def debug_member_cache(self, ctx):
+        await metrics.discord_request('send', ctx.message.channel.send(
+            ', '.join(f"{k}: {v}" for k, v in self._members.stats().items())))
+
+    @commands.command(name="reconcile-flairs")
+    async def reconcile_flairs(self, ctx):
+        channel = ctx.message.channel
+        if self._reconciler.is_running():
+            done, total = self._reconciler.progress
+            await metrics.discord_request('send', channel.send(
+                f"Already catching roles up with reactions. {done} of {total} flair messages checked so far."))
+        else:
+            await metrics.discord_request('send', channel.send(
+                "Catching roles up with reactions. This may take a while."))
+        report = await self.reconcile(sweep=True, remove=True)
+        await metrics.discord_request('send', channel.send(report.summary()))
+
     @commands.command(name="set-flair")
     async def set_flair(self, ctx, message_id, reaction):
         channel = ctx.message.channel
+        if not (message_id.isascii() and message_id.isdigit()):
+            await metrics.discord_request('send', channel.send(
+                f"Sorry, '{message_id}' isn't a message ID. Right click the message and pick \"Copy ID\" to get one."))
+            return
 
         # TODO Make sure the message actually exists
         # It's not documented, but ctx.fetch_message only fetches a message
@@ -76,43 +274,173 @@ class Flairs(commands.Cog):
                 f"Failed to verify an emoji (ID {reaction_id}). This is probably fine: {e}")
             pass
         if not confirmed_custom_emoji:
-            await channel.send(
+            await metrics.discord_request('send', channel.send(
                 f"Heads up: The given emoji '{reaction}' isn't registering as a custom emoji. "
-                "That's fine if it's a built-in emoji, otherwise something went wrong.")
+                "That's fine if it's a built-in emoji, otherwise something went wrong."))
 
         # Extract the mentioned role's ID
         if len(ctx.message.role_mentions) != 1:
-            await channel.send("Sorry, I need exactly one role @mentioned.")
+            await metrics.discord_request('send', channel.send("Sorry, I need exactly one role @mentioned."))
             return
         role = ctx.message.role_mentions[0]
 
         # Now that we've verified as much as we can, save it into our database.
-        self._db.save(ctx.message.author.name,
-                      message_id, reaction_id, role.id)
-        await channel.send(f"Got it! Will add the '{role.name}' role to anyone that reacts {reaction} to message {message_id}")
-        await self._log(ctx.guild.id,
+        await self._db.save(ctx.message.author.name,
+                            message_id, reaction_id, role.id)
+        self._roles_by_reaction.setdefault(
+            (str(message_id), str(reaction_id)), []).append(str(role.id))
+        self._flair_message_ids.add(str(message_id))
+        await metrics.discord_request('send', channel.send(f"Got it! Will add the '{role.name}' role to anyone that reacts {reaction} to message {message_id}"))
+        self._log(ctx.guild.id,
                         f"{datetime.now()}: {ctx.message.author.name} set the '{role.name}' role to anyone that reacts {reaction}' to message '{message_id}'")
 
+    @commands.command(name="remove-flair")
+    async def remove_flair(self, ctx, message_id, reaction):
+        channel = ctx.message.channel
+        reaction_id = self._emoji_id_from_str(reaction)
+        if self._roles_by_reaction.pop((str(message_id), str(reaction_id)), None) is None:
+            await metrics.discord_request('send', channel.send(f"Sorry, reacting {reaction} to message {message_id} doesn't do anything right now."))
+            return
+
+        await self._db.delete(message_id, reaction_id)
+        self._flair_message_ids = {m for m, _ in self._roles_by_reaction}
+        await metrics.discord_request('send', channel.send(f"Got it! Reacting {reaction} to message {message_id} will no longer add any roles."))
+        self._log(ctx.guild.id,
+                        f"{datetime.now()}: {ctx.message.author.name} removed the flairs for reacting {reaction} to message '{message_id}'")
+
+    def _role_ids_for(self, payload) -> List[str]:
+        """Returns the ids of any roles associated with the reaction in the given event."""
+        message_id = str(payload.message_id)
+        if message_id not in self._flair_message_ids:
+            return []
+        reaction_id = str(self._get_emoji_id(payload.emoji))
+        return self._roles_by_reaction.get((message_id, reaction_id), [])
+
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload):
-        reaction_id = self._get_emoji_id(payload.emoji)
-        role_ids = self._db.get(payload.message_id, reaction_id)
-        for rID in role_ids:
-            guild = self._bot.get_guild(payload.guild_id)
-            role = guild.get_role(int(rID))
-            await payload.member.add_roles(role, reason=f"Reacted with {payload.emoji} to message {payload.message_id}.")
-            await self._log(payload.guild_id, f"Added {role} to {payload.member}")
+        await self._warmed_up()
+        with _REACTION_ADD_SECONDS.time():
+            self._queue_role_edits(payload, add=True)
 
     @commands.Cog.listener()
     async def on_raw_reaction_remove(self, payload):
-        reaction_id = self._get_emoji_id(payload.emoji)
-        role_ids = self._db.get(payload.message_id, reaction_id)
+        await self._warmed_up()
+        with _REACTION_REMOVE_SECONDS.time():
+            self._queue_role_edits(payload, add=False)
+
+    async def _warmed_up(self):
+        # Until then, we may not know which reactions grant roles.
+        if self._warmup is not None and not self._warmup.is_ready():
+            await self._warmup.wait()
+
+    def _queue_role_edits(self, payload, add):
+        """
+        Records the role changes the given reaction event asks for.
+
+        The changes aren't made right away. Members tend to click through a
+        role menu several reactions at a time, so we wait for them to finish
+        and then make all of their changes with a single edit.
+        """
+        role_ids = self._role_ids_for(payload)
+        if len(role_ids) == 0:
+            return
+
+        guild = self._bot.get_guild(payload.guild_id)
+        self._reconciler.remember(payload.message_id, guild.id, payload.channel_id)
+        key = (guild.id, int(payload.user_id))
+        pending = self._pending_role_edits.get(key)
+        if pending is None:
+            pending = _PendingRoleEdit(guild, int(payload.user_id))
+            self._pending_role_edits[key] = pending
+            pending.task = asyncio.ensure_future(self._apply_role_edit_later(key))
+
+        # Only reaction adds come with the member attached.
+        if getattr(payload, 'member', None) is not None:
+            pending.member = payload.member
+            self._members.remember(payload.member)
         for rID in role_ids:
-            guild = self._bot.get_guild(payload.guild_id)
             role = guild.get_role(int(rID))
-            user = await guild.fetch_member(int(payload.user_id))
-            await user.remove_roles(role, reason=f"Reacted with {payload.emoji} to message {payload.message_id}.")
-            await self._log(payload.guild_id, f"Removed {role} from {user}")
+            if role is None:
+                print(f"Role {rID} no longer exists in guild {guild.name}. Ignoring it.")
+                continue
+            pending.want(role, add,
+                         f"Reacted with {payload.emoji} to message {payload.message_id}.")
+
+    async def _apply_role_edit_later(self, key):
+        await asyncio.sleep(self._role_edit_delay)
+        pending = self._pending_role_edits.pop(key)
+        try:
+            await self._apply_role_edit_alone(pending)
+        except Exception as e:
+            print(f"Failed to update roles for user {pending.user_id} in guild {pending.guild.id}: {e}")
+
+    async def _apply_role_edit_alone(self, pending: _PendingRoleEdit):
+        """Applies the edit once any other edit to the same member is done."""
+        key = (pending.guild.id, pending.user_id)
+        entry = self._role_edit_locks.get(key)
+        if entry is None:
+            entry = self._role_edit_locks[key] = _RoleEditLock()
+        entry.users += 1
+        try:
+            async with entry.lock:
+                await self._apply_role_edit(pending)
+        finally:
+            entry.users -= 1
+            if entry.users == 0:
+                del self._role_edit_locks[key]
+
+    async def _apply_role_edit(self, pending: _PendingRoleEdit):
+        reason = ' '.join(pending.reasons)
+        # The gateway keeps its copy of the member up to date, so its roles
+        # can be edited as a whole, in one request. Any other copy may be
+        # out of date, and editing its whole list of roles would undo
+        # whatever changed since, so only the roles that change are sent.
+        member = self._members.from_gateway(pending.guild, pending.user_id)
+        if member is not None:
+            # The first role is always @everyone, which can't be assigned.
+            current = member.roles[1:]
+            current_ids = {r.id for r in current}
+            added = [pending.roles[rID] for rID, add in pending.wanted.items()
+                     if add and rID not in current_ids]
+            removed = [r for r in current if pending.wanted.get(r.id) is False]
+            if len(added) == 0 and len(removed) == 0:
+                return
+            await metrics.discord_request('edit_member', member.edit(
+                roles=[r for r in current if r not in removed] + added, reason=reason))
+        else:
+            member = pending.member
+            if member is None:
+                member = await self._members.get(pending.guild, pending.user_id)
+            added = [pending.roles[rID] for rID, add in pending.wanted.items() if add]
+            removed = [pending.roles[rID] for rID, add in pending.wanted.items() if not add]
+            try:
+                if len(added) > 0:
+                    await metrics.discord_request('add_roles', member.add_roles(*added, reason=reason))
+                if len(removed) > 0:
+                    await metrics.discord_request('remove_roles', member.remove_roles(*removed, reason=reason))
+            except Exception:
+                # Whatever we had cached might be why this failed.
+                self._members.forget(pending.guild.id, member.id)
+                raise
+
+        changes = []
+        if len(added) > 0:
+            changes.append(f"Added {', '.join(str(r) for r in added)} to {member}")
+        if len(removed) > 0:
+            changes.append(f"Removed {', '.join(str(r) for r in removed)} from {member}")
+        self._log(pending.guild.id, '. '.join(changes))
+
+    async def _apply_reconciled_roles(self, guild, user_id, changes, reason):
+        pending = _PendingRoleEdit(guild, user_id)
+        for role, add in changes:
+            pending.want(role, add, reason)
+        await self._apply_role_edit_alone(pending)
+
+    async def flush_role_edits(self):
+        """Waits until every queued role change has been made."""
+        tasks = [p.task for p in self._pending_role_edits.values()]
+        if len(tasks) > 0:
+            await asyncio.gather(*tasks)
 
     def _get_emoji_id(self, emoji: discord.PartialEmoji) -> str:
         """
@@ -157,9 +485,5 @@ class Flairs(commands.Cog):
         # format. Just return the whole thing.
         return emoji
 
-    async def _log(self, guild_id, message):
-        print(message)
-        if guild_id not in self._log_channels_by_guild_id:
-            return
-        c = self._log_channels_by_guild_id[guild_id]
-        await c.send(message)
+    def _log(self, guild_id, message):
+        self._log_sink.log(guild_id, message)
@@ -0,0 +1,618 @@
+#!/usr/bin/env python3
+import asyncio
+import copy
+import os
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import discord
+
+import flairs
+from channels import ChannelIndex
+from messages import MESSAGE_SIZE_LIMIT
+from storage import FlairStore
+from warmup import Warmup
+
+# Make sure this doesn't coincide with a sqlite db file that's really used.
+TEST_DB = 'test_flair_db_please_ignore.db'
+
+ADMIN = 'admin-channel'
+LOG = 'log-channel'
+
+# Short, so tests don't take forever, but long enough that the reactions in a
+# test all land in the same window.
+ROLE_EDIT_DELAY = 0.05
+
+GUILD_ID = 1234
+FLAIR_MESSAGE_ID = 5678
+THUMBS_UP = '👍'
+CUSTOM_EMOJI = '<:newton:123456789012345678>'
+
+
+# Fake versions of the discord objects Flairs works with. Every call that
+# would go out to discord is recorded in FakeGuild.calls, so tests can check
+# both what happened and how many requests it took.
+
+class FakeRole:
+    def __init__(self, role_id, name, guild=None):
+        self.id = role_id
+        self.name = name
+        self.guild = guild
+
+    def is_default(self):
+        return self.id == GUILD_ID
+
+    @property
+    def members(self):
+        # Like discord.py's, only knows about members in the gateway's cache.
+        if self.guild is None or not self.guild.gateway_cache:
+            return []
+        return [m for m in self.guild.members.values() if self in m.roles]
+
+    def __str__(self):
+        return self.name
+
+
+class FakeChannel:
+    def __init__(self, guild, name):
+        self.guild = guild
+        self.id = hash(name)
+        self.name = name
+        self.sent = []
+        self.messages = {}
+
+    async def send(self, content, **kwargs):
+        self.guild.calls.append(('send', self.name, content))
+        self.sent.append(content)
+
+    def add_message(self, message_id):
+        self.messages[message_id] = FakeMessage(self.guild, message_id)
+        return self.messages[message_id]
+
+    async def fetch_message(self, message_id):
+        self.guild.calls.append(('fetch_message', self.name, message_id))
+        if message_id not in self.messages:
+            raise discord.NotFound(SimpleNamespace(status=404, reason='Not Found'), 'Unknown Message')
+        return self.messages[message_id]
+
+
+class FakeMessage:
+    def __init__(self, guild, message_id):
+        self.guild = guild
+        self.id = message_id
+        self.reactions = []
+
+    def react(self, reaction, *members):
+        emoji = discord.PartialEmoji.from_str(reaction)
+        r = next((r for r in self.reactions if r.emoji == emoji), None)
+        if r is None:
+            r = FakeReaction(self.guild, emoji)
+            self.reactions.append(r)
+        r.user_ids += [m.id for m in members]
+
+
+class FakeReaction:
+    def __init__(self, guild, emoji):
+        self.guild = guild
+        # Unicode emoji are plain strings, like discord.py's.
+        self.emoji = emoji.name if emoji.id is None else emoji
+        self.user_ids = []
+
+    async def users(self, limit=None, after=None):
+        self.guild.calls.append(('reaction_users', after.id if after is not None else None))
+        ids = sorted(self.user_ids)
+        if after is not None:
+            ids = [i for i in ids if i > after.id]
+        for i in ids[:limit]:
+            yield SimpleNamespace(id=i)
+
+
+class FakeMember:
+    def __init__(self, guild, member_id):
+        self.guild = guild
+        self.id = member_id
+        # Like discord, the first role is always the guild's default role.
+        self.roles = [guild.default_role]
+
+    # Like discord, these change the member itself, whichever copy of them
+    # they're called on.
+    def _current(self):
+        return self.guild.members.get(self.id, self)
+
+    async def add_roles(self, *roles, reason=None):
+        self.guild.calls.append(('add_roles', self.id, [r.id for r in roles]))
+        current = self._current()
+        current.roles = current.roles + [r for r in roles if r not in current.roles]
+
+    async def remove_roles(self, *roles, reason=None):
+        self.guild.calls.append(('remove_roles', self.id, [r.id for r in roles]))
+        current = self._current()
+        current.roles = [r for r in current.roles if r not in roles]
+
+    async def edit(self, roles=None, reason=None):
+        self.guild.calls.append(('edit', self.id, sorted(r.id for r in roles)))
+        current = self._current()
+        current.roles = [self.guild.default_role] + list(roles)
+        return current
+
+    def __str__(self):
+        return f"member{self.id}"
+
+
+class FakeGuild:
+    def __init__(self, guild_id=GUILD_ID):
+        self.id = guild_id
+        self.name = f"guild{guild_id}"
+        self.calls = []
+        self.default_role = FakeRole(guild_id, '@everyone')
+        self.roles = {}
+        self.members = {}
+        self.channels = [FakeChannel(self, ADMIN), FakeChannel(self, LOG)]
+        # Whether get_member can find members, like it can when discord.py
+        # has the members intent.
+        self.gateway_cache = False
+
+    def add_role(self, role_id):
+        self.roles[role_id] = FakeRole(role_id, f"role{role_id}", self)
+        return self.roles[role_id]
+
+    def add_channel(self, name):
+        self.channels.append(FakeChannel(self, name))
+        return self.channels[-1]
+
+    def add_member(self, member_id):
+        self.members[member_id] = FakeMember(self, member_id)
+        return self.members[member_id]
+
+    def get_role(self, role_id):
+        return self.roles.get(role_id)
+
+    def get_member(self, member_id):
+        if not self.gateway_cache:
+            return None
+        return self.members.get(member_id)
+
+    async def fetch_member(self, member_id):
+        self.calls.append(('fetch_member', member_id))
+        return self.members[member_id]
+
+    @property
+    def text_channels(self):
+        return self.channels
+
+    def get_channel(self, channel_id):
+        return next((c for c in self.channels if c.id == channel_id), None)
+
+    def channel(self, name):
+        return next(c for c in self.channels if c.name == name)
+
+    def count(self, call):
+        """Returns how many calls of the given kind have been made."""
+        return len([c for c in self.calls if c[0] == call])
+
+
+class FakeBot:
+    def __init__(self, guilds):
+        self.guilds = guilds
+
+    def get_guild(self, guild_id):
+        return next((g for g in self.guilds if g.id == guild_id), None)
+
+    def get_emoji(self, emoji_id):
+        return None
+
+
+class FlairsTest(unittest.TestCase):
+    def setUp(self):
+        # TEST_DB should be deleted in tearDown, but if the test was interrupted
+        # it might not have been.
+        if os.path.exists(TEST_DB):
+            os.remove(TEST_DB)
+        self.db = FlairStore(TEST_DB)
+
+        self.guild = FakeGuild()
+        self.bot = FakeBot([self.guild])
+        self.channels = ChannelIndex(ADMIN, LOG)
+        _run(self.channels.index_guilds(self.bot.guilds))
+        self.cog = self.new_cog()
+        _run(self.cog.on_ready())
+
+    def tearDown(self):
+        _run(self.cog._log_sink.stop())
+        self.db.close()
+        if os.path.exists(TEST_DB):
+            os.remove(TEST_DB)
+
+    def new_cog(self, **kwargs):
+        # Tests flush the log themselves (see settle), rather than waiting.
+        return flairs.Flairs(self.db, self.bot, self.channels,
+                             role_edit_delay=ROLE_EDIT_DELAY,
+                             log_flush_interval=60, reconcile_on_ready=False, **kwargs)
+
+    def set_flair(self, message_id, reaction, role):
+        ctx = self.ctx(f"!set-flair {message_id} {reaction} <@&{role.id}>")
+        ctx.message.role_mentions = [role]
+        _run(self.cog.set_flair.callback(
+            self.cog, ctx, str(message_id), reaction))
+        self.settle()
+
+    def remove_flair(self, message_id, reaction):
+        _run(self.cog.remove_flair.callback(
+            self.cog, self.ctx(f"!remove-flair {message_id} {reaction}"),
+            str(message_id), reaction))
+        self.settle()
+
+    def ctx(self, text):
+        ctx = MagicMock()
+        ctx.guild = self.guild
+        ctx.bot = self.bot
+        ctx.message.content = text
+        ctx.message.author.name = "arbitrary_user"
+        ctx.message.channel = self.guild.channel(ADMIN)
+        return ctx
+
+    # Reacts, and by default waits for any resulting role changes to be made.
+    def react(self, member, reaction, message_id=FLAIR_MESSAGE_ID, settle=True):
+        _run(self.cog.on_raw_reaction_add(
+            payload(member, reaction, message_id)))
+        if settle:
+            self.settle()
+
+    # Removes a reaction. Like discord, doesn't include the member.
+    def unreact(self, member, reaction, message_id=FLAIR_MESSAGE_ID, settle=True):
+        p = payload(member, reaction, message_id)
+        p.member = None
+        _run(self.cog.on_raw_reaction_remove(p))
+        if settle:
+            self.settle()
+
+    def settle(self):
+        _run(self.cog.flush_role_edits())
+        _run(self.cog._log_sink.flush())
+
+    def role_ids(self, member):
+        return {r.id for r in member.roles if not r.is_default()}
+
+
+class TestReactionRoles(FlairsTest):
+    def test_adds_and_removes_roles(self):
+        role = self.guild.add_role(1)
+        member = self.guild.add_member(99)
+        self.set_flair(FLAIR_MESSAGE_ID, THUMBS_UP, role)
+
+        self.react(member, THUMBS_UP)
+        self.assertEqual(self.role_ids(member), {1})
+
+        self.unreact(member, THUMBS_UP)
+        self.assertEqual(self.role_ids(member), set())
+
+    def test_custom_emoji(self):
+        role = self.guild.add_role(1)
+        member = self.guild.add_member(99)
+        self.set_flair(FLAIR_MESSAGE_ID, CUSTOM_EMOJI, role)
+
+        self.react(member, CUSTOM_EMOJI)
+        self.assertEqual(self.role_ids(member), {1})
+
+    def test_ignores_other_reactions(self):
+        role = self.guild.add_role(1)
+        member = self.guild.add_member(99)
+        self.set_flair(FLAIR_MESSAGE_ID, THUMBS_UP, role)
+        calls = len(self.guild.calls)
+
+        # Wrong emoji, then wrong message.
+        self.react(member, CUSTOM_EMOJI)
+        self.react(member, THUMBS_UP, message_id=FLAIR_MESSAGE_ID + 1)
+        self.unreact(member, THUMBS_UP, message_id=FLAIR_MESSAGE_ID + 1)
+
+        self.assertEqual(self.role_ids(member), set())
+        self.assertEqual(len(self.guild.calls), calls)
+
+    def test_loads_flairs_on_ready(self):
+        role = self.guild.add_role(1)
+        member = self.guild.add_member(99)
+        self.set_flair(FLAIR_MESSAGE_ID, THUMBS_UP, role)
+
+        # A restarted bot should still know about the flair.
+        self.cog = self.new_cog()
+        _run(self.cog.on_ready())
+
+        self.react(member, THUMBS_UP)
+        self.assertEqual(self.role_ids(member), {1})
+
+    def test_remove_flair(self):
+        role = self.guild.add_role(1)
+        member = self.guild.add_member(99)
+        self.set_flair(FLAIR_MESSAGE_ID, THUMBS_UP, role)
+        self.remove_flair(FLAIR_MESSAGE_ID, THUMBS_UP)
+
+        self.react(member, THUMBS_UP)
+        self.assertEqual(self.role_ids(member), set())
+
+        # Should stay removed after a restart, too.
+        self.cog = self.new_cog()
+        _run(self.cog.on_ready())
+        self.react(member, THUMBS_UP)
+        self.assertEqual(self.role_ids(member), set())
+
+    def test_rejects_bad_message_ids(self):
+        role = self.guild.add_role(1)
+        self.set_flair('abc', THUMBS_UP, role)
+
+        self.assertIn("isn't a message ID", self.guild.channel(ADMIN).sent[-1])
+        self.assertEqual(_run(self.db.list_flair_messages()), [])
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class TestWarmup(FlairsTest):
+    def test_holds_reactions_until_warmed_up(self):
+        role = self.guild.add_role(1)
+        member = self.guild.add_member(99)
+        self.set_flair(FLAIR_MESSAGE_ID, THUMBS_UP, role)
+        _run(self.cog._log_sink.stop())
+
+        # A restarted bot, warming up.
+        warmup = Warmup()
+        self.cog = self.new_cog(warmup=warmup)
+        _run(self.cog.on_ready())
+
+        async def main():
+            reaction = asyncio.ensure_future(self.cog.on_raw_reaction_add(
+                payload(member, THUMBS_UP, FLAIR_MESSAGE_ID)))
+            await asyncio.sleep(0.01)
+            self.assertFalse(reaction.done())
+            await warmup.run(self.bot.guilds)
+            await reaction
+        _run(main())
+        self.settle()
+        self.assertEqual(self.role_ids(member), {1})
+        self.assertIn("Added role1 to member99", self.guild.channel(LOG).sent[-1])
+
+
+class TestCoalescedRoleEdits(FlairsTest):
+    def setUp(self):
+        super().setUp()
+        # With the gateway's up to date copy of members, a member's roles
+        # are edited all at once (see TestMemberCache for without).
+        self.guild.gateway_cache = True
+        self.roles = [self.guild.add_role(i) for i in range(1, 4)]
+        self.reactions = [THUMBS_UP, CUSTOM_EMOJI, '🎉']
+        for role, reaction in zip(self.roles, self.reactions):
+            self.set_flair(FLAIR_MESSAGE_ID, reaction, role)
+        self.guild.calls = []
+        self.guild.channel(LOG).sent = []
+
+    def test_burst_is_one_edit(self):
+        member = self.guild.add_member(99)
+        for reaction in self.reactions:
+            self.react(member, reaction, settle=False)
+        self.settle()
+
+        self.assertEqual(self.role_ids(member), {1, 2, 3})
+        self.assertEqual(self.guild.count('edit'), 1)
+        self.assertEqual(len(self.guild.channel(LOG).sent), 1)
+
+    def test_undone_reactions_cancel_out(self):
+        member = self.guild.add_member(99)
+        self.react(member, THUMBS_UP, settle=False)
+        self.unreact(member, THUMBS_UP, settle=False)
+        self.react(member, CUSTOM_EMOJI, settle=False)
+        self.settle()
+
+        self.assertEqual(self.role_ids(member), {2})
+        self.assertEqual(self.guild.count('edit'), 1)
+
+        # Removing and re-adding a role the member already has is a no-op.
+        self.unreact(member, CUSTOM_EMOJI, settle=False)
+        self.react(member, CUSTOM_EMOJI, settle=False)
+        self.settle()
+
+        self.assertEqual(self.role_ids(member), {2})
+        self.assertEqual(self.guild.count('edit'), 1)
+
+    def test_removals_fetch_member_once(self):
+        self.guild.gateway_cache = False
+        member = self.guild.add_member(99)
+        for reaction in self.reactions:
+            self.unreact(member, reaction, settle=False)
+        self.settle()
+
+        self.assertEqual(self.guild.count('fetch_member'), 1)
+
+    def test_members_are_edited_separately(self):
+        members = [self.guild.add_member(i) for i in (97, 98, 99)]
+        for m in members:
+            self.react(m, THUMBS_UP, settle=False)
+        self.settle()
+
+        for m in members:
+            self.assertEqual(self.role_ids(m), {1})
+        self.assertEqual(self.guild.count('edit'), 3)
+
+    def test_reconciling_waits_for_reaction_edits(self):
+        member = self.guild.add_member(99)
+        edit = member.edit
+        started, release = asyncio.Event(), asyncio.Event()
+
+        async def held_edit(roles=None, reason=None):
+            started.set()
+            await release.wait()
+            return await edit(roles=roles, reason=reason)
+        member.edit = held_edit
+
+        async def main():
+            await self.cog.on_raw_reaction_add(payload(member, THUMBS_UP))
+            await started.wait()
+            # Reconciling comes along while the reaction's edit is in flight.
+            reconciling = asyncio.ensure_future(self.cog._apply_reconciled_roles(
+                self.guild, member.id, [(self.roles[1], True)], "Catching up."))
+            await asyncio.sleep(0)
+            release.set()
+            await reconciling
+            await self.cog.flush_role_edits()
+        _run(main())
+
+        self.assertEqual(self.role_ids(member), {1, 2})
+        self.assertEqual(self.cog._role_edit_locks, {})
+
+
+class TestMemberCache(FlairsTest):
+    def setUp(self):
+        super().setUp()
+        self.role = self.guild.add_role(1)
+        self.set_flair(FLAIR_MESSAGE_ID, THUMBS_UP, self.role)
+        self.now = 0
+        self.cache = flairs.MemberCache(max_size=2, ttl=10,
+                                        clock=lambda: self.now)
+        _run(self.cog._log_sink.stop())
+        self.cog = self.new_cog(member_cache=self.cache)
+        _run(self.cog.on_ready())
+
+    def test_reacting_member_is_not_fetched_to_unreact(self):
+        member = self.guild.add_member(99)
+        self.react(member, THUMBS_UP)
+        self.unreact(member, THUMBS_UP)
+
+        self.assertEqual(self.role_ids(member), set())
+        self.assertEqual(self.guild.count('fetch_member'), 0)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_doesnt_undo_changes_made_since_caching(self):
+        member = self.guild.add_member(99)
+        self.react(member, THUMBS_UP)
+        # Someone else gives them a role, after we cached them.
+        stale = copy.copy(member)
+        stale.roles = list(member.roles)
+        self.cache.remember(stale)
+        member.roles.append(self.guild.add_role(2))
+
+        self.unreact(member, THUMBS_UP)
+        self.assertEqual(self.role_ids(member), {2})
+        self.assertEqual(self.guild.count('edit'), 0)
+
+    def test_prefers_gateway_cache(self):
+        self.guild.gateway_cache = True
+        member = self.guild.add_member(99)
+        member.roles.append(self.role)
+        self.unreact(member, THUMBS_UP)
+
+        self.assertEqual(self.role_ids(member), set())
+        self.assertEqual(self.guild.count('fetch_member'), 0)
+        self.assertEqual(self.cache.gateway_hits, 1)
+
+    def test_expires_and_evicts(self):
+        members = [self.guild.add_member(i) for i in (97, 98, 99)]
+        for m in members:
+            _run(self.cache.get(self.guild, m.id))
+        self.assertEqual(self.cache.misses, 3)
+
+        # 97 was evicted to make room for 99.
+        _run(self.cache.get(self.guild, 99))
+        _run(self.cache.get(self.guild, 97))
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 4)
+
+        self.now += 11
+        _run(self.cache.get(self.guild, 97))
+        self.assertEqual(self.cache.misses, 5)
+        self.assertEqual(self.guild.count('fetch_member'), 5)
+
+
+class TestLogSink(FlairsTest):
+    def test_packs_lines_into_messages(self):
+        log = self.guild.channel(LOG)
+        log.sent = []
+        line = 'x' * 99
+        for _ in range(50):
+            self.cog._log(GUILD_ID, line)
+        self.assertEqual(log.sent, [])
+
+        self.settle()
+        # 50 lines of 100 characters (with the newline) need 3 messages.
+        self.assertEqual(len(log.sent), 3)
+        self.assertTrue(all(len(m) <= MESSAGE_SIZE_LIMIT for m in log.sent))
+        self.assertEqual(sum(m.count(line) for m in log.sent), 50)
+
+    def test_drops_lines_past_the_limit(self):
+        log = self.guild.channel(LOG)
+        log.sent = []
+        sink = self.cog._log_sink
+        sink._max_queued = 10
+        for i in range(15):
+            self.cog._log(GUILD_ID, f"line {i}")
+
+        self.settle()
+        self.assertEqual(sink.dropped, 5)
+        self.assertEqual(log.sent, ['\n'.join(f"line {i}" for i in range(10))])
+
+    def test_sends_when_a_message_fills_up(self):
+        log = self.guild.channel(LOG)
+        log.sent = []
+        for _ in range(30):
+            self.cog._log(GUILD_ID, 'x' * 99)
+
+        # Even though the flush interval hasn't passed, more than a full
+        # message is waiting, so it should all be sent right away.
+        _run(asyncio.sleep(0.01))
+        self.assertEqual(len(log.sent), 2)
+        self.assertEqual(sum(m.count('x' * 99) for m in log.sent), 30)
+
+    def test_follows_log_channel_changes(self):
+        old = self.guild.channel(LOG)
+        _run(self.channels.on_guild_channel_delete(old))
+        self.cog._log(GUILD_ID, "nowhere")
+        self.settle()
+        self.assertEqual(old.sent, [])
+
+        new = FakeChannel(self.guild, LOG)
+        _run(self.channels.on_guild_channel_create(new))
+        self.cog._log(GUILD_ID, "somewhere")
+        self.settle()
+        self.assertEqual(new.sent, ["somewhere"])
+
+        # Guilds joined later get their log channels too.
+        joined = FakeGuild(GUILD_ID + 1)
+        _run(self.channels.on_guild_join(joined))
+        self.cog._log(joined.id, "new guild")
+        self.settle()
+        self.assertEqual(joined.channel(LOG).sent, ["new guild"])
+
+    def test_stopping_finishes_the_flush_under_way(self):
+        log = self.guild.channel(LOG)
+        log.sent = []
+        send = log.send
+
+        async def slow_send(content, **kwargs):
+            await asyncio.sleep(0.02)
+            await send(content, **kwargs)
+        log.send = slow_send
+        for _ in range(30):
+            self.cog._log(GUILD_ID, 'x' * 99)
+
+        async def main():
+            # Stop while the background task is sending what it took off
+            # the queue.
+            await asyncio.sleep(0.01)
+            await self.cog._log_sink.stop()
+        _run(main())
+        self.assertEqual(sum(m.count('x' * 99) for m in log.sent), 30)
+
+
+# Returns a reaction event (really a SimpleNamespace) like discord.py's
+# RawReactionActionEvent.
+def payload(member, reaction, message_id=FLAIR_MESSAGE_ID):
+    return SimpleNamespace(
+        message_id=message_id,
+        guild_id=member.guild.id,
+        channel_id=member.guild.channels[0].id,
+        user_id=member.id,
+        member=member,
+        emoji=discord.PartialEmoji.from_str(reaction))
+
+
+if __name__ == '__main__':
+    unittest.main()
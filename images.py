@@ -0,0 +1,185 @@
+"""
+Shrinks images before they're saved, so summons upload less.
+
+Images wider or taller than the maximum are scaled down, and everything is
+recompressed without its metadata (EXIF, comments and the like), in the format
+its filename says it is, so discord still previews it. Whichever of the
+original and the new image is smaller is kept. Animated images (GIFs, and
+animated WebPs and PNGs) are left alone, since only their first frame
+would be kept.
+
+Needs Pillow, which is in the Pipfile. Without it, images are saved as
+uploaded.
+"""
+import asyncio
+import io
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import NamedTuple, Optional, Tuple
+
+import discord
+
+import metrics
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+# Images are scaled down to fit in a square this many pixels wide. Discord
+# never previews them any larger than this anyway.
+MAX_IMAGE_DIMENSION = 1600
+# If an image still takes more than this many bytes, it's scaled down further
+# (by SHRINK_FACTOR at a time, at most MAX_SHRINKS times) until it doesn't.
+MAX_IMAGE_BYTES = 2 * 1024 * 1024
+SHRINK_FACTOR = 0.75
+MAX_SHRINKS = 4
+JPEG_QUALITY = 85
+# Images are shrunk in this many worker processes. Pillow holds the GIL for
+# long stretches of decoding and encoding, so worker threads still made the
+# event loop late by over a hundred milliseconds (see images_bench.py).
+WORKERS = 2
+# How much less of the CPU workers get than the bot, on systems that can
+# say (see os.nice). Shrinking images can wait; everything else can't.
+WORKER_NICENESS = 10
+
+# The formats we recompress, by filename extension. Anything else (GIFs,
+# which may be animated, included) is left alone.
+_FORMATS = {
+    '.jpg': 'JPEG',
+    '.jpeg': 'JPEG',
+    '.png': 'PNG',
+    '.webp': 'WEBP',
+}
+
+NORMALIZE_SECONDS = metrics.histogram(
+    'newton_image_normalize_seconds', "Time taken to shrink an image, including waiting for a worker.")
+BYTES_SAVED = metrics.counter(
+    'newton_image_bytes_saved_total', "Bytes taken off images by shrinking them before they're saved.")
+
+
+def available() -> bool:
+    return Image is not None
+
+
+class Limits(NamedTuple):
+    max_dimension: int = MAX_IMAGE_DIMENSION
+    max_bytes: int = MAX_IMAGE_BYTES
+    jpeg_quality: int = JPEG_QUALITY
+
+
+def normalize(data: bytes, filename: str, limits: Limits = Limits()) -> bytes:
+    """
+    Returns the image, scaled down to fit the limits, recompressed and without
+    metadata. Returns it unchanged if it isn't smaller that way, or isn't an
+    image we can recompress (like an animated one).
+
+    Blocks, so don't call it from the event loop.
+    """
+    fmt = _format(filename)
+    if Image is None or fmt is None:
+        return data
+    try:
+        with Image.open(io.BytesIO(data)) as original:
+            # Saving would only keep the first frame.
+            if getattr(original, 'is_animated', False):
+                return data
+            original.load()
+            # Stripping the metadata drops the EXIF orientation too, so it's
+            # applied to the pixels first.
+            image = ImageOps.exif_transpose(original)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return data
+    if fmt == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    dimension = limits.max_dimension
+    out = data
+    for _ in range(MAX_SHRINKS + 1):
+        if max(image.size) > dimension:
+            image.thumbnail((dimension, dimension), Image.LANCZOS)
+        out = _encode(image, fmt, limits)
+        if len(out) <= limits.max_bytes:
+            break
+        dimension = int(max(image.size) * SHRINK_FACTOR)
+    return out if len(out) < len(data) else data
+
+
+def _format(filename) -> Optional[str]:
+    return _FORMATS.get(os.path.splitext(filename)[1].lower())
+
+
+def _start_worker():
+    if hasattr(os, 'nice'):
+        os.nice(WORKER_NICENESS)
+
+
+def _normalize_in_worker(data: bytes, filename: str, limits: Limits) -> Optional[bytes]:
+    """Like normalize(), but returns None if the image is unchanged, so it isn't sent back."""
+    out = normalize(data, filename, limits)
+    return None if out is data else out
+
+
+def _encode(image, fmt, limits: Limits) -> bytes:
+    buf = io.BytesIO()
+    # Nothing is carried over from the original unless it's passed in here,
+    # so this is what strips the metadata.
+    if fmt == 'JPEG':
+        image.save(buf, fmt, quality=limits.jpeg_quality, optimize=True, progressive=True)
+    elif fmt == 'WEBP':
+        image.save(buf, fmt, quality=limits.jpeg_quality, method=4)
+    else:
+        image.save(buf, fmt, optimize=True)
+    return buf.getvalue()
+
+
+class ImageNormalizer:
+    """Runs normalize() on a pool of worker processes, so images never block the event loop."""
+
+    def __init__(self, limits: Limits = Limits(), workers=WORKERS):
+        self._limits = limits
+        self._workers = workers
+        self._pool = self._new_pool()
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # Forking would copy the event loop's threads' locks in whatever
+        # state they're in, so workers start afresh.
+        return ProcessPoolExecutor(self._workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_start_worker)
+
+    async def normalize(self, image: discord.File) -> Tuple[discord.File, Optional[int]]:
+        """
+        Returns the image to save in place of the given one, and the original
+        image's size in bytes if it was changed (None otherwise).
+        """
+        data = image.fp.read()
+        # Not worth sending to a worker if it would come straight back.
+        if not available() or _format(image.filename) is None:
+            return discord.File(io.BytesIO(data), filename=image.filename), None
+
+        start = time.perf_counter()
+        pool = self._pool
+        try:
+            out = await asyncio.get_running_loop().run_in_executor(
+                pool, _normalize_in_worker, data, image.filename, self._limits)
+        except BrokenProcessPool as e:
+            # A worker died (say, out of memory on an enormous image). The
+            # image is saved as uploaded, and later ones get new workers.
+            print(f"Failed to shrink image {image.filename}, so saving it as uploaded: {e}")
+            if self._pool is pool:
+                self._pool = self._new_pool()
+                pool.shutdown(wait=False)
+            out = None
+        finally:
+            NORMALIZE_SECONDS.labels().observe(time.perf_counter() - start)
+        if out is None:
+            return discord.File(io.BytesIO(data), filename=image.filename), None
+        BYTES_SAVED.labels().inc(len(data) - len(out))
+        return discord.File(io.BytesIO(out), filename=image.filename), len(data)
+
+    def close(self):
+        self._pool.shutdown()
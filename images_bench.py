@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Benchmarks images.py over a corpus of images.
+
+Run with: python3 images_bench.py [corpus directory] [options]
+
+Without a corpus, a synthetic one is generated: photo-like and flat images of
+a few sizes, as JPEG, PNG and WEBP. Prints how long each image took to shrink
+and how much smaller it got, then how late the event loop ran while the
+whole corpus was shrunk at once through ImageNormalizer.
+"""
+import argparse
+import asyncio
+import io
+import os
+import random
+import time
+from typing import List, Tuple
+
+import discord
+
+import images
+from storage_bench import _loop_lag, _summarize
+
+# (width, height) of the synthetic images.
+SYNTHETIC_SIZES = [(320, 240), (1280, 960), (3000, 2000), (4032, 3024)]
+SYNTHETIC_FORMATS = [('JPEG', '.jpg'), ('PNG', '.png'), ('WEBP', '.webp')]
+
+
+def synthetic_corpus(seed) -> List[Tuple[str, bytes]]:
+    from PIL import Image, ImageDraw
+    rng = random.Random(seed)
+    corpus = []
+    for width, height in SYNTHETIC_SIZES:
+        # Photos are mostly smooth, with some noise. Screenshots and memes
+        # are mostly flat colour.
+        photo = Image.merge('RGB', [Image.effect_noise((width, height), rng.randint(10, 40))
+                                    for _ in range(3)])
+        flat = Image.new('RGB', (width, height), 'white')
+        draw = ImageDraw.Draw(flat)
+        for _ in range(50):
+            x, y = rng.randrange(width), rng.randrange(height)
+            draw.rectangle((x, y, x + width // 8, y + height // 8),
+                           fill=tuple(rng.randrange(256) for _ in range(3)))
+        for kind, img in (('photo', photo), ('flat', flat)):
+            for fmt, ext in SYNTHETIC_FORMATS:
+                buf = io.BytesIO()
+                img.save(buf, fmt, **({'quality': 95} if fmt != 'PNG' else {}))
+                corpus.append((f"{kind}-{width}x{height}{ext}", buf.getvalue()))
+    return corpus
+
+
+def load_corpus(path) -> List[Tuple[str, bytes]]:
+    corpus = []
+    for name in sorted(os.listdir(path)):
+        full = os.path.join(path, name)
+        if os.path.isfile(full):
+            with open(full, 'rb') as f:
+                corpus.append((name, f.read()))
+    return corpus
+
+
+async def _normalize_all(normalizer, corpus) -> float:
+    """Shrinks the whole corpus at once, returning the worst event loop lag meanwhile."""
+    lags = []
+    stop = asyncio.Event()
+    lag_task = asyncio.ensure_future(_loop_lag(stop, lags))
+    await asyncio.gather(*(normalizer.normalize(discord.File(io.BytesIO(data), filename=name))
+                           for name, data in corpus))
+    stop.set()
+    await lag_task
+    return max(lags, default=0.0)
+
+
+def _main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus', nargs='?',
+                        help="A directory of images. Defaults to a synthetic corpus.")
+    parser.add_argument('--max-dimension', type=int, default=images.MAX_IMAGE_DIMENSION)
+    parser.add_argument('--max-bytes', type=int, default=images.MAX_IMAGE_BYTES)
+    parser.add_argument('--quality', type=int, default=images.JPEG_QUALITY)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if not images.available():
+        parser.exit(1, "Pillow isn't installed, so there's nothing to benchmark.\n")
+
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus(args.seed)
+    limits = images.Limits(args.max_dimension, args.max_bytes, args.quality)
+
+    before_total = after_total = 0
+    seconds = []
+    for name, data in corpus:
+        start = time.perf_counter()
+        out = images.normalize(data, name, limits)
+        seconds.append(time.perf_counter() - start)
+        before_total += len(data)
+        after_total += len(out)
+        print(f"{name:<32} {len(data):>10} -> {len(out):>10} bytes "
+              f"({100 * (1 - len(out) / len(data)):5.1f}% smaller) in {seconds[-1]*1e3:7.1f}ms")
+
+    print()
+    _summarize("normalize", seconds)
+    print(f"Corpus: {before_total} -> {after_total} bytes "
+          f"({100 * (1 - after_total / max(before_total, 1)):.1f}% smaller), "
+          f"which every summon of these images would save.")
+
+    normalizer = images.ImageNormalizer(limits)
+    try:
+        worst = asyncio.run(_normalize_all(normalizer, corpus))
+    finally:
+        normalizer.close()
+    print(f"Worst event loop lag while shrinking the corpus at once: {worst*1e3:.1f}ms")
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import asyncio
+import io
+import os
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import patch
+
+import discord
+
+import images
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def _image(fmt, size, **save_args) -> bytes:
+    # Noisy, so it doesn't compress to nothing.
+    img = Image.effect_noise(size, 64).convert('RGB')
+    buf = io.BytesIO()
+    img.save(buf, fmt, **save_args)
+    return buf.getvalue()
+
+
+@unittest.skipIf(Image is None, "Pillow isn't installed.")
+class TestNormalize(unittest.TestCase):
+    def test_scales_down_large_images(self):
+        data = _image('PNG', (800, 400))
+        out = images.normalize(data, 'big.png', images.Limits(max_dimension=200))
+        with Image.open(io.BytesIO(out)) as img:
+            self.assertEqual(img.format, 'PNG')
+            self.assertEqual(img.size, (200, 100))
+
+    def test_strips_metadata(self):
+        exif = Image.Exif()
+        exif[0x010e] = 'a description'
+        data = _image('JPEG', (300, 300), quality=100, exif=exif.tobytes())
+        out = images.normalize(data, 'photo.JPG')
+        self.assertLess(len(out), len(data))
+        with Image.open(io.BytesIO(out)) as img:
+            self.assertEqual(img.format, 'JPEG')
+            self.assertEqual(len(img.getexif()), 0)
+
+    def test_shrinks_to_max_bytes(self):
+        data = _image('PNG', (600, 600))
+        out = images.normalize(data, 'noise.png', images.Limits(max_bytes=len(data) // 4))
+        self.assertLessEqual(len(out), len(data) // 4)
+
+    def test_leaves_other_files_alone(self):
+        data = _image('GIF', (800, 800))
+        self.assertIs(images.normalize(data, 'animated.gif', images.Limits(max_dimension=10)), data)
+        self.assertIs(images.normalize(b'not an image', 'fake.png'), b'not an image')
+
+    def test_leaves_animations_alone(self):
+        frames = [Image.effect_noise((400, 400), 64).convert('RGB') for _ in range(3)]
+        for fmt, filename in (('WEBP', 'animated.webp'), ('PNG', 'animated.png')):
+            buf = io.BytesIO()
+            frames[0].save(buf, fmt, save_all=True, append_images=frames[1:])
+            data = buf.getvalue()
+            self.assertIs(images.normalize(data, filename, images.Limits(max_dimension=10)), data)
+
+
+class TestImageNormalizer(unittest.TestCase):
+    def setUp(self):
+        self.normalizer = images.ImageNormalizer()
+
+    def tearDown(self):
+        self.normalizer.close()
+
+    def test_without_pillow_saves_as_uploaded(self):
+        with patch('images.Image', None):
+            image, original_size = _run(self.normalizer.normalize(
+                discord.File(io.BytesIO(b'533190190'), filename='image.png')))
+        self.assertIsNone(original_size)
+        self.assertEqual(image.filename, 'image.png')
+        self.assertEqual(image.fp.read(), b'533190190')
+
+    @unittest.skipIf(Image is None, "Pillow isn't installed.")
+    def test_reports_original_size(self):
+        data = _image('PNG', (800, 800))
+        image, original_size = _run(self.normalizer.normalize(
+            discord.File(io.BytesIO(data), filename='big.png')))
+        self.assertEqual(original_size, len(data))
+        self.assertEqual(image.filename, 'big.png')
+        self.assertLess(len(image.fp.read()), len(data))
+
+    @unittest.skipIf(Image is None, "Pillow isn't installed.")
+    def test_survives_workers_dying(self):
+        # Like a worker running out of memory.
+        with self.assertRaises(BrokenProcessPool):
+            self.normalizer._pool.submit(os._exit, 1).result()
+        data = _image('PNG', (800, 800))
+        image, original_size = _run(self.normalizer.normalize(
+            discord.File(io.BytesIO(data), filename='big.png')))
+        self.assertIsNone(original_size)
+        self.assertEqual(image.fp.read(), data)
+
+        # Later images get new workers.
+        image, original_size = _run(self.normalizer.normalize(
+            discord.File(io.BytesIO(data), filename='big.png')))
+        self.assertEqual(original_size, len(data))
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+if __name__ == '__main__':
+    unittest.main()
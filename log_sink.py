@@ -0,0 +1,101 @@
+import asyncio
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional
+
+import discord
+
+import metrics
+from messages import MESSAGE_SIZE_LIMIT, paginate
+
+# How often queued log lines are sent to their log channels.
+LOG_FLUSH_INTERVAL_SECONDS = 5.0
+
+# How many lines may be waiting to be sent to a single guild's log channel.
+# Past this, new lines only go to stdout.
+MAX_QUEUED_LOG_LINES = 1000
+
+
+class LogSink:
+    """
+    Sends log lines to each guild's log channel, in the background.
+
+    Every line is printed to stdout right away. Lines for a guild with a log
+    channel are also queued, then packed into as few messages as possible and
+    sent every LOG_FLUSH_INTERVAL_SECONDS, or as soon as a full message's
+    worth is waiting. Callers never wait on discord, so logging can't slow
+    down whatever is being logged.
+    """
+
+    def __init__(self, channel_for_guild: Callable[[int], Optional[discord.abc.Messageable]],
+                 interval=LOG_FLUSH_INTERVAL_SECONDS, max_queued=MAX_QUEUED_LOG_LINES):
+        self._channel_for_guild = channel_for_guild
+        self._interval = interval
+        self._max_queued = max_queued
+        self._queues: Dict[int, Deque[str]] = {}
+        self._queued_chars: Dict[int, int] = {}
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+        # Lines that only made it to stdout because too many were queued.
+        self.dropped = 0
+
+    def log(self, guild_id, line: str):
+        print(line)
+        if self._channel_for_guild(guild_id) is None:
+            return
+
+        queue = self._queues.setdefault(guild_id, deque())
+        if len(queue) >= self._max_queued:
+            self.dropped += 1
+            return
+        # A single line that doesn't fit in a message would never be sent.
+        line = line[:MESSAGE_SIZE_LIMIT]
+        queue.append(line)
+        self._queued_chars[guild_id] = self._queued_chars.get(guild_id, 0) + len(line) + 1
+        if self._queued_chars[guild_id] > MESSAGE_SIZE_LIMIT:
+            self._full.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        """Stops the background task, after sending anything still queued."""
+        if self._task is not None:
+            # Cancelling it could lose the lines of a flush that's under way,
+            # so it's woken up to flush once more and finish instead.
+            self._stopping = True
+            self._full.set()
+            await self._task
+            self._task = None
+            self._stopping = False
+        await self.flush()
+
+    async def flush(self):
+        """Sends everything that is currently queued."""
+        for guild_id in list(self._queues):
+            messages = self._pack(guild_id)
+            channel = self._channel_for_guild(guild_id)
+            if channel is None:
+                continue
+            for m in messages:
+                try:
+                    await metrics.discord_request('send', channel.send(m))
+                except Exception as e:
+                    print(f"Failed to send to the log channel of guild {guild_id}: {e}")
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._full.wait(), self._interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            await self.flush()
+
+    def _pack(self, guild_id) -> List[str]:
+        """Removes the guild's queued lines, and joins them into messages that are each under the size limit."""
+        queue = self._queues.pop(guild_id)
+        self._queued_chars.pop(guild_id, None)
+        return paginate(list(queue))
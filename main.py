@@ -1,20 +1,40 @@
 #!/usr/bin/env python3
 import os
 import sys
+from typing import NamedTuple, Optional
 
 from discord.ext import commands
 
-from storage import CmdStore, FlairStore
+from channels import ChannelIndex
+from ratelimit import SummonLimiter
+import storage
+from storage import FlairStore, GuildCmdStores, migrate_to_partitions
 import flairs
 import cmd_setter
+import images
+import metrics
+from warmup import Warmup
 
 TOKEN_ENV_VAR = 'DISCORD_BOT_TOKEN'
 ADMIN_CHANNEL_ENV_VAR = 'DISCORD_ADMIN_CHANNEL'
 LOG_CHANNEL_ENV_VAR = 'DISCORD_LOG_CHANNEL'
+# If set, metrics are served for Prometheus on this port, on localhost only.
+METRICS_PORT_ENV_VAR = 'NEWTON_METRICS_PORT'
+# Saved images are shrunk to fit in a square this many pixels wide, if Pillow
+# is installed. Defaults to images.MAX_IMAGE_DIMENSION.
+MAX_IMAGE_DIMENSION_ENV_VAR = 'NEWTON_MAX_IMAGE_DIMENSION'
 
 # Keeping the DBs separate makes it less likely that a bug causes me to nuke both tables.
-COMMAND_DB_NAME = 'newton_storage.db'
 FLAIR_DB_NAME = 'newton_storage_flairs.db'
+# Each guild's commands get their own DB in here, with the commands every
+# guild can use in global.db.
+COMMAND_DATA_DIR = 'newton_commands'
+# Where all the commands used to be, before they were split up by guild. If
+# it's still around, it's moved into COMMAND_DATA_DIR as global.db.
+COMMAND_DB_NAME = 'newton_storage.db'
+# Which storage engine keeps the commands and flairs (see storage.ENGINES).
+# Defaults to sqlite. Only sqlite databases are moved or sharded.
+STORAGE_ENGINE_ENV_VAR = 'NEWTON_STORAGE_ENGINE'
 
 # The channel where admin commands (!save, !delete, etc) can be run.
 DEFAULT_ADMIN_CHANNEL = 'newtons-study'
@@ -23,20 +43,62 @@ DEFAULT_ADMIN_CHANNEL = 'newtons-study'
 DEFAULT_LOG_CHANNEL = 'newtons-reactions-log'
 
 
-class Bot(commands.Bot):
-    def __init__(self, cmd_store, flair_store, admin_channel_name, log_channel_name):
-        super().__init__(command_prefix=cmd_setter.PREFIX)
+class _Newton:
+    """The cogs and setup shared by Bot and ShardedBot."""
+
+    def __init__(self, cmd_store, flair_store, admin_channel_name, log_channel_name, metrics_port=None,
+                 image_limits: Optional[images.Limits] = None, **kwargs):
+        super().__init__(command_prefix=cmd_setter.PREFIX, **kwargs)
+        self._metrics_port = metrics_port
+        self._metrics_server = None
+        limiter = SummonLimiter(per_user=cmd_setter.SUMMON_USER_LIMIT,
+                                per_channel=cmd_setter.SUMMON_CHANNEL_LIMIT,
+                                per_trigger=cmd_setter.SUMMON_TRIGGER_LIMIT,
+                                dedup_window=cmd_setter.SUMMON_DEDUP_WINDOW_SECONDS)
+        suggestion_limiter = SummonLimiter(per_user=cmd_setter.SUGGESTION_USER_LIMIT,
+                                           per_channel=cmd_setter.SUGGESTION_CHANNEL_LIMIT,
+                                           dedup_window=cmd_setter.SUMMON_DEDUP_WINDOW_SECONDS)
+        normalizer = images.ImageNormalizer(image_limits) if image_limits is not None else None
+        # The cogs add what they need loaded to this, and hold events back
+        # until it's done.
+        self._warmup = Warmup()
+        channels = ChannelIndex(admin_channel_name, log_channel_name, self._warmup)
+        self.add_cog(channels)
         # TODO because the bot isn't connected yet, self.user is still none. Fix.
         self.add_cog(cmd_setter.CommandSetter(
-            self.user, cmd_store, admin_channel_name))
-        self.add_cog(flairs.Flairs(flair_store, self,
-                                   admin_channel_name, log_channel_name))
+            self.user, cmd_store, channels, limiter, normalizer, self._warmup, suggestion_limiter))
+        self.add_cog(flairs.Flairs(flair_store, self, channels, warmup=self._warmup))
 
     async def on_ready(self):
         print(f"Logged in as {self.user}")
+        # on_ready runs again after every reconnect.
+        if self._metrics_port is not None and self._metrics_server is None:
+            self._metrics_server = await metrics.serve(self._metrics_port)
+            print(f"Serving metrics at http://{metrics.DEFAULT_HOST}:{self._metrics_port}{metrics.METRICS_PATH}")
+        await self._warmup.run(self.guilds)
+        print(self._warmup.summary())
 
 
-def _main():
+class Bot(_Newton, commands.Bot):
+    pass
+
+
+class ShardedBot(_Newton, commands.AutoShardedBot):
+    """Runs some of the bot's shards, alongside other processes running the rest. See shards.py."""
+    pass
+
+
+class Settings(NamedTuple):
+    admin_channel: str
+    log_channel: str
+    metrics_port: Optional[int]
+    # None if saved images are left as uploaded.
+    image_limits: Optional[images.Limits]
+    engine: str
+    token: str
+
+
+def settings_from_env() -> Settings:
     # Set admin channel, or notify what the default is.
     admin_channel = DEFAULT_ADMIN_CHANNEL
     if ADMIN_CHANNEL_ENV_VAR not in os.environ:
@@ -55,20 +117,49 @@ def _main():
     else:
         log_channel = os.environ[LOG_CHANNEL_ENV_VAR]
 
-    # Create bot instance.
-    cmd_db = CmdStore(COMMAND_DB_NAME)
-    flair_db = FlairStore(FLAIR_DB_NAME)
-    newton = Bot(cmd_db, flair_db, admin_channel, log_channel)
+    metrics_port = None
+    if METRICS_PORT_ENV_VAR in os.environ:
+        metrics_port = int(os.environ[METRICS_PORT_ENV_VAR])
+
+    image_limits = None
+    if images.available():
+        image_limits = images.Limits(
+            max_dimension=int(os.environ.get(MAX_IMAGE_DIMENSION_ENV_VAR, images.MAX_IMAGE_DIMENSION)))
+        print(f"Shrinking saved images to at most {image_limits.max_dimension} pixels across. "
+              f"To change it, run again with the prefix '{MAX_IMAGE_DIMENSION_ENV_VAR}=<pixels>'")
+    else:
+        print("Pillow isn't installed, so images will be saved as they were uploaded.")
+
+    engine = os.environ.get(STORAGE_ENGINE_ENV_VAR, storage.SQLITE_ENGINE)
+    if engine not in storage.ENGINES:
+        sys.exit(f"Unknown storage engine '{engine}'. {STORAGE_ENGINE_ENV_VAR} must be one of {', '.join(storage.ENGINES)}.")
+    if engine == storage.DBM_ENGINE and not storage.dbm_available():
+        sys.exit(f"The {engine} storage engine needs Python built with gdbm or ndbm. Pick another {STORAGE_ENGINE_ENV_VAR}.")
+    if engine != storage.SQLITE_ENGINE:
+        print(f"Using the {engine} storage engine.")
 
     # Check for auth token.
     if TOKEN_ENV_VAR not in os.environ:
         sys.exit("{0} not found in system environment. Try running again with the prefix '{0}=<insert discord bot token here>'".format(
             TOKEN_ENV_VAR))
     auth = os.environ[TOKEN_ENV_VAR]
+    return Settings(admin_channel, log_channel, metrics_port, image_limits, engine, auth)
+
+
+def _main():
+    settings = settings_from_env()
+
+    # Create bot instance.
+    if settings.engine == storage.SQLITE_ENGINE and migrate_to_partitions(COMMAND_DB_NAME, COMMAND_DATA_DIR):
+        print(f"Moved {COMMAND_DB_NAME} into {COMMAND_DATA_DIR}, as the global commands.")
+    cmd_db = GuildCmdStores(COMMAND_DATA_DIR, engine=settings.engine)
+    flair_db = FlairStore(FLAIR_DB_NAME, engine=settings.engine)
+    newton = Bot(cmd_db, flair_db, settings.admin_channel, settings.log_channel, settings.metrics_port,
+                 settings.image_limits)
 
     # Log in and begin reading and responding to messages.
     # Nothing else will run below this line.
-    newton.run(auth)
+    newton.run(settings.token)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,30 @@
+"""Helpers for keeping what the bot sends within what discord accepts."""
+from typing import List
+
+# The maximum number of characters that a message can be before discord rejects
+# the request.
+#
+# Most of the time we don't even check this, and just raise an exception (which
+# is then ignored) if discord rejects the message for being too long. This is
+# here for the special cases when we actually give a shit and want to make sure
+# the message is actually sent.
+MESSAGE_SIZE_LIMIT = 2000
+
+
+def paginate(lines: List[str], limit: int = MESSAGE_SIZE_LIMIT) -> List[str]:
+    """Joins lines into as few messages of at most limit characters as possible."""
+    pages = []
+    line_queue = []
+    total_chars = 0
+    for line in lines:
+        length = len(line)
+
+        # If this line would exceed the size limit, start a new page.
+        if total_chars + length > limit:
+            pages.append('\n'.join(line_queue))
+            line_queue = []
+            total_chars = 0
+        line_queue.append(line)
+        total_chars += length+1  # +1 is for the \n
+    pages.append('\n'.join(line_queue))
+    return pages
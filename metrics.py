@@ -0,0 +1,255 @@
+"""
+Counters and latency histograms for the bot, cheap enough to leave on.
+
+Metrics are declared once, at import time, as families with label names:
+
+    SAVES = metrics.counter('newton_saves_total', "Commands saved.", ['kind'])
+    SAVES.labels(kind='random').inc()
+
+Looking up a family's labels is a dict lookup, so hot paths should look up
+their labels once and keep the result around. Everything here is meant to be
+used from the event loop's thread only.
+
+The lot can be read in the Prometheus text format, either from render() or
+over HTTP from serve(), or as a short human readable summary for !stats.
+"""
+import asyncio
+import functools
+import time
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Upper bounds of the histogram buckets, in seconds. Everything we time takes
+# somewhere between a few microseconds (skipping a message) and a few seconds
+# (a rate limited discord request).
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# Where the metrics are served from, when they are served at all.
+DEFAULT_HOST = '127.0.0.1'
+METRICS_PATH = '/metrics'
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    __slots__ = ('_bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Sequence[float]):
+        self._bounds = bounds
+        # One more bucket than bounds, for everything over the last bound.
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self._bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> '_Timer':
+        """Returns a context manager that observes how long its body takes."""
+        return _Timer(self)
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates the given quantile, by interpolating within the bucket it
+        falls in. Returns 0 if nothing has been observed.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if c > 0 and seen + c >= rank:
+                lower = self._bounds[i - 1] if i > 0 else 0.0
+                if i == len(self._bounds):
+                    # No upper bound to interpolate towards.
+                    return lower
+                return lower + (self._bounds[i] - lower) * (rank - seen) / c
+            seen += c
+        return self._bounds[-1]
+
+
+class _Timer:
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram: Histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+
+class Family:
+    """A metric name, and one counter or histogram per combination of labels."""
+
+    def __init__(self, name, help_text, kind, label_names, new_child):
+        self.name = name
+        self.help = help_text
+        self.kind = kind
+        self.label_names = tuple(label_names)
+        self._new_child = new_child
+        self.children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, **labels):
+        key = tuple(str(labels[n]) for n in self.label_names)
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = self._new_child()
+        return child
+
+
+class Registry:
+    def __init__(self):
+        self._families: Dict[str, Family] = {}
+
+    def counter(self, name, help_text, label_names=()) -> Family:
+        return self._register(Family(name, help_text, 'counter', label_names, Counter))
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS) -> Family:
+        return self._register(Family(name, help_text, 'histogram', label_names,
+                                     lambda: Histogram(buckets)))
+
+    def _register(self, family: Family) -> Family:
+        if family.name in self._families:
+            raise ValueError(f"Metric {family.name} already exists.")
+        self._families[family.name] = family
+        return family
+
+    def render(self) -> str:
+        """Returns every metric, in the Prometheus text exposition format."""
+        lines = []
+        for f in self._families.values():
+            lines.append(f"# HELP {f.name} {f.help}")
+            lines.append(f"# TYPE {f.name} {f.kind}")
+            for key, child in sorted(f.children.items()):
+                labels = list(zip(f.label_names, key))
+                if f.kind == 'counter':
+                    lines.append(f"{f.name}{_labels(labels)} {child.value}")
+                    continue
+                cumulative = 0
+                for bound, c in zip(child._bounds, child.counts):
+                    cumulative += c
+                    lines.append(f"{f.name}_bucket{_labels(labels + [('le', repr(bound))])} {cumulative}")
+                lines.append(f"{f.name}_bucket{_labels(labels + [('le', '+Inf')])} {child.count}")
+                lines.append(f"{f.name}_sum{_labels(labels)} {child.sum!r}")
+                lines.append(f"{f.name}_count{_labels(labels)} {child.count}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> List[str]:
+        """
+        Returns a line per counter and histogram that has been used, with
+        latencies in milliseconds.
+        """
+        lines = []
+        for f in self._families.values():
+            for key, child in sorted(f.children.items()):
+                name = f.name + _labels(zip(f.label_names, key))
+                if f.kind == 'counter':
+                    lines.append(f"{name} {child.value}")
+                elif child.count > 0:
+                    lines.append(f"{name} n={child.count} "
+                                 f"p50={child.quantile(0.5)*1e3:.2f}ms "
+                                 f"p99={child.quantile(0.99)*1e3:.2f}ms")
+        return lines
+
+
+def _labels(labels) -> str:
+    labels = [f'{n}="{_escape(v)}"' for n, v in labels]
+    if not labels:
+        return ''
+    return '{' + ','.join(labels) + '}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# The registry everything in the bot reports to.
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+
+# Shared by everything that talks to discord.
+DISCORD_REQUEST_SECONDS = histogram(
+    'newton_discord_request_seconds', "Time taken by requests to discord.", ['call'])
+DISCORD_REQUEST_ERRORS = counter(
+    'newton_discord_request_errors_total', "Requests to discord that raised.", ['call'])
+
+
+def timed(family: Family, **labels):
+    """Decorates an async function, so every call is observed in family."""
+    def decorator(fn):
+        h = family.labels(**labels)
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                h.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+async def discord_request(call: str, awaitable):
+    """Awaits a request to discord, recording how long it took and whether it failed."""
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    except Exception:
+        DISCORD_REQUEST_ERRORS.labels(call=call).inc()
+        raise
+    finally:
+        DISCORD_REQUEST_SECONDS.labels(call=call).observe(time.perf_counter() - start)
+
+
+async def serve(port: int, host=DEFAULT_HOST, registry: Optional[Registry] = None) -> asyncio.AbstractServer:
+    """
+    Serves the registry's metrics over HTTP at METRICS_PATH, for Prometheus to
+    scrape. Returns the (already serving) server.
+    """
+    registry = registry if registry is not None else REGISTRY
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readline()
+            # Skip the headers. We don't need anything from them.
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == METRICS_PATH:
+                status = '200 OK'
+                body = registry.render().encode()
+            else:
+                status = '404 Not Found'
+                body = f"Metrics are at {METRICS_PATH}\n".encode()
+            writer.write(f"HTTP/1.1 {status}\r\n"
+                         "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\n"
+                         "Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import asyncio
+import unittest
+
+import metrics
+
+
+class TestHistogram(unittest.TestCase):
+    def test_buckets(self):
+        h = metrics.Histogram([1, 2, 4])
+        for v in [0.5, 1, 1.5, 3, 100]:
+            h.observe(v)
+        # Bounds are inclusive, and anything past the last one has a bucket too.
+        self.assertEqual(h.counts, [2, 1, 1, 1])
+        self.assertEqual(h.count, 5)
+        self.assertEqual(h.sum, 106)
+
+    def test_quantile(self):
+        h = metrics.Histogram([0.001, 0.01, 0.1])
+        self.assertEqual(h.quantile(0.5), 0)
+        for _ in range(90):
+            h.observe(0.0005)
+        for _ in range(10):
+            h.observe(0.05)
+        self.assertLessEqual(h.quantile(0.5), 0.001)
+        self.assertGreater(h.quantile(0.99), 0.01)
+        self.assertLessEqual(h.quantile(0.99), 0.1)
+
+    def test_time(self):
+        h = metrics.Histogram(metrics.DEFAULT_BUCKETS)
+        with h.time():
+            pass
+        self.assertEqual(h.count, 1)
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_render(self):
+        c = self.registry.counter('test_total', "A counter.", ['kind'])
+        c.labels(kind='a').inc()
+        c.labels(kind='a').inc(2)
+        c.labels(kind='say "hi"').inc()
+        h = self.registry.histogram('test_seconds', "A histogram.", buckets=(0.1, 1))
+        h.labels().observe(0.5)
+
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# HELP test_total A counter.',
+            '# TYPE test_total counter',
+            'test_total{kind="a"} 3',
+            'test_total{kind="say \\"hi\\""} 1',
+            '# HELP test_seconds A histogram.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="0.1"} 0',
+            'test_seconds_bucket{le="1"} 1',
+            'test_seconds_bucket{le="+Inf"} 1',
+            'test_seconds_sum 0.5',
+            'test_seconds_count 1',
+        ]) + '\n')
+
+    def test_rejects_duplicates(self):
+        self.registry.counter('test_total', "A counter.")
+        with self.assertRaises(ValueError):
+            self.registry.histogram('test_total', "Not a counter.")
+
+    def test_summary_skips_unused_histograms(self):
+        h = self.registry.histogram('test_seconds', "A histogram.", ['call'])
+        h.labels(call='unused')
+        h.labels(call='used').observe(0.002)
+        self.assertEqual(len(self.registry.summary()), 1)
+        self.assertIn('test_seconds{call="used"} n=1', self.registry.summary()[0])
+
+
+class TestInstrumentation(unittest.TestCase):
+    def test_timed(self):
+        family = metrics.Registry().histogram('test_seconds', "A histogram.", ['fn'])
+
+        @metrics.timed(family, fn='fails')
+        async def fails():
+            raise RuntimeError()
+
+        with self.assertRaises(RuntimeError):
+            _run(fails())
+        self.assertEqual(family.labels(fn='fails').count, 1)
+
+    def test_discord_request_counts_errors(self):
+        async def fails():
+            raise RuntimeError()
+
+        errors = metrics.DISCORD_REQUEST_ERRORS.labels(call='test')
+        seconds = metrics.DISCORD_REQUEST_SECONDS.labels(call='test')
+        with self.assertRaises(RuntimeError):
+            _run(metrics.discord_request('test', fails()))
+        self.assertEqual(errors.value, 1)
+        self.assertEqual(seconds.count, 1)
+
+
+class TestServe(unittest.TestCase):
+    def get(self, path):
+        registry = metrics.Registry()
+        registry.counter('test_total', "A counter.").labels().inc()
+
+        async def get():
+            server = await metrics.serve(0, registry=registry)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection(metrics.DEFAULT_HOST, port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+            response = await reader.read()
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return response.decode()
+        return _run(get())
+
+    def test_serves_metrics(self):
+        response = self.get(metrics.METRICS_PATH)
+        self.assertTrue(response.startswith('HTTP/1.1 200 OK'))
+        self.assertIn('\r\n\r\n# HELP test_total A counter.', response)
+        self.assertIn('test_total 1', response)
+
+    def test_not_found(self):
+        self.assertTrue(self.get('/').startswith('HTTP/1.1 404'))
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+Token buckets, for limiting how often summons are answered.
+"""
+import time
+from collections import OrderedDict
+from typing import Hashable, NamedTuple, Optional
+
+# How many users, channels or triggers each limiter remembers buckets for.
+# Past this, the longest unused bucket is forgotten. It will have refilled by
+# then, unless we're being flooded from more directions than this.
+MAX_TRACKED_KEYS = 10000
+
+
+class Limit(NamedTuple):
+    # How many tokens are added back every second.
+    per_second: float
+    # The most tokens there can be, and so the most summons in a quick burst.
+    burst: float
+
+
+class TokenBucket:
+    __slots__ = ('_limit', '_tokens', '_updated')
+
+    def __init__(self, limit: Limit, now: float):
+        self._limit = limit
+        self._tokens = limit.burst
+        self._updated = now
+
+    def has_token(self, now: float) -> bool:
+        self._tokens = min(self._limit.burst,
+                           self._tokens + (now - self._updated) * self._limit.per_second)
+        self._updated = now
+        return self._tokens >= 1
+
+    def take(self):
+        """Takes a token. Only call after has_token has returned true."""
+        self._tokens -= 1
+
+
+class RateLimiter:
+    """A token bucket for every key, forgetting the least recently used."""
+
+    def __init__(self, limit: Limit, max_keys=MAX_TRACKED_KEYS):
+        self._limit = limit
+        self._max_keys = max_keys
+        self._buckets: 'OrderedDict[Hashable, TokenBucket]' = OrderedDict()
+
+    def bucket(self, key: Hashable, now: float) -> TokenBucket:
+        b = self._buckets.get(key)
+        if b is None:
+            b = self._buckets[key] = TokenBucket(self._limit, now)
+            if len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return b
+
+
+class SummonLimiter:
+    """
+    Decides whether a summon gets answered.
+
+    A summon of the same trigger in the same channel as one answered less
+    than dedup_window seconds ago is dropped, since the answer is already
+    right there. Otherwise the user, the channel and the trigger each need a
+    token in their bucket, and only if all of them do is one taken from each.
+    Any of the limits can be left out.
+    """
+
+    def __init__(self, per_user: Optional[Limit] = None, per_channel: Optional[Limit] = None,
+                 per_trigger: Optional[Limit] = None, dedup_window=0.0,
+                 clock=time.monotonic, max_keys=MAX_TRACKED_KEYS):
+        self._limiters = []
+        for name, limit in (('user', per_user), ('channel', per_channel), ('trigger', per_trigger)):
+            if limit is not None:
+                self._limiters.append((name, RateLimiter(limit, max_keys)))
+        self._dedup_window = dedup_window
+        self._max_keys = max_keys
+        # When each (channel, trigger) was last answered.
+        self._answered: 'OrderedDict[Hashable, float]' = OrderedDict()
+        self._clock = clock
+
+    def check(self, user_id, channel_id, trigger) -> Optional[str]:
+        """
+        Returns None if the summon should be answered, and counts it against
+        the limits. Otherwise returns why it shouldn't: 'duplicate', 'user',
+        'channel' or 'trigger'.
+        """
+        now = self._clock()
+        answered_key = (channel_id, trigger)
+        if self._dedup_window > 0:
+            answered = self._answered.get(answered_key)
+            if answered is not None and now - answered < self._dedup_window:
+                return 'duplicate'
+
+        keys = {'user': user_id, 'channel': channel_id, 'trigger': trigger}
+        buckets = []
+        for name, limiter in self._limiters:
+            b = limiter.bucket(keys[name], now)
+            if not b.has_token(now):
+                return name
+            buckets.append(b)
+        for b in buckets:
+            b.take()
+
+        if self._dedup_window > 0:
+            self._answered[answered_key] = now
+            self._answered.move_to_end(answered_key)
+            if len(self._answered) > self._max_keys:
+                self._answered.popitem(last=False)
+        return None
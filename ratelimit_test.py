@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import unittest
+
+from ratelimit import Limit, RateLimiter, SummonLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestRateLimiter(unittest.TestCase):
+    def take(self, limiter, key, now):
+        b = limiter.bucket(key, now)
+        if not b.has_token(now):
+            return False
+        b.take()
+        return True
+
+    def test_burst_then_rate(self):
+        limiter = RateLimiter(Limit(per_second=0.5, burst=3))
+        self.assertEqual([self.take(limiter, 'k', 0) for _ in range(4)],
+                         [True, True, True, False])
+        # One token back every 2 seconds.
+        self.assertFalse(self.take(limiter, 'k', 1.9))
+        self.assertTrue(self.take(limiter, 'k', 2))
+        self.assertFalse(self.take(limiter, 'k', 2))
+        # Never more than the burst, however long it's been.
+        self.assertEqual([self.take(limiter, 'k', 1000) for _ in range(4)],
+                         [True, True, True, False])
+
+    def test_keys_are_separate(self):
+        limiter = RateLimiter(Limit(per_second=1, burst=1))
+        self.assertTrue(self.take(limiter, 'a', 0))
+        self.assertFalse(self.take(limiter, 'a', 0))
+        self.assertTrue(self.take(limiter, 'b', 0))
+
+    def test_forgets_least_recently_used(self):
+        limiter = RateLimiter(Limit(per_second=1, burst=1), max_keys=2)
+        self.take(limiter, 'a', 0)
+        self.take(limiter, 'b', 0)
+        limiter.bucket('a', 0)
+        self.take(limiter, 'c', 0)
+        # b was the least recently used, so it's the one that's forgotten.
+        self.assertEqual(set(limiter._buckets), {'a', 'c'})
+
+
+class TestSummonLimiter(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def test_dedup(self):
+        limiter = SummonLimiter(dedup_window=3, clock=self.clock)
+        self.assertIsNone(limiter.check(1, 10, 'hi'))
+        self.assertEqual(limiter.check(2, 10, 'hi'), 'duplicate')
+        # Different channel, or different trigger, are fine.
+        self.assertIsNone(limiter.check(2, 11, 'hi'))
+        self.assertIsNone(limiter.check(2, 10, 'bye'))
+        self.clock.now = 3
+        self.assertIsNone(limiter.check(2, 10, 'hi'))
+
+    def test_reports_which_limit(self):
+        limiter = SummonLimiter(per_user=Limit(1, 1), per_channel=Limit(1, 2),
+                                per_trigger=Limit(1, 3), clock=self.clock)
+        self.assertIsNone(limiter.check(1, 10, 'a'))
+        self.assertEqual(limiter.check(1, 11, 'b'), 'user')
+        self.assertIsNone(limiter.check(2, 10, 'a'))
+        self.assertEqual(limiter.check(3, 10, 'c'), 'channel')
+        self.assertIsNone(limiter.check(3, 11, 'a'))
+        self.assertEqual(limiter.check(4, 12, 'a'), 'trigger')
+
+    def test_only_takes_tokens_when_answered(self):
+        limiter = SummonLimiter(per_user=Limit(1, 1), per_channel=Limit(1, 1), clock=self.clock)
+        self.assertIsNone(limiter.check(1, 10, 'a'))
+        # Rejected by the channel limit, so user 2 keeps their token.
+        self.assertEqual(limiter.check(2, 10, 'a'), 'channel')
+        self.assertIsNone(limiter.check(2, 11, 'a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,365 @@
+"""
+Catches roles up with reactions that were added or taken back while the bot
+was offline, since discord doesn't replay the reaction events it missed.
+
+Reconciler reads who has reacted to every flair message, works out which
+members should have which of the flairs' roles, and makes whatever edits it
+takes to get there. Everything it asks discord for goes through a few
+workers at a time, and at a limited rate, so catching up doesn't get in the
+way of the bot answering everything else meanwhile.
+
+Flairs only record their message's id, so a message nobody has reacted to
+since the bot started has to be looked for in every channel of its roles'
+guilds. That only happens when asked to (see Reconciler.run), as does taking
+roles away, since members may have been given them some other way.
+"""
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import discord
+
+import metrics
+from ratelimit import Limit, TokenBucket
+
+# How many requests reconciling has out with discord at once, at most.
+RECONCILE_CONCURRENCY = 4
+# How often reconciling may ask discord for something (a message, a page of
+# reactions or a member's role edit), across all its workers. Well under
+# discord's own limits, which the rest of the bot shares.
+RECONCILE_REQUESTS = Limit(per_second=5, burst=5)
+# How many users each request for a reaction's users gets. Discord's maximum.
+REACTION_USERS_PAGE_SIZE = 100
+# How many times a request that was rate limited is tried, in all.
+RECONCILE_MAX_ATTEMPTS = 3
+# How long to back off after being rate limited, if discord doesn't say.
+RECONCILE_RETRY_SECONDS = 5.0
+# How often progress is printed while reconciling.
+RECONCILE_PROGRESS_INTERVAL_SECONDS = 10.0
+# How long a flair message that couldn't be found anywhere isn't looked for
+# again, unless a reaction says where it is.
+MISSING_MESSAGE_RETRY_SECONDS = 60 * 60
+
+RECONCILE_SECONDS = metrics.histogram(
+    'newton_reconcile_seconds', "Time taken to catch roles up with reactions.")
+RECONCILE_ROLE_CHANGES = metrics.counter(
+    'newton_reconcile_role_changes_total', "Roles added or removed to catch up with reactions.", ['change'])
+
+# Called with a guild, a member's id, and the roles to add (True) or remove
+# (False) from them, with the reason. Only needs to edit what isn't already so.
+ApplyRoles = Callable[[discord.Guild, int, List[Tuple[discord.Role, bool]], str], Awaitable]
+
+
+def emoji_id(emoji) -> str:
+    """Returns the id flairs are saved with for a reaction's emoji (see Flairs._get_emoji_id)."""
+    if isinstance(emoji, str):
+        return emoji
+    if emoji.id is None:
+        return emoji.name
+    return str(emoji.id)
+
+
+class ReconcileReport:
+    def __init__(self):
+        self.messages = 0
+        # Flair messages that couldn't be found in any channel.
+        self.missing = 0
+        # Flair messages that weren't looked for, since where they are isn't
+        # known yet.
+        self.unsearched = 0
+        # Flair messages skipped because their ids aren't numbers, so can't
+        # be any message's.
+        self.invalid = 0
+        self.reactions = 0
+        self.added = 0
+        self.removed = 0
+        self.members = 0
+        self.failed = 0
+        # Whether roles were taken away from members who hadn't reacted.
+        self.removing = False
+        self.seconds: Optional[float] = None
+
+    def summary(self) -> str:
+        lines = [f"Checked {self.messages} flair messages ({self.reactions} reactions) in {self.seconds:.2f}s. "
+                 f"Added {self.added} roles and removed {self.removed}, across {self.members} members."]
+        if not self.removing:
+            lines.append("Roles weren't taken away from anyone, since that wasn't asked for.")
+        if self.missing > 0:
+            lines.append(f"{self.missing} messages couldn't be found.")
+        if self.unsearched > 0:
+            lines.append(f"{self.unsearched} messages haven't been reacted to since the bot started, "
+                         "so weren't looked for.")
+        if self.invalid > 0:
+            lines.append(f"{self.invalid} messages were skipped, since their ids aren't numbers.")
+        if self.failed > 0:
+            lines.append(f"{self.failed} members' roles couldn't be edited.")
+        return ' '.join(lines)
+
+
+class Reconciler:
+    """
+    A member should have a flair's role if they've reacted to any flair
+    message with any reaction that grants it, and not otherwise. Roles are
+    only taken away when asked to, and only from members discord.py knows
+    have the role (see discord.Role.members), so without the members intent,
+    reconciling only adds roles.
+
+    Only flairs with roles in this process's guilds are reconciled, so each
+    shard process (see shards.py) catches up with its own.
+    """
+
+    def __init__(self, bot, apply: ApplyRoles, concurrency=RECONCILE_CONCURRENCY, limit=RECONCILE_REQUESTS,
+                 page_size=REACTION_USERS_PAGE_SIZE, max_attempts=RECONCILE_MAX_ATTEMPTS, clock=time.monotonic):
+        self._bot = bot
+        self._apply = apply
+        self._concurrency = concurrency
+        self._limit = limit
+        self._page_size = page_size
+        self._max_attempts = max_attempts
+        self._clock = clock
+        self._task: Optional[asyncio.Task] = None
+        # The bucket every request takes a token from, and when to wait
+        # until after being rate limited. Set up anew for each run.
+        self._workers: Optional[asyncio.Semaphore] = None
+        self._bucket: Optional[TokenBucket] = None
+        self._paused_until = 0.0
+
+        # Where each flair message is, as (guild id, channel id), once it's
+        # been found or reacted to, so it only has to be looked for once.
+        self._locations: Dict[int, Tuple[int, int]] = {}
+        # When each flair message that couldn't be found was last looked for.
+        self._missing: Dict[int, float] = {}
+
+        # How many of the flair messages the current (or last) run has
+        # checked, of how many.
+        self.progress: Tuple[int, int] = (0, 0)
+
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def remember(self, message_id, guild_id, channel_id):
+        """Records where a flair message is, for when reaction events say."""
+        self._locations[int(message_id)] = (guild_id, channel_id)
+        self._missing.pop(int(message_id), None)
+
+    async def run(self, roles_by_reaction: Dict[Tuple[str, str], List[str]], sweep=False,
+                  remove=False) -> ReconcileReport:
+        """
+        Reconciles the given flairs (see Flairs._roles_by_reaction). If a run
+        is already going, waits for that one instead.
+
+        Messages that haven't been found or reacted to yet are only looked
+        for if sweep is true, since that takes a request per channel.
+        Otherwise they're skipped, and nobody loses the roles they grant.
+
+        Roles are only taken away from members who haven't reacted if remove
+        is true, since they may have been given them by hand.
+        """
+        if not self.is_running():
+            self._task = asyncio.ensure_future(self._run(dict(roles_by_reaction), sweep, remove))
+        return await asyncio.shield(self._task)
+
+    async def _run(self, roles_by_reaction, sweep, remove) -> ReconcileReport:
+        start = time.perf_counter()
+        report = ReconcileReport()
+        report.removing = remove
+        self._workers = asyncio.Semaphore(self._concurrency)
+        self._bucket = TokenBucket(self._limit, self._clock())
+        self._paused_until = 0.0
+
+        reactions_by_message: Dict[int, Dict[str, List[str]]] = {}
+        invalid: Set[str] = set()
+        for (message_id, reaction_id), role_ids in roles_by_reaction.items():
+            try:
+                reactions_by_message.setdefault(int(message_id), {})[reaction_id] = role_ids
+            except ValueError:
+                invalid.add(message_id)
+        if len(invalid) > 0:
+            report.invalid = len(invalid)
+            print(f"Flair message ids {', '.join(sorted(invalid))} aren't numbers. Skipping them.")
+        # A flair message is in the same guild as its roles. Messages whose
+        # roles are in guilds this process doesn't have are left to the
+        # process that does.
+        guild_of_role = self._guilds_of_roles(
+            {int(r) for role_ids in roles_by_reaction.values() for r in role_ids})
+        guilds_by_message: Dict[int, Set[int]] = {}
+        for message_id, reactions in reactions_by_message.items():
+            guild_ids = {guild_of_role[int(r)] for role_ids in reactions.values() for r in role_ids
+                         if int(r) in guild_of_role}
+            if len(guild_ids) > 0:
+                guilds_by_message[message_id] = guild_ids
+        reactions_by_message = {m: r for m, r in reactions_by_message.items() if m in guilds_by_message}
+        report.messages = len(reactions_by_message)
+        self.progress = (0, report.messages)
+        last_printed = time.perf_counter()
+
+        # Who reacted with something granting each role, by guild.
+        reactors: Dict[Tuple[int, int], Set[int]] = {}
+        # Roles granted by messages that couldn't be found. Nobody loses
+        # them, since they may have reacted there.
+        unknown: Set[int] = set()
+
+        async def check(message_id, reactions):
+            nonlocal last_printed
+            message_guilds = guilds_by_message[message_id]
+            message = await self._fetch_known(message_id, message_guilds)
+            if message is None and sweep:
+                message = await self._sweep(message_id, message_guilds)
+                if message is None:
+                    report.missing += 1
+                    print(f"Flair message {message_id} couldn't be found. Skipping it.")
+            elif message is None:
+                report.unsearched += 1
+            if message is None:
+                unknown.update(int(r) for role_ids in reactions.values() for r in role_ids)
+            else:
+                for reaction in message.reactions:
+                    role_ids = reactions.get(emoji_id(reaction.emoji), [])
+                    if len(role_ids) == 0:
+                        continue
+                    users = await self._reaction_users(reaction)
+                    report.reactions += len(users)
+                    for role_id in role_ids:
+                        reactors.setdefault((message.guild.id, int(role_id)), set()).update(users)
+                for role_ids in reactions.values():
+                    # Roles nobody reacted for should still be taken away.
+                    for role_id in role_ids:
+                        reactors.setdefault((message.guild.id, int(role_id)), set())
+            done, total = self.progress
+            self.progress = (done + 1, total)
+            if time.perf_counter() - last_printed >= RECONCILE_PROGRESS_INTERVAL_SECONDS:
+                last_printed = time.perf_counter()
+                print(f"Reconciling flairs: checked {done + 1} of {total} messages.")
+        await asyncio.gather(*(check(m, r) for m, r in reactions_by_message.items()))
+
+        changes = self._diff(reactors, unknown, remove)
+        report.members = len(changes)
+        for guild, user_id, member_changes in changes:
+            added = sum(1 for _, add in member_changes if add)
+            report.added += added
+            report.removed += len(member_changes) - added
+
+        async def apply(guild, user_id, member_changes):
+            try:
+                await self._request(lambda: self._apply(
+                    guild, user_id, member_changes, "Catching up with reactions made while offline."))
+            except Exception as e:
+                report.failed += 1
+                print(f"Failed to reconcile roles for user {user_id} in guild {guild.id}: {e}")
+        await asyncio.gather(*(apply(*c) for c in changes))
+        RECONCILE_ROLE_CHANGES.labels(change='added').inc(report.added)
+        RECONCILE_ROLE_CHANGES.labels(change='removed').inc(report.removed)
+
+        report.seconds = time.perf_counter() - start
+        RECONCILE_SECONDS.labels().observe(report.seconds)
+        return report
+
+    def _diff(self, reactors: Dict[Tuple[int, int], Set[int]], unknown: Set[int],
+              remove: bool) -> List[Tuple[discord.Guild, int, List[Tuple[discord.Role, bool]]]]:
+        """Returns each member whose roles need changing, and the changes, all at once so they're a single edit."""
+        me = getattr(getattr(self._bot, 'user', None), 'id', None)
+        changes: Dict[Tuple[int, int], List[Tuple[discord.Role, bool]]] = {}
+        guilds = {}
+        for (guild_id, role_id), user_ids in reactors.items():
+            guild = self._bot.get_guild(guild_id)
+            role = guild.get_role(role_id) if guild is not None else None
+            if role is None:
+                continue
+            guilds[guild_id] = guild
+            holders = {m.id for m in role.members}
+            for user_id in user_ids - holders - {me}:
+                changes.setdefault((guild_id, user_id), []).append((role, True))
+            if not remove or role_id in unknown:
+                continue
+            for user_id in holders - user_ids:
+                changes.setdefault((guild_id, user_id), []).append((role, False))
+        return [(guilds[g], u, c) for (g, u), c in changes.items()]
+
+    def _guilds_of_roles(self, role_ids: Set[int]) -> Dict[int, int]:
+        """Returns the id of the guild each role is in, for the roles in this process's guilds."""
+        guild_of_role = {}
+        for guild in self._bot.guilds:
+            for role_id in role_ids - guild_of_role.keys():
+                if guild.get_role(role_id) is not None:
+                    guild_of_role[role_id] = guild.id
+        return guild_of_role
+
+    async def _fetch_known(self, message_id, guild_ids: Set[int]) -> Optional[discord.Message]:
+        """Fetches the flair message from where it was last found or reacted to, if anywhere."""
+        location = self._locations.get(message_id)
+        if location is None or location[0] not in guild_ids:
+            return None
+        guild = self._bot.get_guild(location[0])
+        channel = guild.get_channel(location[1]) if guild is not None else None
+        if channel is None:
+            return None
+        return await self._fetch(channel, message_id)
+
+    async def _sweep(self, message_id, guild_ids: Set[int]) -> Optional[discord.Message]:
+        """
+        Looks for the flair message in every channel of the given guilds,
+        unless it was looked for and not found recently.
+        """
+        last_missed = self._missing.get(message_id)
+        if last_missed is not None and self._clock() - last_missed < MISSING_MESSAGE_RETRY_SECONDS:
+            return None
+        for guild_id in sorted(guild_ids):
+            guild = self._bot.get_guild(guild_id)
+            for channel in guild.text_channels if guild is not None else []:
+                message = await self._fetch(channel, message_id)
+                if message is not None:
+                    self.remember(message_id, guild.id, channel.id)
+                    return message
+        self._missing[message_id] = self._clock()
+        return None
+
+    async def _fetch(self, channel, message_id) -> Optional[discord.Message]:
+        try:
+            return await self._request(
+                lambda: metrics.discord_request('fetch_message', channel.fetch_message(message_id)))
+        except (discord.NotFound, discord.Forbidden):
+            return None
+
+    async def _reaction_users(self, reaction) -> Set[int]:
+        """Returns the ids of everyone who reacted, a page at a time."""
+        users = set()
+        after = None
+        while True:
+            page = await self._request(
+                lambda: metrics.discord_request('reaction_users', _page(reaction, self._page_size, after)))
+            users.update(u.id for u in page)
+            if len(page) < self._page_size:
+                return users
+            after = discord.Object(id=page[-1].id)
+
+    async def _request(self, call: Callable[[], Awaitable]):
+        """
+        Awaits call() once one of the workers is free and the rate limit
+        allows, trying again if discord rate limits it anyway.
+        """
+        async with self._workers:
+            for attempt in range(1, self._max_attempts + 1):
+                await self._wait_for_token()
+                try:
+                    return await call()
+                except discord.HTTPException as e:
+                    if e.status != 429 or attempt == self._max_attempts:
+                        raise
+                    # Every worker backs off, not just this one.
+                    retry_after = getattr(e, 'retry_after', None) or RECONCILE_RETRY_SECONDS
+                    self._paused_until = max(self._paused_until, self._clock() + retry_after)
+
+    async def _wait_for_token(self):
+        while True:
+            now = self._clock()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+            elif self._bucket.has_token(now):
+                self._bucket.take()
+                return
+            else:
+                await asyncio.sleep(1 / self._limit.per_second)
+
+
+async def _page(reaction, limit, after) -> List:
+    return [u async for u in reaction.users(limit=limit, after=after)]
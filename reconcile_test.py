@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+import asyncio
+import os
+import unittest
+from types import SimpleNamespace
+
+import discord
+
+import flairs
+from channels import ChannelIndex
+from flairs_test import ADMIN, FLAIR_MESSAGE_ID, LOG, THUMBS_UP, CUSTOM_EMOJI, FakeBot, FakeGuild, payload
+from ratelimit import Limit
+import reconcile
+from reconcile import Reconciler
+from storage import FlairStore
+
+# Make sure this doesn't coincide with a sqlite db file that's really used.
+TEST_DB = 'test_reconcile_db_please_ignore.db'
+
+# Fast enough not to slow the tests down.
+TEST_LIMIT = Limit(per_second=1000, burst=1000)
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+def rate_limited(retry_after):
+    e = discord.HTTPException(SimpleNamespace(status=429, reason='Too Many Requests'), 'You are being rate limited.')
+    e.retry_after = retry_after
+    return e
+
+
+class ReconcileTest(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(TEST_DB):
+            os.remove(TEST_DB)
+        self.db = FlairStore(TEST_DB)
+        self.guild = FakeGuild()
+        # So the roles know who has them.
+        self.guild.gateway_cache = True
+        self.bot = FakeBot([self.guild])
+        self.channels = ChannelIndex(ADMIN, LOG)
+        _run(self.channels.index_guilds(self.bot.guilds))
+        # Flair messages are in their own channel.
+        self.roles_channel = self.guild.add_channel('roles')
+        self.message = self.roles_channel.add_message(FLAIR_MESSAGE_ID)
+        self.role = self.guild.add_role(1)
+        self.cog = self.new_cog()
+
+    def tearDown(self):
+        self.db.close()
+        if os.path.exists(TEST_DB):
+            os.remove(TEST_DB)
+
+    def new_cog(self, **kwargs):
+        cog = flairs.Flairs(self.db, self.bot, self.channels, role_edit_delay=0,
+                            log_flush_interval=60, reconcile_on_ready=False)
+        cog._reconciler = Reconciler(self.bot, cog._apply_reconciled_roles, limit=TEST_LIMIT, **kwargs)
+        return cog
+
+    def set_flair(self, reaction, role, message_id=FLAIR_MESSAGE_ID):
+        _run(self.db.save('user', message_id, self.cog._emoji_id_from_str(reaction), role.id))
+
+    def role_ids(self, member):
+        return {r.id for r in member.roles if not r.is_default()}
+
+
+class TestReconcile(ReconcileTest):
+    def test_catches_up_with_missed_reactions(self):
+        reacted, unreacted, unchanged = (self.guild.add_member(i) for i in (1, 2, 3))
+        unreacted.roles.append(self.role)
+        unchanged.roles.append(self.role)
+        self.message.react(THUMBS_UP, reacted, unchanged)
+        self.set_flair(THUMBS_UP, self.role)
+
+        report = _run(self.cog.reconcile(sweep=True, remove=True))
+        self.assertEqual(self.role_ids(reacted), {1})
+        self.assertEqual(self.role_ids(unreacted), set())
+        self.assertEqual(self.role_ids(unchanged), {1})
+        self.assertEqual((report.messages, report.reactions, report.added, report.removed, report.members),
+                         (1, 2, 1, 1, 2))
+        self.assertEqual(self.guild.count('edit'), 2)
+
+        # Once it's caught up, there's nothing left to do, and the message
+        # doesn't have to be looked for again.
+        self.guild.calls = []
+        report = _run(self.cog.reconcile(sweep=True, remove=True))
+        self.assertEqual((report.added, report.removed), (0, 0))
+        self.assertEqual([c for c in self.guild.calls if c[0] == 'fetch_message'],
+                         [('fetch_message', 'roles', FLAIR_MESSAGE_ID)])
+
+    def test_roles_granted_anywhere_are_kept(self):
+        other = self.roles_channel.add_message(FLAIR_MESSAGE_ID + 1)
+        member = self.guild.add_member(1)
+        member.roles.append(self.role)
+        other.react(CUSTOM_EMOJI, member)
+        self.set_flair(THUMBS_UP, self.role)
+        self.set_flair(CUSTOM_EMOJI, self.role, FLAIR_MESSAGE_ID + 1)
+
+        self.assertEqual(_run(self.cog.reconcile(sweep=True, remove=True)).removed, 0)
+        self.assertEqual(self.role_ids(member), {1})
+
+    def test_missing_messages_take_nothing_away(self):
+        member = self.guild.add_member(1)
+        member.roles.append(self.role)
+        self.set_flair(THUMBS_UP, self.role, message_id=FLAIR_MESSAGE_ID + 1)
+
+        report = _run(self.cog.reconcile(sweep=True, remove=True))
+        self.assertEqual((report.missing, report.removed), (1, 0))
+        self.assertEqual(self.role_ids(member), {1})
+
+    def test_only_takes_roles_away_when_asked(self):
+        reacted, given_by_hand = self.guild.add_member(1), self.guild.add_member(2)
+        given_by_hand.roles.append(self.role)
+        self.message.react(THUMBS_UP, reacted)
+        self.set_flair(THUMBS_UP, self.role)
+
+        report = _run(self.cog.reconcile(sweep=True))
+        self.assertEqual((report.added, report.removed), (1, 0))
+        self.assertEqual(self.role_ids(given_by_hand), {1})
+        self.assertIn("Roles weren't taken away", report.summary())
+
+    def test_skips_messages_with_bad_ids(self):
+        member = self.guild.add_member(1)
+        self.message.react(THUMBS_UP, member)
+        self.set_flair(THUMBS_UP, self.role)
+        self.set_flair(CUSTOM_EMOJI, self.role, message_id='abc')
+
+        report = _run(self.cog.reconcile(sweep=True))
+        self.assertEqual((report.invalid, report.messages, report.added), (1, 1, 1))
+        self.assertEqual(self.role_ids(member), {1})
+        self.assertIn("1 messages were skipped", report.summary())
+
+    def test_pages_through_reactions(self):
+        self.cog = self.new_cog(page_size=2)
+        members = [self.guild.add_member(i) for i in range(1, 6)]
+        self.message.react(THUMBS_UP, *members)
+        self.set_flair(THUMBS_UP, self.role)
+
+        self.assertEqual(_run(self.cog.reconcile(sweep=True)).added, 5)
+        self.assertEqual([c for c in self.guild.calls if c[0] == 'reaction_users'],
+                         [('reaction_users', None), ('reaction_users', 2), ('reaction_users', 4)])
+        self.assertTrue(all(self.role_ids(m) == {1} for m in members))
+
+    def test_uses_where_reactions_came_from(self):
+        member = self.guild.add_member(1)
+        self.set_flair(THUMBS_UP, self.role)
+        _run(self.cog.load_flairs())
+        p = payload(member, THUMBS_UP)
+        p.channel_id = self.roles_channel.id
+        _run(self.cog.on_raw_reaction_add(p))
+        _run(self.cog.flush_role_edits())
+
+        self.guild.calls = []
+        _run(self.cog.reconcile(sweep=True))
+        self.assertEqual(self.guild.count('fetch_message'), 1)
+
+    def test_limits_requests_in_flight(self):
+        in_flight = []
+        most = [0]
+
+        async def apply(guild, user_id, changes, reason):
+            in_flight.append(user_id)
+            most[0] = max(most[0], len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(user_id)
+        reconciler = Reconciler(self.bot, apply, concurrency=2, limit=TEST_LIMIT)
+        self.message.react(THUMBS_UP, *(self.guild.add_member(i) for i in range(1, 11)))
+
+        report = _run(reconciler.run({(str(FLAIR_MESSAGE_ID), THUMBS_UP): ['1']}, sweep=True))
+        self.assertEqual(report.added, 10)
+        self.assertEqual(most[0], 2)
+
+    def test_keeps_to_the_rate_limit(self):
+        async def apply(guild, user_id, changes, reason):
+            pass
+        reconciler = Reconciler(self.bot, apply, limit=Limit(per_second=50, burst=1))
+        self.message.react(THUMBS_UP, *(self.guild.add_member(i) for i in range(1, 6)))
+
+        report = _run(reconciler.run({(str(FLAIR_MESSAGE_ID), THUMBS_UP): ['1']}, sweep=True))
+        # A message, a page of reactions and five edits, 1/50th of a second
+        # apart after the first.
+        self.assertGreaterEqual(report.seconds, 6 / 50)
+
+    def test_backs_off_when_rate_limited(self):
+        attempts = []
+
+        async def apply(guild, user_id, changes, reason):
+            attempts.append(user_id)
+            if len(attempts) == 1:
+                raise rate_limited(0.05)
+            if len(attempts) == 2:
+                raise discord.HTTPException(SimpleNamespace(status=403, reason='Forbidden'), 'Missing Permissions')
+        reconciler = Reconciler(self.bot, apply, concurrency=1, limit=TEST_LIMIT)
+        self.message.react(THUMBS_UP, self.guild.add_member(1), self.guild.add_member(2))
+
+        report = _run(reconciler.run({(str(FLAIR_MESSAGE_ID), THUMBS_UP): ['1']}, sweep=True))
+        # The first was tried again once the limit had passed. Only being
+        # rate limited is worth trying again.
+        self.assertEqual(attempts, [1, 1, 2])
+        self.assertEqual(report.failed, 1)
+        self.assertGreaterEqual(report.seconds, 0.05)
+
+    def test_admin_command(self):
+        member = self.guild.add_member(1)
+        self.message.react(THUMBS_UP, member)
+        self.set_flair(THUMBS_UP, self.role)
+        admin = self.guild.channel(ADMIN)
+        ctx = SimpleNamespace(message=SimpleNamespace(channel=admin))
+
+        unreacted = self.guild.add_member(2)
+        unreacted.roles.append(self.role)
+
+        _run(self.cog.reconcile_flairs.callback(self.cog, ctx))
+        self.assertEqual(self.role_ids(member), {1})
+        self.assertEqual(self.role_ids(unreacted), set())
+        self.assertIn("Added 1 roles and removed 1", admin.sent[-1])
+
+    def test_runs_on_ready(self):
+        member = self.guild.add_member(1)
+        self.message.react(THUMBS_UP, member)
+        self.set_flair(THUMBS_UP, self.role)
+        cog = flairs.Flairs(self.db, self.bot, self.channels, role_edit_delay=0, log_flush_interval=60)
+        # Where the message is was learned before the bot reconnected.
+        cog._reconciler.remember(FLAIR_MESSAGE_ID, self.guild.id, self.roles_channel.id)
+
+        async def main():
+            await cog.on_ready()
+            while self.role_ids(member) != {1}:
+                await asyncio.sleep(0.01)
+            await cog._log_sink.stop()
+        _run(asyncio.wait_for(main(), 5))
+
+    def test_only_looks_for_messages_when_asked(self):
+        member = self.guild.add_member(1)
+        member.roles.append(self.role)
+        self.set_flair(THUMBS_UP, self.role)
+
+        report = _run(self.cog.reconcile())
+        self.assertEqual((report.unsearched, report.missing, report.removed), (1, 0, 0))
+        self.assertEqual(self.guild.count('fetch_message'), 0)
+        self.assertEqual(self.role_ids(member), {1})
+
+    def test_doesnt_look_for_missing_messages_again(self):
+        now = [0.0]
+        self.cog = self.new_cog(clock=lambda: now[0])
+        self.set_flair(THUMBS_UP, self.role, message_id=FLAIR_MESSAGE_ID + 1)
+        self.assertEqual(_run(self.cog.reconcile(sweep=True)).missing, 1)
+        looked = self.guild.count('fetch_message')
+
+        self.assertEqual(_run(self.cog.reconcile(sweep=True)).missing, 1)
+        self.assertEqual(self.guild.count('fetch_message'), looked)
+        # Until it's been a while.
+        now[0] += reconcile.MISSING_MESSAGE_RETRY_SECONDS
+        _run(self.cog.reconcile(sweep=True))
+        self.assertEqual(self.guild.count('fetch_message'), 2 * looked)
+
+    def test_leaves_other_guilds_flairs_alone(self):
+        other = FakeGuild(self.guild.id + 1)
+        elsewhere = other.add_role(2)
+        self.set_flair(THUMBS_UP, elsewhere)
+
+        report = _run(self.cog.reconcile(sweep=True))
+        self.assertEqual((report.messages, report.missing), (0, 0))
+        self.assertEqual(self.guild.count('fetch_message'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
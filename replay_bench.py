@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Replays synthetic discord traffic through CommandSetter and Flairs.
+
+Run with: python3 replay_bench.py [options]
+
+The traffic is mostly ordinary chatter, with summons spread over the triggers
+by a Zipf distribution, the odd admin command, and bursts ("storms") of
+reactions on a role menu. Every handler runs against real sqlite stores on
+scratch databases, which are deleted afterwards. Discord itself is faked with
+the same fakes the tests use.
+
+Prints throughput and per-handler latency, and with --out saves them as JSON.
+Given --baseline, compares against an earlier run's JSON and exits non-zero
+if anything got slower than --tolerance allows.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
+
+import discord
+
+import cmd_setter
+import flairs
+from channels import ChannelIndex
+from cmd_setter import CommandSetter
+from flairs_test import ADMIN, LOG, FakeBot, FakeGuild
+from storage import CmdStore, FlairStore, Response
+from storage_bench import _remove_db
+
+# Make sure these don't coincide with sqlite db files that are really used.
+REPLAY_DB = 'replay_db_please_ignore.db'
+REPLAY_FLAIR_DB = 'replay_flair_db_please_ignore.db'
+
+FLAIR_MESSAGE_ID = 5678
+# Reactions on the role menu. A storm also includes reactions that don't grant
+# anything, and reactions on other messages.
+FLAIR_EMOJIS = ['👍', '🎮', '🎨', '<:newton:123456789012345678>']
+OTHER_EMOJIS = ['😂', '🔥']
+
+# Role edits are coalesced for this long. Kept short so the replay doesn't
+# mostly wait for it, but longer than a storm lasts.
+ROLE_EDIT_DELAY = 0.05
+
+
+class ReplayChannel:
+    """Stands in for a discord.TextChannel. Only counts what is sent."""
+
+    def __init__(self, name):
+        self.id = hash(name)
+        self.name = name
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+
+
+def _message(text, channel, author):
+    return SimpleNamespace(content=text, channel=channel, guild=None, author=author, attachments=[])
+
+
+def _payload(guild, member, emoji, message_id):
+    return SimpleNamespace(
+        message_id=message_id,
+        guild_id=guild.id,
+        channel_id=guild.channels[0].id,
+        user_id=member.id,
+        member=member,
+        emoji=discord.PartialEmoji.from_str(emoji))
+
+
+def generate_events(args, rng: random.Random) -> List[Tuple]:
+    """
+    Returns the traffic to replay, as (kind, ...) tuples. Kinds are chatter,
+    summon, admin, reaction-add and reaction-remove.
+    """
+    triggers = [f"t{i}" for i in range(args.triggers)]
+    zipf = [1 / (k ** args.zipf) for k in range(1, args.triggers + 1)]
+    kinds = ['chatter', 'summon', 'admin', 'storm']
+    kind_weights = [args.chatter, args.summon, args.admin, args.storms]
+
+    events = []
+    while len(events) < args.n:
+        kind = rng.choices(kinds, kind_weights)[0]
+        if kind == 'chatter':
+            events.append(('chatter', f"just chatting, message {len(events)}"))
+        elif kind == 'summon':
+            trigger = rng.choices(triggers, zipf)[0]
+            events.append(('summon', f"{cmd_setter.SUMMONING_KEY}{trigger} with some words after"))
+        elif kind == 'admin':
+            trigger = rng.choices(triggers, zipf)[0]
+            scratch = f"scratch{rng.randrange(10)}"
+            events.append(('admin', rng.choice([
+                f"{cmd_setter.SAVE_COMMAND}{scratch} saved during the replay",
+                f"{cmd_setter.RANDOM_COMMAND}{trigger} added during the replay",
+                f"{cmd_setter.RANDOM_COMMAND}{trigger}*3 weighted during the replay",
+                f"{cmd_setter.DELETE_COMMAND}{scratch}",
+                cmd_setter.LIST_COMMAND,
+            ])))
+        else:
+            for _ in range(args.storm_size):
+                emoji = rng.choice(FLAIR_EMOJIS + OTHER_EMOJIS)
+                message_id = FLAIR_MESSAGE_ID if rng.random() < 0.9 else FLAIR_MESSAGE_ID + 1
+                add = rng.random() < 0.7
+                events.append(('reaction-add' if add else 'reaction-remove',
+                               rng.randrange(args.members), emoji, message_id))
+    return events[:args.n]
+
+
+async def _seed(args, rng, cmd_store, flair_store, guild):
+    await cmd_store.save_many(
+        Response(time.time(), 'replay', f"t{t}", f"response {r} to t{t}",
+                 rng.choice([1.0, 1.0, 2.0, 5.0]))
+        for t in range(args.triggers) for r in range(args.responses))
+    for i, emoji in enumerate(FLAIR_EMOJIS):
+        role = guild.add_role(100 + i)
+        e = discord.PartialEmoji.from_str(emoji)
+        await flair_store.save('replay', str(FLAIR_MESSAGE_ID),
+                               str(e.id) if e.id is not None else e.name, role.id)
+    for m in range(args.members):
+        guild.add_member(m)
+
+
+async def replay(args) -> Dict:
+    rng = random.Random(args.seed)
+    events = generate_events(args, rng)
+
+    _remove_db(REPLAY_DB)
+    _remove_db(REPLAY_FLAIR_DB)
+    cmd_store = CmdStore(REPLAY_DB)
+    flair_store = FlairStore(REPLAY_FLAIR_DB)
+    guild = FakeGuild()
+    # Every member reacting is in the gateway cache, like with the members
+    # intent, so the replay measures us rather than fake fetches.
+    guild.gateway_cache = True
+    bot = FakeBot([guild])
+    try:
+        await _seed(args, rng, cmd_store, flair_store, guild)
+        channels = ChannelIndex(ADMIN, LOG)
+        await channels.index_guilds(bot.guilds)
+        setter = CommandSetter(object(), cmd_store, channels)
+        # There's no downtime to catch up on in a replay.
+        flair_cog = flairs.Flairs(flair_store, bot, channels,
+                                  role_edit_delay=ROLE_EDIT_DELAY, reconcile_on_ready=False)
+        await flair_cog.on_ready()
+
+        author = SimpleNamespace(name='replay_user')
+        chat = ReplayChannel('general')
+        admin = ReplayChannel(ADMIN)
+
+        latencies: Dict[str, List[float]] = {}
+        start = time.perf_counter()
+        for kind, *event in events:
+            if kind == 'reaction-add' or kind == 'reaction-remove':
+                member_id, emoji, message_id = event
+                p = _payload(guild, guild.members[member_id], emoji, message_id)
+                handler = flair_cog.on_raw_reaction_add if kind == 'reaction-add' else flair_cog.on_raw_reaction_remove
+                if kind == 'reaction-remove':
+                    # Like discord, removals don't include the member.
+                    p.member = None
+                t = time.perf_counter()
+                await handler(p)
+            else:
+                m = _message(event[0], admin if kind == 'admin' else chat, author)
+                t = time.perf_counter()
+                await setter.on_message(m)
+            latencies.setdefault(kind, []).append(time.perf_counter() - t)
+            # Give background work (role edits, log flushes, the stores'
+            # futures) a turn, like waiting on the gateway would.
+            await asyncio.sleep(0)
+        handled = time.perf_counter() - start
+        await flair_cog.flush_role_edits()
+        await flair_cog._log_sink.stop()
+        elapsed = time.perf_counter() - start
+    finally:
+        cmd_store.close()
+        flair_store.close()
+        _remove_db(REPLAY_DB)
+        _remove_db(REPLAY_FLAIR_DB)
+
+    return {
+        'config': {k: v for k, v in vars(args).items()
+                   if k not in ('out', 'baseline', 'tolerance', 'verbose')},
+        'events': len(events),
+        'events_per_second': len(events) / elapsed,
+        'handled_seconds': handled,
+        'elapsed_seconds': elapsed,
+        'role_edits': guild.count('edit'),
+        'replies': chat.sent + admin.sent,
+        'handlers': {kind: _percentiles(samples) for kind, samples in sorted(latencies.items())},
+    }
+
+
+def _percentiles(seconds) -> Dict[str, float]:
+    """Summarizes latency samples, in microseconds."""
+    seconds = sorted(seconds)
+    return {
+        'n': len(seconds),
+        'mean_us': sum(seconds) / len(seconds) * 1e6,
+        'p50_us': seconds[len(seconds) // 2] * 1e6,
+        'p99_us': seconds[min(len(seconds) - 1, int(len(seconds) * 0.99))] * 1e6,
+    }
+
+
+def _print_results(results):
+    print(f"{results['events']} events in {results['elapsed_seconds']:.2f}s: "
+          f"{results['events_per_second']:.0f} events/s, "
+          f"{results['role_edits']} role edits, {results['replies']} replies")
+    for kind, p in results['handlers'].items():
+        print(f"{kind:<20} n={p['n']:<7} mean={p['mean_us']:9.1f}us "
+              f"p50={p['p50_us']:9.1f}us p99={p['p99_us']:9.1f}us")
+
+
+def compare(results, baseline, tolerance) -> List[str]:
+    """
+    Returns a description of everything in results that is worse than in
+    baseline by more than the given fraction.
+    """
+    regressions = []
+    if results['events_per_second'] < baseline['events_per_second'] * (1 - tolerance):
+        regressions.append(f"throughput fell from {baseline['events_per_second']:.0f} "
+                           f"to {results['events_per_second']:.0f} events/s")
+    for kind, p in results['handlers'].items():
+        if kind not in baseline['handlers']:
+            continue
+        for stat in ('p50_us', 'p99_us'):
+            before = baseline['handlers'][kind][stat]
+            if p[stat] > before * (1 + tolerance):
+                regressions.append(f"{kind} {stat[:3]} rose from {before:.1f}us to {p[stat]:.1f}us")
+    return regressions
+
+
+def _main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=20000,
+                        help="Number of events to replay.")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Seed for generating the traffic. The same seed replays the same events.")
+    parser.add_argument('--triggers', type=int, default=200,
+                        help="Number of distinct triggers.")
+    parser.add_argument('--responses', type=int, default=5,
+                        help="Number of responses each trigger starts with.")
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help="Exponent of the Zipf distribution summons follow.")
+    parser.add_argument('--members', type=int, default=500,
+                        help="Number of members reacting.")
+    parser.add_argument('--chatter', type=float, default=0.95,
+                        help="Share of messages that are ordinary chatter.")
+    parser.add_argument('--summon', type=float, default=0.045,
+                        help="Share of messages that summon a trigger.")
+    parser.add_argument('--admin', type=float, default=0.004,
+                        help="Share of messages that are admin commands.")
+    parser.add_argument('--storms', type=float, default=0.001,
+                        help="Chance, per message, of a reaction storm starting.")
+    parser.add_argument('--storm-size', type=int, default=200,
+                        help="Number of reaction events in a storm.")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="Show what the handlers log.")
+    parser.add_argument('--out', help="Where to save the results as JSON.")
+    parser.add_argument('--baseline', help="Results JSON of an earlier run to compare against.")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="How much slower than the baseline counts as a regression, as a fraction.")
+    args = parser.parse_args()
+
+    # The handlers log everything they do to stdout. Those writes are still
+    # timed, they just don't end up mixed in with the results.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(
+            sys.stdout if args.verbose else devnull):
+        results = asyncio.run(replay(args))
+    _print_results(results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['config'] != results['config']:
+            print("Warning: the baseline was run with different options.")
+        regressions = compare(results, baseline, args.tolerance)
+        for r in regressions:
+            print(f"Regression: {r}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Runs the bot as several processes, each handling some of its shards.
+
+    python3 shards.py --processes 4 --shards 16
+
+Takes the same environment variables as main.py. With NEWTON_METRICS_PORT
+set, each process serves its metrics on its own port, counting up from it.
+
+Every process reads the databases itself, but all writes go through one
+extra writer process, so sqlite never has processes fighting over the write
+lock. The writer also tells every shard process about commands and flairs the
+others changed, so they can update what they have cached.
+
+Any commands database from before commands were partitioned by guild is made
+the global partition before the processes start.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import multiprocessing
+import pickle
+import threading
+from multiprocessing.connection import Connection, wait
+from typing import Callable, Dict, List, Optional
+
+import main
+from storage import SQLITE_ENGINE, FlairStore, GuildCmdStores, SharedWriter, migrate_to_partitions
+
+# What changes to commands are published as. Every guild's partition shares
+# it, since they're opened as they're needed.
+COMMANDS_TOPIC = 'commands'
+
+
+def shard_ids_for(process: int, processes: int, shard_count: int) -> List[int]:
+    """Returns the shards the given process (counting from 0) runs."""
+    return list(range(process, shard_count, processes))
+
+
+class Link:
+    """
+    A shard process's end of its connection to the writer process.
+
+    Requests can be sent from any thread. Replies and change notices are read
+    by a background thread: replies complete their request's future, and
+    change notices are passed to the listener for their topic, on the event
+    loop given to listen().
+    """
+
+    def __init__(self, conn: Connection):
+        self._conn = conn
+        self._send_lock = threading.Lock()
+        self._ids = itertools.count()
+        self._pending: Dict[int, concurrent.futures.Future] = {}
+        self._pending_lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._listeners: Dict[str, Callable] = {}
+        self._thread = threading.Thread(target=self._run, name='writer-link', daemon=True)
+        self._thread.start()
+
+    def request(self, db_name, fn, args, exclusive) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        request_id = next(self._ids)
+        with self._pending_lock:
+            self._pending[request_id] = future
+        self._send(('write', request_id, db_name, fn, args, exclusive))
+        return future
+
+    def publish(self, topic, change):
+        """Tells every other shard process about the change."""
+        self._send(('changed', topic, change))
+
+    def listen(self, loop: asyncio.AbstractEventLoop, topic, listener: Callable):
+        """Calls listener, on loop, with every change other processes publish to the topic."""
+        self._loop = loop
+        self._listeners[topic] = listener
+
+    def close(self):
+        # Closing the connection wouldn't wake the thread reading from it,
+        # so the writer is asked to hang up instead.
+        self._send(('close',))
+        self._thread.join()
+        self._conn.close()
+
+    def _send(self, message):
+        with self._send_lock:
+            self._conn.send(message)
+
+    def _run(self):
+        while True:
+            try:
+                message = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            if message[0] == 'closed':
+                break
+            if message[0] == 'result':
+                _, request_id, ok, value = message
+                with self._pending_lock:
+                    future = self._pending.pop(request_id)
+                if future.cancelled():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+            elif message[0] == 'changed':
+                _, topic, change = message
+                listener = self._listeners.get(topic)
+                if listener is not None and self._loop is not None:
+                    self._loop.call_soon_threadsafe(listener, change)
+
+        # The writer is gone, so nothing pending will ever be answered.
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(ConnectionError("Lost the connection to the writer process."))
+
+
+class RemoteWriter:
+    """Stands in for a store's writer thread, sending its work to the writer process instead."""
+
+    def __init__(self, link: Link, db_name):
+        self._link = link
+        self._db_name = db_name
+
+    def submit(self, fn, args, exclusive=False) -> concurrent.futures.Future:
+        return self._link.request(self._db_name, fn, args, exclusive)
+
+    def stop(self):
+        # The link is shared by every store in the process, so it's closed
+        # separately.
+        pass
+
+
+def run_writer(conns: List[Connection]):
+    """
+    Serves writes for the shard processes on the other end of conns, until
+    all of them have disconnected. Databases are opened as they're first
+    written to.
+    """
+    dbs: Dict[str, SharedWriter] = {}
+    send_locks = {conn: threading.Lock() for conn in conns}
+
+    def send(conn, message):
+        with send_locks[conn]:
+            try:
+                conn.send(message)
+            except (OSError, EOFError):
+                pass  # That shard is gone. Its conn is dropped below.
+
+    def reply(conn, request_id, future):
+        if future.exception() is None:
+            send(conn, ('result', request_id, True, future.result()))
+            return
+        e = future.exception()
+        try:
+            pickle.dumps(e)
+        except Exception:
+            # Still let the shard know it failed.
+            e = RuntimeError(repr(e))
+        send(conn, ('result', request_id, False, e))
+
+    live = list(conns)
+    while live:
+        for conn in wait(live):
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                live.remove(conn)
+                continue
+            if message[0] == 'write':
+                _, request_id, db_name, fn, args, exclusive = message
+                # Writes run on the database's writer thread, so several
+                # shards' writes can share a commit.
+                db = dbs.get(db_name)
+                if db is None:
+                    db = dbs[db_name] = SharedWriter(db_name)
+                future = db.submit(fn, args, exclusive)
+                future.add_done_callback(
+                    lambda f, conn=conn, request_id=request_id: reply(conn, request_id, f))
+            elif message[0] == 'close':
+                send(conn, ('closed',))
+                live.remove(conn)
+                with send_locks[conn]:
+                    conn.close()
+            elif message[0] == 'changed':
+                for other in live:
+                    if other is not conn:
+                        send(other, message)
+
+    for db in dbs.values():
+        db.close()
+
+
+def connect_stores(link: Link):
+    """Opens the stores a shard process uses, with writes going through the link."""
+    cmd_stores = GuildCmdStores(main.COMMAND_DATA_DIR, writer_for=lambda path: RemoteWriter(link, path))
+    flair_store = FlairStore(main.FLAIR_DB_NAME, writer=RemoteWriter(link, main.FLAIR_DB_NAME))
+    return cmd_stores, flair_store
+
+
+def share_changes(link: Link, loop: asyncio.AbstractEventLoop,
+                  cmd_stores: GuildCmdStores, flair_store: FlairStore, flair_db_name, flairs_cog):
+    """
+    Tells the other shard processes about changes made through these stores,
+    and updates their caches when the other processes make changes.
+    """
+    cmd_stores.listeners.append(
+        lambda guild_id, triggers: link.publish(COMMANDS_TOPIC, (guild_id, triggers)))
+    flair_store.listeners.append(lambda message_ids: link.publish(flair_db_name, message_ids))
+    link.listen(loop, COMMANDS_TOPIC,
+                lambda change: asyncio.ensure_future(cmd_stores.reload(*change)))
+    link.listen(loop, flair_db_name,
+                lambda message_ids: asyncio.ensure_future(flairs_cog.load_flairs()))
+
+
+def run_shards(index: int, shard_ids: List[int], shard_count: int, conn: Connection, settings: main.Settings):
+    """Runs the given shards, until the bot stops."""
+    link = Link(conn)
+    cmd_stores, flair_store = connect_stores(link)
+    metrics_port = None
+    if settings.metrics_port is not None:
+        metrics_port = settings.metrics_port + index
+    newton = main.ShardedBot(cmd_stores, flair_store, settings.admin_channel, settings.log_channel,
+                             metrics_port, settings.image_limits, shard_ids=shard_ids, shard_count=shard_count)
+    share_changes(link, newton.loop, cmd_stores, flair_store, main.FLAIR_DB_NAME, newton.get_cog('Flairs'))
+    try:
+        newton.run(settings.token)
+    finally:
+        cmd_stores.close()
+        flair_store.close()
+        link.close()
+
+
+def _main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                        help="How many shard processes to run. Defaults to the number of CPUs.")
+    parser.add_argument('--shards', type=int,
+                        help="How many shards to split the bot into. Defaults to one per process.")
+    args = parser.parse_args()
+    shard_count = args.shards if args.shards is not None else args.processes
+    processes = min(args.processes, shard_count)
+    settings = main.settings_from_env()
+    if settings.engine != SQLITE_ENGINE:
+        # The other engines can't share the writer process.
+        parser.exit(1, f"Only the {SQLITE_ENGINE} storage engine can be sharded.\n")
+    if migrate_to_partitions(main.COMMAND_DB_NAME, main.COMMAND_DATA_DIR):
+        print(f"Moved {main.COMMAND_DB_NAME} into {main.COMMAND_DATA_DIR}, as the global commands.")
+
+    ctx = multiprocessing.get_context('spawn')
+    pipes = [ctx.Pipe() for _ in range(processes)]
+    writer = ctx.Process(target=run_writer, name='writer', args=([w for w, _ in pipes],))
+    writer.start()
+    shards = []
+    for i, (_, conn) in enumerate(pipes):
+        ids = shard_ids_for(i, processes, shard_count)
+        print(f"Starting process {i} for shards {ids}.")
+        p = ctx.Process(target=run_shards, name=f"shards-{i}",
+                        args=(i, ids, shard_count, conn, settings))
+        p.start()
+        shards.append(p)
+    # The children have their own copies of the pipes now. Closing ours lets
+    # the writer notice when every shard process has exited.
+    for w, conn in pipes:
+        w.close()
+        conn.close()
+
+    try:
+        for p in shards:
+            p.join()
+    except KeyboardInterrupt:
+        for p in shards:
+            p.terminate()
+    writer.join()
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import asyncio
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import time
+import unittest
+from types import SimpleNamespace
+
+import cmd_setter
+import flairs
+import shards
+from channels import ChannelIndex
+from flairs_test import ADMIN, LOG, THUMBS_UP, FakeBot, FakeGuild, payload
+from storage import FlairStore, GuildCmdStores, _execute
+
+# Make sure these don't coincide with sqlite db files that are really used.
+TEST_DATA_DIR = 'test_shards_data_please_ignore'
+TEST_FLAIR_DB = 'test_shards_flair_db_please_ignore.db'
+
+FLAIR_MESSAGE_ID = 5678
+GUILD_ID = 1234
+PROCESSES = 2
+
+
+class FakeChannel:
+    def __init__(self, name):
+        self.id = hash(name)
+        self.name = name
+        self.sent = []
+
+    async def send(self, content, **kwargs):
+        self.sent.append(content)
+
+
+# Stands in for one shard process, with a fake gateway: messages and
+# reactions are handed straight to the cogs.
+class FakeShard:
+    def __init__(self, conn):
+        self.link = shards.Link(conn)
+        self.cmd_stores = GuildCmdStores(
+            TEST_DATA_DIR, writer_for=lambda path: shards.RemoteWriter(self.link, path))
+        self.flair_store = FlairStore(TEST_FLAIR_DB, writer=shards.RemoteWriter(self.link, TEST_FLAIR_DB))
+        self.guild = FakeGuild()
+        self.guild.gateway_cache = True
+        channels = ChannelIndex(ADMIN, LOG)
+        _run(channels.index_guilds([self.guild]))
+        self.setter = cmd_setter.CommandSetter(object(), self.cmd_stores, channels)
+        self.flairs = flairs.Flairs(self.flair_store, FakeBot([self.guild]), channels,
+                                    role_edit_delay=0, log_flush_interval=60)
+        _run(self.flairs.on_ready())
+        shards.share_changes(self.link, asyncio.get_event_loop(),
+                             self.cmd_stores, self.flair_store, TEST_FLAIR_DB, self.flairs)
+
+    def send(self, text, channel_name='arbitrary-channel', guild_id=GUILD_ID):
+        channel = FakeChannel(channel_name)
+        guild = SimpleNamespace(id=guild_id) if guild_id is not None else None
+        _run(self.setter.on_message(SimpleNamespace(
+            content=text, channel=channel, guild=guild,
+            author=SimpleNamespace(id=1, name='arbitrary_user'), attachments=[])))
+        return channel.sent
+
+    def close(self):
+        _run(self.flairs._log_sink.stop())
+        self.cmd_stores.close()
+        self.flair_store.close()
+        self.link.close()
+
+
+class ShardsTest(unittest.TestCase):
+    def setUp(self):
+        _remove_dbs()
+        ctx = multiprocessing.get_context('spawn')
+        pipes = [ctx.Pipe() for _ in range(PROCESSES)]
+        self.writer = ctx.Process(target=shards.run_writer,
+                                  args=([w for w, _ in pipes],))
+        self.writer.start()
+        for w, _ in pipes:
+            w.close()
+        self.shards = [FakeShard(conn) for _, conn in pipes]
+
+    def tearDown(self):
+        for s in self.shards:
+            s.close()
+        self.writer.join(timeout=10)
+        _remove_dbs()
+
+    # Runs the event loop until the condition holds, so the shards can hear
+    # about each other's changes.
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "Timed out.")
+            _run(asyncio.sleep(0.01))
+
+    def test_sees_other_shards_commands(self):
+        a, b = self.shards
+        self.assertEqual(b.send(f"{cmd_setter.SUMMONING_KEY}hi"), [])
+        a.send(f"{cmd_setter.SAVE_COMMAND}hi hello", ADMIN)
+        self.wait_for(lambda: b.send(f"{cmd_setter.SUMMONING_KEY}hi") == ["hello"])
+
+        # Overwrites and deletes show up too.
+        a.send(f"{cmd_setter.SAVE_COMMAND}hi goodbye", ADMIN)
+        self.wait_for(lambda: b.send(f"{cmd_setter.SUMMONING_KEY}hi") == ["goodbye"])
+        a.send(f"{cmd_setter.DELETE_COMMAND}hi", ADMIN)
+        self.wait_for(lambda: b.send(f"{cmd_setter.SUMMONING_KEY}hi") == [])
+
+    def test_sees_other_shards_global_commands(self):
+        a, b = self.shards
+        a.send(f"{cmd_setter.SAVE_COMMAND}hi hello", ADMIN, guild_id=None)
+        self.wait_for(lambda: b.send(f"{cmd_setter.SUMMONING_KEY}hi", guild_id=None) == ["hello"])
+        self.assertEqual(b.send(f"{cmd_setter.SUMMONING_KEY}hi"), ["hello"])
+
+    def test_lists_other_shards_commands(self):
+        a, b = self.shards
+        b.send(cmd_setter.LIST_COMMAND, ADMIN)
+        a.send(f"{cmd_setter.RANDOM_COMMAND}hi hello", ADMIN)
+        self.wait_for(lambda: "hi" in b.send(cmd_setter.LIST_COMMAND, ADMIN)[0])
+
+    def test_sees_other_shards_flairs(self):
+        a, b = self.shards
+        role = b.guild.add_role(1)
+        member = b.guild.add_member(99)
+        _run(a.flair_store.save('arbitrary_user', str(FLAIR_MESSAGE_ID), THUMBS_UP, role.id))
+
+        def has_role():
+            _run(b.flairs.on_raw_reaction_add(payload(member, THUMBS_UP, FLAIR_MESSAGE_ID)))
+            _run(b.flairs.flush_role_edits())
+            return role in member.roles
+        self.wait_for(has_role)
+
+    def test_writes_share_the_writer(self):
+        a, b = self.shards
+        a_store, b_store = (_run(s.cmd_stores.partition(GUILD_ID)) for s in self.shards)
+        _run(asyncio.gather(*(store.save('user', f"t{i}", 'content')
+                              for i in range(20) for store in (a_store, b_store))))
+        self.assertEqual(len(_run(a_store.list_commands())), 20)
+        self.wait_for(lambda: _run(b_store.count('t0')) == 2)
+
+    def test_reports_errors(self):
+        a, _ = self.shards
+        with self.assertRaises(sqlite3.OperationalError):
+            _run(a.cmd_stores.shared._engine._db.transaction(_execute, 'NOT SQL', ()))
+
+
+class TestShardIds(unittest.TestCase):
+    def test_covers_every_shard_once(self):
+        ids = [shards.shard_ids_for(i, 3, 8) for i in range(3)]
+        self.assertEqual(ids, [[0, 3, 6], [1, 4, 7], [2, 5]])
+
+
+def _remove_dbs():
+    shutil.rmtree(TEST_DATA_DIR, ignore_errors=True)
+    for name in (TEST_FLAIR_DB,):
+        for suffix in ('', '-wal', '-shm', '-journal'):
+            if os.path.exists(name + suffix):
+                os.remove(name + suffix)
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+if __name__ == '__main__':
+    unittest.main()
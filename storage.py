@@ -1,111 +1,2008 @@
 #!/usr/bin/env python3
+import asyncio
+import concurrent.futures
+import contextlib
+import difflib
+import hashlib
+import glob
 import io
+import math
+import os
 import pickle
+import queue
+import random
+import re
+import shelve
 import sqlite3
+import threading
+import time
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Optional, Tuple
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Protocol, Set, Tuple
 
 import discord
 
+import metrics
+
+# The dbm engine only uses gdbm or ndbm. shelve falls back to dbm.dumb when
+# Python was built without either, but dbm.dumb rewrites its index every
+# time it's synced, so saves get slower as commands are added.
+try:
+    import dbm.gnu as _fast_dbm
+except ImportError:
+    try:
+        import dbm.ndbm as _fast_dbm
+    except ImportError:
+        _fast_dbm = None
+
+# How many threads (and so sqlite connections) each store reads with.
+READ_POOL_SIZE = 4
+
+# How the databases are journaled. WAL lets reads carry on while something is
+# being written, and makes commits much cheaper.
+JOURNAL_MODE = 'WAL'
+
+# The most writes that will share a single commit.
+GROUP_COMMIT_MAX_WRITES = 100
+# How long the writer waits for more writes to share a commit with, after
+# picking up the first of a batch. By default it only batches writes that
+# queued up while it was busy, which costs a lone write nothing.
+GROUP_COMMIT_WINDOW_SECONDS = 0.0
+
+# How many responses bulk imports commit at a time, and exports read at a time.
+BULK_CHUNK_SIZE = 500
+
+# How much more a search term counts for when it's in a trigger, rather than
+# in a response.
+SEARCH_TRIGGER_WEIGHT = 10.0
+# Did-you-mean suggestions are picked from this many triggers that share the
+# most pieces of three characters with the one that was summoned, and must be
+# at least SUGGESTION_CUTOFF similar to it (see difflib.get_close_matches).
+SUGGESTION_CANDIDATES = 20
+SUGGESTION_CUTOFF = 0.7
+# Searches only rank the newest this many responses that match (see _search).
+MAX_RANKED_MATCHES = 1000
+# SQLite's trigram tokenizer is new in 3.34. With older versions, trigger
+# names are kept in a plain table and matched with LIKE, which has to read
+# every name (see _create_search_indexes).
+HAS_TRIGRAM_TOKENIZER = sqlite3.sqlite_version_info >= (3, 34, 0)
+
+# The storage engines (see ENGINES). sqlite is the default, and the only one
+# with transactions, search indexes and writers that can be shared (see
+# shards.py). memory keeps nothing once closed, and dbm keeps everything in a
+# dbm file of pickles, which is quick to look things up in but slow to search.
+SQLITE_ENGINE = 'sqlite'
+MEMORY_ENGINE = 'memory'
+DBM_ENGINE = 'dbm'
+
+# With commands partitioned by guild (see GuildCmdStores), each guild's are
+# kept in <guild id>.db under the data directory, and the global ones, which
+# every guild can use, in GLOBAL_PARTITION_NAME.db.
+GLOBAL_PARTITION_NAME = 'global'
+# A guild's database is closed, and its index dropped, once none of its
+# commands have been used for this long. It's reopened the next time one is.
+PARTITION_IDLE_SECONDS = 30 * 60
+# The most guild databases kept open at once. Past this, the least recently
+# used are closed early, as long as they've been idle for at least
+# PARTITION_MIN_IDLE_SECONDS (they may still be in use otherwise).
+MAX_OPEN_PARTITIONS = 64
+PARTITION_MIN_IDLE_SECONDS = 60
+# Most guilds summon a few commands a minute at most, so their databases only
+# get one reader thread each.
+PARTITION_READ_POOL_SIZE = 1
+# A guild hides a global command from itself by saving a response to it with
+# this as the user (a tombstone), in its own partition. No discord user can
+# have this name.
+HIDDEN_BY = '\x00hidden'
+
+STORAGE_SECONDS = metrics.histogram(
+    'newton_storage_seconds', "Time taken by storage methods, including waiting for the database.", ['method'])
+SUMMON_IMAGE_BYTES_SAVED = metrics.counter(
+    'newton_summon_image_bytes_saved_total',
+    "Bytes not sent with responses, thanks to their images being shrunk when they were saved.")
+
+
+# Images used to be pickled instances of this class, stored inline in each
+# commands row. It is only kept around so _migrate_legacy_images can read them.
 @dataclass
 class File:
     name: str
     data: bytes
 
-def _discord_file_to_bytes(f: discord.File) -> bytes:
-    return pickle.dumps(File(f.filename, f.fp.read()))
 
+def _image_hash(data) -> str:
+    return hashlib.sha256(data).hexdigest()
 
-def _bytes_to_discord_file(b: bytes) -> discord.File:
-    f = pickle.loads(b)
-    # If the filename does not end with a image format, discord will not preview the image.
-    # It doesn't actually matter if the image is a .png or not, discord will still preview it lol.
-    return discord.File(io.BytesIO(f.data), filename=f.name)
 
+def _store_image(conn: sqlite3.Connection, data, original_size=None) -> str:
+    """
+    Adds the image to the images table, unless it is already there. Returns
+    its hash. original_size is the size of the image it was shrunk from, if
+    it was (see images.py).
+    """
+    h = _image_hash(data)
+    if original_size is None:
+        # Also used by migrations from before the original_size column.
+        conn.execute('''INSERT OR IGNORE INTO images (hash, data) VALUES(?, ?);''', (h, data))
+    else:
+        conn.execute('''INSERT OR IGNORE INTO images (hash, data, original_size) VALUES(?, ?, ?);''',
+                     (h, data, original_size))
+    return h
+
+
+def _load_image(conn: sqlite3.Connection, image_hash) -> Optional[io.BytesIO]:
+    """Copies the image with the given hash out of the images table."""
+    # Connection.blobopen would save a copy, but needs Python 3.11, which the
+    # pinned discord.py doesn't run on.
+    rows = conn.execute('''SELECT data FROM images WHERE hash=?;''', (image_hash,)).fetchall()
+    if len(rows) == 0:
+        return None
+    return io.BytesIO(rows[0][0])
+
+
+def _migrate_legacy_images(conn: sqlite3.Connection) -> Tuple[int, int]:
+    """
+    Moves pickled images out of the commands table and into the images table.
+
+    Returns the number of rows converted and the number of image bytes that
+    no longer need to be stored, since identical images are now only stored
+    once.
+    """
+    rows = conn.execute(
+        '''SELECT key, image FROM commands WHERE image IS NOT NULL;''').fetchall()
+    old_bytes = 0
+    new_bytes = 0
+    for key, pickled in rows:
+        old_bytes += len(pickled)
+        f = pickle.loads(pickled)
+        h = _image_hash(f.data)
+        if conn.execute('''SELECT 1 FROM images WHERE hash=?;''', (h,)).fetchone() is None:
+            new_bytes += len(f.data)
+            _store_image(conn, f.data)
+        conn.execute('''UPDATE commands SET image=NULL, image_hash=?, image_name=? WHERE key=?;''',
+                     (h, f.name, key))
+    return len(rows), old_bytes - new_bytes
+
+
+class Response(NamedTuple):
+    """One of a command's responses, as saved, imported and exported by CmdStore."""
+    date: float
+    user: str
+    trigger: str
+    content: str
+    weight: float = 1.0
+    image_name: Optional[str] = None
+    image_data: Optional[bytes] = None
+    # The size of the image image_data was shrunk from, if it was.
+    image_original_size: Optional[int] = None
+
+
+def _save_responses(conn: sqlite3.Connection, responses: List[Response]) -> List[int]:
+    """Inserts the given responses. Returns their keys, in the same order."""
+    rows = []
+    for r in responses:
+        image_hash = None
+        if r.image_data is not None:
+            image_hash = _store_image(conn, r.image_data, r.image_original_size)
+        rows.append((r.date, r.user, r.trigger, r.content,
+                    image_hash, r.image_name, r.weight))
+
+    new_triggers = {r.trigger for r in responses if conn.execute(
+        '''SELECT 1 FROM commands WHERE trigger=? AND enabled=1 LIMIT 1;''', (r.trigger,)).fetchone() is None}
+
+    # Since every write goes through one connection, nothing else can insert
+    # rows in between, and the new rows are exactly those past the old max.
+    last_key = conn.execute('''SELECT COALESCE(MAX(key), 0) FROM commands;''').fetchone()[0]
+    conn.executemany('''INSERT INTO commands (date, user, trigger, content, enabled, image_hash, image_name, weight) VALUES(?, ?, ?, ?, 1, ?, ?, ?)''',
+                     rows)
+    conn.execute('''INSERT INTO commands_search (rowid, trigger, content) SELECT key, trigger, content FROM commands WHERE key > ?;''',
+                 (last_key,))
+    # Each trigger's name is kept under the key of its first response.
+    for trigger in new_triggers:
+        conn.execute('''INSERT INTO trigger_names (rowid, trigger) SELECT MIN(key), trigger FROM commands WHERE trigger=? AND enabled=1;''',
+                     (trigger,))
+    return [r[0] for r in conn.execute('''SELECT key FROM commands WHERE key > ? ORDER BY key;''', (last_key,))]
+
+
+def _overwrite_responses(conn: sqlite3.Connection, trigger, responses: List[Response], max_existing) -> Optional[List[int]]:
+    """
+    Replaces all of the trigger's responses with the given ones, unless it
+    has more than max_existing of them. Returns the new responses' keys, or
+    None if nothing was replaced.
+    """
+    existing = conn.execute('''SELECT COUNT(*) FROM commands WHERE trigger=? AND enabled=1;''', (trigger,)).fetchone()[0]
+    if existing > max_existing:
+        return None
+    _disable_trigger(conn, trigger)
+    return _save_responses(conn, responses)
+
+
+def _disable_trigger(conn: sqlite3.Connection, trigger):
+    """Disables all of the trigger's responses, and takes them out of the search indexes."""
+    # The search index only stores where its terms are, not the text they
+    # came from, so it has to be told exactly what it's forgetting.
+    conn.execute('''INSERT INTO commands_search (commands_search, rowid, trigger, content) SELECT 'delete', key, trigger, content FROM commands WHERE trigger=? AND enabled=1;''',
+                 (trigger,))
+    conn.execute('''DELETE FROM trigger_names WHERE rowid=(SELECT MIN(key) FROM commands WHERE trigger=? AND enabled=1);''',
+                 (trigger,))
+    conn.execute('''UPDATE commands SET enabled=0 WHERE trigger=?''', (trigger,))
+
+
+def _load_responses_after(conn: sqlite3.Connection, key, limit) -> List[Tuple[int, Response]]:
+    """Returns up to limit enabled responses (and their keys) with keys greater than the given one."""
+    rows = conn.execute('''SELECT c.key, c.date, c.user, c.trigger, c.content, c.weight, c.image_name, c.image_hash, i.original_size FROM commands c LEFT JOIN images i ON i.hash=c.image_hash WHERE c.enabled=1 AND c.key > ? ORDER BY c.key LIMIT ?;''',
+                        (key, limit)).fetchall()
+    responses = []
+    for key, date, user, trigger, content, weight, image_name, image_hash, original_size in rows:
+        image_data = None
+        if image_hash is not None:
+            image = _load_image(conn, image_hash)
+            image_data = image.getvalue() if image is not None else None
+        responses.append(
+            (key, Response(date, user, trigger, content, weight, image_name, image_data, original_size)))
+    return responses
+
+
+def _load_response(conn: sqlite3.Connection, key) -> Tuple[Optional[str], Optional[str], Optional[io.BytesIO], Optional[int]]:
+    """
+    Returns the content, image name, image data and original image size (see
+    _store_image) of the response with the given key.
+    """
+    rows = conn.execute(
+        '''SELECT c.content, c.image_name, c.image_hash, i.original_size FROM commands c LEFT JOIN images i ON i.hash=c.image_hash WHERE c.key=?;''', (key,)).fetchall()
+    if len(rows) == 0:
+        return None, None, None, None
+    content, image_name, image_hash, original_size = rows[0]
+    if image_hash is None:
+        return content, None, None, None
+    return content, image_name, _load_image(conn, image_hash), original_size
+
+
+# Schema migrations.
+#
+# Each database records the number of migrations that have been applied to it
+# in its schema_version table. When a store is opened, any migrations past
+# that point are applied in order, each in its own transaction.
+#
+# Only ever append to these lists. Migrations that have shipped must not be
+# edited or reordered, since databases out there have already applied them.
+
+def _create_commands_table(conn: sqlite3.Connection):
+    conn.execute('''CREATE TABLE IF NOT EXISTS commands (key INTEGER PRIMARY KEY, date REAL, user TEXT, trigger TEXT, content TEXT, enabled INTEGER, image BLOB);''')
+
+
+def _create_images_table(conn: sqlite3.Connection):
+    # Images are stored once each, keyed by the hash of their contents.
+    # Commands rows refer to them by hash. (The image column above only
+    # ever holds images from before this table existed.)
+    conn.execute('''CREATE TABLE IF NOT EXISTS images (hash TEXT PRIMARY KEY, data BLOB);''')
+    columns = [r[1] for r in conn.execute('''PRAGMA table_info(commands);''')]
+    if 'image_hash' not in columns:
+        conn.execute('''ALTER TABLE commands ADD COLUMN image_hash TEXT;''')
+        conn.execute('''ALTER TABLE commands ADD COLUMN image_name TEXT;''')
+    converted, reclaimed = _migrate_legacy_images(conn)
+    if converted > 0:
+        print(f"Moved {converted} images out of the commands table. "
+              f"Reclaimed {reclaimed} bytes of duplicate images.")
+
+
+def _index_commands(conn: sqlite3.Connection):
+    # Covers count and delete, which search by trigger, as well as the
+    # trigger index CmdStore builds when it is opened.
+    conn.execute('''CREATE INDEX IF NOT EXISTS commands_by_trigger ON commands (trigger, enabled);''')
+
+
+def _add_command_weights(conn: sqlite3.Connection):
+    # How likely each response is to be picked, relative to the trigger's
+    # other responses.
+    conn.execute('''ALTER TABLE commands ADD COLUMN weight REAL NOT NULL DEFAULT 1;''')
+
+
+def _fix_text_dates(conn: sqlite3.Connection):
+    # Rows used to be dated with strftime('%s.%f'), which makes text like
+    # '1697500000.45.123' (%f is seconds and milliseconds). Keep the part that
+    # is a number.
+    conn.execute('''UPDATE commands SET date=CAST(date AS REAL) WHERE typeof(date)='text';''')
+
+
+def _add_image_original_sizes(conn: sqlite3.Connection):
+    # NULL for images stored as they were uploaded.
+    conn.execute('''ALTER TABLE images ADD COLUMN original_size INTEGER;''')
+
+
+def _create_search_indexes(conn: sqlite3.Connection):
+    # Full text search over enabled responses, for !find. It reads the text
+    # from the commands table rather than keeping its own copy.
+    conn.execute('''CREATE VIRTUAL TABLE commands_search USING fts5(trigger, content, content='commands', content_rowid='key');''')
+    conn.execute(f'''INSERT INTO commands_search (commands_search, rank) VALUES('rank', 'bm25({SEARCH_TRIGGER_WEIGHT}, 1.0)');''')
+    conn.execute('''INSERT INTO commands_search (rowid, trigger, content) SELECT key, trigger, content FROM commands WHERE enabled=1;''')
+    # Every enabled trigger, split into every three characters, for finding
+    # ones that are spelled like a trigger that doesn't exist. Each is kept
+    # under the key of its first response, so it can be found again to delete.
+    if HAS_TRIGRAM_TOKENIZER:
+        conn.execute('''CREATE VIRTUAL TABLE trigger_names USING fts5(trigger, tokenize='trigram');''')
+    else:
+        conn.execute('''CREATE TABLE trigger_names (trigger TEXT);''')
+    conn.execute('''INSERT INTO trigger_names (rowid, trigger) SELECT MIN(key), trigger FROM commands WHERE enabled=1 GROUP BY trigger;''')
+
+
+def _fix_flair_text_dates(conn: sqlite3.Connection):
+    # See _fix_text_dates.
+    conn.execute('''UPDATE flairs SET date=CAST(date AS REAL) WHERE typeof(date)='text';''')
+
+
+def _create_flairs_table(conn: sqlite3.Connection):
+    conn.execute('''CREATE TABLE IF NOT EXISTS flairs (key INTEGER PRIMARY KEY, date REAL, user TEXT, message_id TEXT, reaction_id TEXT, role_id TEXT, enabled INTEGER);''')
+
+
+def _index_flairs(conn: sqlite3.Connection):
+    # Includes role_id so that FlairStore.get never has to touch the table itself.
+    conn.execute('''CREATE INDEX IF NOT EXISTS flairs_by_reaction ON flairs (message_id, reaction_id, enabled, role_id);''')
+
+
+COMMAND_MIGRATIONS = [
+    _create_commands_table,
+    _create_images_table,
+    _index_commands,
+    _add_command_weights,
+    _fix_text_dates,
+    _add_image_original_sizes,
+    _create_search_indexes,
+]
+
+FLAIR_MIGRATIONS = [
+    _create_flairs_table,
+    _index_flairs,
+    _fix_flair_text_dates,
+]
+
+
+def _migrate(conn: sqlite3.Connection, migrations) -> int:
+    """Applies any of the given migrations that haven't been yet. Returns how many were applied."""
+    with conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (version INTEGER);''')
+        rows = conn.execute('''SELECT version FROM schema_version;''').fetchall()
+        if len(rows) == 0:
+            conn.execute('''INSERT INTO schema_version (version) VALUES(0);''')
+            version = 0
+        else:
+            version = rows[0][0]
+
+    free_pages = conn.execute('''PRAGMA freelist_count;''').fetchone()[0]
+    for i in range(version, len(migrations)):
+        with conn:
+            # sqlite3 only opens transactions implicitly for DML, and we want
+            # schema changes to be rolled back too if a migration fails.
+            conn.execute('''BEGIN;''')
+            migrations[i](conn)
+            conn.execute('''UPDATE schema_version SET version=?;''', (i+1,))
+
+    # Give back any space migrations freed up, like moving images out of the
+    # commands table does. This can't be done inside a transaction, so it
+    # has to happen here rather than in the migrations. Ordinary writes leave
+    # free pages too, but sqlite reuses those, and they aren't worth
+    # rewriting the whole file for every time it's opened.
+    if conn.execute('''PRAGMA freelist_count;''').fetchone()[0] > free_pages:
+        conn.execute('''VACUUM;''')
+    return len(migrations) - min(version, len(migrations))
+
+
+class _Job:
+    """A write waiting for _Writer to apply it."""
+
+    def __init__(self, fn, args, exclusive):
+        self.fn = fn
+        self.args = args
+        self.exclusive = exclusive
+        self.future = concurrent.futures.Future()
+
+
+class _Writer(threading.Thread):
+    """
+    Applies every write to a database, from a single thread and connection.
+
+    Whatever writes are waiting when the writer gets to them (up to
+    GROUP_COMMIT_MAX_WRITES) are applied in one transaction, so a burst of
+    writes shares a single commit. Each write gets its own savepoint, so one
+    failing doesn't undo the others.
+    """
+
+    def __init__(self, connect, name):
+        super().__init__(name=name, daemon=True)
+        self._connect = connect
+        self._jobs = queue.SimpleQueue()
+        # Stats, for benchmarks and the curious.
+        self.commits = 0
+        self.writes = 0
+
+    def submit(self, fn, args, exclusive=False) -> concurrent.futures.Future:
+        """
+        Queues a call to fn(connection, *args).
+
+        Exclusive calls are made on their own, outside of any transaction,
+        for things like migrations that manage transactions themselves.
+        """
+        job = _Job(fn, args, exclusive)
+        self._jobs.put(job)
+        return job.future
+
+    def stop(self):
+        """Applies any writes already queued, then stops the thread."""
+        self._jobs.put(None)
+        self.join()
+
+    def run(self):
+        conn = self._connect()
+        next_job = None
+        while True:
+            job = next_job if next_job is not None else self._jobs.get()
+            next_job = None
+            if job is None:
+                return
+            if job.exclusive:
+                self._run_exclusive(conn, job)
+                continue
+
+            batch = [job]
+            deadline = time.monotonic() + GROUP_COMMIT_WINDOW_SECONDS
+            while len(batch) < GROUP_COMMIT_MAX_WRITES:
+                try:
+                    job = self._jobs.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if job is None or job.exclusive:
+                    # Has to wait until this batch is done.
+                    next_job = job
+                    break
+                batch.append(job)
+            self._run_batch(conn, batch)
+
+    def _run_exclusive(self, conn, job: _Job):
+        try:
+            job.future.set_result(job.fn(conn, *job.args))
+        except Exception as e:
+            job.future.set_exception(e)
+
+    def _run_batch(self, conn, batch: List[_Job]):
+        results = []
+        try:
+            conn.execute('''BEGIN IMMEDIATE;''')
+            for job in batch:
+                conn.execute('''SAVEPOINT job;''')
+                try:
+                    results.append((job.fn(conn, *job.args), None))
+                except Exception as e:
+                    conn.execute('''ROLLBACK TO job;''')
+                    results.append((None, e))
+                conn.execute('''RELEASE job;''')
+            conn.execute('''COMMIT;''')
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute('''ROLLBACK;''')
+            for job in batch:
+                job.future.set_exception(e)
+            return
+
+        self.commits += 1
+        self.writes += len(batch)
+        # Only let anyone know how their write went once it's committed.
+        for job, (result, error) in zip(batch, results):
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+
+
+def _execute(conn: sqlite3.Connection, sql, args):
+    return conn.execute(sql, args).lastrowid
+
+
+class _Database:
+    """
+    Runs sqlite3 statements without blocking the event loop.
+
+    Reads are spread over a small pool of threads, each with its own
+    connection. All writes go through a single writer thread (see _Writer),
+    so sqlite never has two of our connections fighting over the write lock.
+    The database is kept in WAL mode, so reads don't wait on writes either.
+    """
+
+    def __init__(self, sqlite3_db_name, read_pool_size=READ_POOL_SIZE, writer=None):
+        self._name = sqlite3_db_name
+        self._read_pool_size = read_pool_size
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._readers = ThreadPoolExecutor(
+            read_pool_size, thread_name_prefix=f"{sqlite3_db_name}-reader")
+        # Anything with _Writer's submit() and stop() can stand in for it,
+        # like the shards' writer process (see shards.py).
+        self._writer = writer
+        if self._writer is None:
+            # The writer manages its own transactions, so it opens its
+            # connection in autocommit mode.
+            self._writer = _Writer(lambda: self._open(isolation_level=None),
+                                   f"{sqlite3_db_name}-writer")
+            self._writer.start()
+
+    async def read(self, sql, *args):
+        """Returns all rows produced by the given query."""
+        return await asyncio.get_running_loop().run_in_executor(self._readers, self._read, sql, args)
+
+    async def write(self, sql, *args):
+        """Runs and commits the given statement. Returns the id of the last inserted row."""
+        return await self.transaction(_execute, sql, args)
+
+    async def read_with(self, fn, *args):
+        """Calls fn(connection, *args) on a reader thread, and returns the result."""
+        return await asyncio.get_running_loop().run_in_executor(self._readers, self._read_with, fn, args)
+
+    async def transaction(self, fn, *args):
+        """
+        Calls fn(connection, *args) on the writer thread, and returns the result.
+
+        Everything fn does is committed together, or not at all if it raises.
+        """
+        return await asyncio.wrap_future(self.submit(fn, args))
+
+    def submit(self, fn, args, exclusive=False) -> concurrent.futures.Future:
+        """Queues fn(connection, *args) on the writer thread, like transaction, without waiting for it."""
+        return self._writer.submit(fn, args, exclusive)
+
+    async def warm_up(self):
+        """
+        Starts every reader thread and opens its connection (reading the
+        schema), which would otherwise be left to the first reads.
+        """
+        # Each waits for the rest, so every thread in the pool gets one.
+        started = threading.Barrier(self._read_pool_size)
+
+        def warm(conn):
+            conn.execute('''SELECT COUNT(*) FROM sqlite_master;''').fetchall()
+            started.wait()
+        await asyncio.gather(*(self.read_with(warm) for _ in range(self._read_pool_size)))
+
+    # The blocking versions are only meant for use while starting up, before
+    # there is an event loop to stall.
+    def read_blocking(self, sql, *args):
+        return self._readers.submit(self._read, sql, args).result()
+
+    def write_blocking(self, sql, *args):
+        return self.submit(_execute, (sql, args)).result()
+
+    def migrate(self, migrations):
+        """Brings the database's schema up to date. Blocks until finished."""
+        return self.submit(_migrate, (migrations,), exclusive=True).result()
+
+    def close(self):
+        self._writer.stop()
+        self._readers.shutdown()
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+
+    def _read(self, sql, args):
+        return self._connection().execute(sql, args).fetchall()
+
+    def _read_with(self, fn, args):
+        return fn(self._connection(), *args)
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns the calling reader thread's connection, opening one if needed."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+        return conn
+
+    def _open(self, **kwargs) -> sqlite3.Connection:
+        # Each connection is only ever used by the thread that opened it,
+        # but close() runs on whichever thread shuts the store down.
+        conn = sqlite3.connect(self._name, check_same_thread=False, **kwargs)
+        conn.execute(f'''PRAGMA journal_mode={JOURNAL_MODE};''')
+        # In WAL mode, this can only lose the last few commits if the whole
+        # machine goes down, not if the bot crashes. Either way the database
+        # stays consistent.
+        conn.execute('''PRAGMA synchronous=NORMAL;''')
+        # Other processes (like transfer.py) may hold the lock for a moment.
+        conn.execute('''PRAGMA busy_timeout=5000;''')
+        conn.execute('''PRAGMA temp_store=MEMORY;''')
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+
+class SharedWriter:
+    """
+    The writer process's end of a database (see shards.py). Runs the writes
+    the shard processes send it on the database's writer thread, so writes
+    from several shards can share a commit.
+    """
 
-class CmdStore:
     def __init__(self, sqlite3_db_name):
-        self._conn = sqlite3.connect(sqlite3_db_name)
-        self._cursor = self._conn.cursor()
-        self._exec('''CREATE TABLE IF NOT EXISTS commands (key INTEGER PRIMARY KEY, date REAL, user TEXT, trigger TEXT, content TEXT, enabled INTEGER, image BLOB);''')
+        self._db = _Database(sqlite3_db_name)
+
+    def submit(self, fn, args, exclusive=False) -> concurrent.futures.Future:
+        return self._db.submit(fn, args, exclusive)
+
+    def close(self):
+        self._db.close()
+
+
+class CommandSummary(NamedTuple):
+    trigger: str
+    # Who saved the most recent response, and how long ago.
+    user: str
+    elapsed_seconds: float
+    responses: int
+
+
+class SearchResult(NamedTuple):
+    trigger: str
+    # How many of its responses matched (of those that were ranked), and a
+    # bit of the best match, with the matching terms in bold. Triggers found
+    # by name alone have no matches, and an empty snippet.
+    matches: int
+    snippet: str
+    # Lower is better. Triggers found by name rank above the rest.
+    rank: Tuple[int, float]
+
+
+def _search(conn: sqlite3.Connection, text, limit, offset) -> List[SearchResult]:
+    """
+    Returns the triggers named with every word in text first, then the ones
+    with responses that have every word in it, best matches first.
+    """
+    words = re.findall(r'\w+', text.lower())
+    if len(words) == 0:
+        return []
+    wanted = offset + limit
+
+    # The trigram index only finds words of at least three characters, as
+    # part of a name.
+    named = []
+    if all(len(w) >= 3 for w in words):
+        named = _search_names(conn, words, wanted)
+
+    # Words are matched whole. Matching them as prefixes too is several times
+    # slower for common words, and the names above are matched in part anyway.
+    query = ' '.join(f'"{w}"' for w in words)
+    # Ranking is most of the cost of a search, so only the newest matches are
+    # ranked. A word common enough to be in more responses than that doesn't
+    # say much about which are best anyway.
+    oldest = conn.execute('''SELECT rowid FROM commands_search WHERE commands_search MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?;''',
+                          (query, MAX_RANKED_MATCHES - 1)).fetchone()
+    oldest = oldest[0] if oldest is not None else 0
+    # With a single MIN(), SQLite takes the other bare columns (rowid here)
+    # from the row it picked, so this is each trigger's best match.
+    matched = conn.execute('''SELECT trigger, COUNT(*), MIN(rank) AS best, rowid FROM commands_search WHERE commands_search MATCH ? AND rowid >= ? GROUP BY trigger ORDER BY best LIMIT ?;''',
+                           (query, oldest, wanted + len(named))).fetchall()
+
+    results = {}
+    best = {}
+    for trigger, rank in named:
+        results[trigger] = SearchResult(trigger, 0, '', (0, rank))
+    for trigger, matches, rank, key in matched:
+        rank = results[trigger].rank if trigger in results else (1, rank)
+        results[trigger] = SearchResult(trigger, matches, '', rank)
+        best[trigger] = key
+    page = sorted(results.values(), key=lambda r: r.rank)[offset:wanted]
+
+    # snippet() can't be grouped, so it's taken from the best matches again.
+    keys = [best[r.trigger] for r in page if r.trigger in best]
+    snippets = dict(conn.execute(
+        f'''SELECT trigger, snippet(commands_search, 1, '**', '**', '...', 12) FROM commands_search WHERE commands_search MATCH ? AND rowid IN ({', '.join('?' * len(keys))});''',
+        (query, *keys)))
+    return [r._replace(snippet=snippets.get(r.trigger, '')) for r in page]
+
+
+def _search_names(conn: sqlite3.Connection, words, limit) -> List[Tuple[str, float]]:
+    """Returns the triggers whose names contain every word, and their ranks, best matches first."""
+    if _has_trigram_names(conn):
+        return conn.execute('''SELECT trigger, rank FROM trigger_names WHERE trigger_names MATCH ? ORDER BY rank LIMIT ?;''',
+                            (' AND '.join(f'"{w}"' for w in words), limit)).fetchall()
+    # Shorter names are closer matches.
+    conditions = ' AND '.join([f"trigger LIKE ? ESCAPE '{_LIKE_ESCAPE}'"] * len(words))
+    return conn.execute(f'''SELECT trigger, length(trigger) AS rank FROM trigger_names WHERE {conditions} ORDER BY rank LIMIT ?;''',
+                        (*(_containing(w) for w in words), limit)).fetchall()
+
+
+def _suggest(conn: sqlite3.Connection, command, limit) -> List[str]:
+    pieces = sorted({command[i:i + 3] for i in range(len(command) - 2)})
+    if len(pieces) == 0:
+        return []
+    if _has_trigram_names(conn):
+        # The trigram tokenizer matches any trigger containing a quoted piece.
+        query = ' OR '.join('"{}"'.format(p.replace('"', '""')) for p in pieces)
+        candidates = [r[0] for r in conn.execute(
+            '''SELECT trigger FROM trigger_names WHERE trigger_names MATCH ? ORDER BY rank LIMIT ?;''',
+            (query, SUGGESTION_CANDIDATES))]
+    else:
+        # The triggers containing the most pieces.
+        shared = ' + '.join([f"(trigger LIKE ? ESCAPE '{_LIKE_ESCAPE}')"] * len(pieces))
+        likes = [_containing(p) for p in pieces]
+        candidates = [r[0] for r in conn.execute(
+            f'''SELECT trigger FROM trigger_names WHERE {shared} > 0 ORDER BY {shared} DESC LIMIT ?;''',
+            (*likes, *likes, SUGGESTION_CANDIDATES))]
+    return difflib.get_close_matches(command, candidates, limit, SUGGESTION_CUTOFF)
+
+
+_LIKE_ESCAPE = '!'
+
+
+def _containing(text) -> str:
+    """Returns a LIKE pattern matching anything containing text."""
+    for c in (_LIKE_ESCAPE, '%', '_'):
+        text = text.replace(c, _LIKE_ESCAPE + c)
+    return f'%{text}%'
+
+
+def _has_trigram_names(conn: sqlite3.Connection) -> bool:
+    """
+    Returns true iff trigger_names uses the trigram tokenizer, rather than
+    being the plain table made where SQLite didn't have it. The database
+    could have been made by another version of SQLite than this one.
+    """
+    sql = conn.execute('''SELECT sql FROM sqlite_master WHERE name='trigger_names';''').fetchone()
+    return sql is not None and 'trigram' in sql[0]
+
+
+class CommandEngine(Protocol):
+    """
+    Keeps a CmdStore's responses and images, and searches them. The store
+    keeps the index of triggers in memory, and picks responses itself, so an
+    engine only ever has to look responses up by key (or trigger).
+    """
+    # Whether what's saved is still there when the engine is opened again.
+    persistent: bool
+    # Whether the engine indexes trigger names itself. If not, CmdStore picks
+    # suggestions from its own index of triggers, and never calls suggest().
+    indexes_triggers: bool
+
+    @classmethod
+    def last_modified(cls, path) -> Optional[float]:
+        """When the engine's data at path last changed, or None if there's nothing there."""
+        ...
+
+    def load_index(self) -> List[Tuple[int, str, str, float, float]]:
+        """
+        Returns the key, trigger, user, date and weight of every enabled
+        response, by key. Blocks, since it's only called while opening.
+        """
+        ...
+
+    async def save(self, responses: List[Response]) -> List[int]:
+        """Adds the responses. Returns their keys, in the same order."""
+        ...
+
+    async def overwrite(self, trigger, responses: List[Response], max_existing) -> Optional[List[int]]:
+        """See _overwrite_responses."""
+        ...
+
+    async def disable(self, trigger):
+        """Removes all of the trigger's responses."""
+        ...
+
+    async def load_triggers(self, triggers: List[str]) -> List[Tuple[int, str, str, float, float]]:
+        """Like load_index, for the given triggers only."""
+        ...
+
+    async def load_response(self, key) -> Tuple[Optional[str], Optional[str], Optional[io.BytesIO], Optional[int]]:
+        """See _load_response."""
+        ...
+
+    async def load_responses_after(self, key, limit) -> List[Tuple[int, Response]]:
+        """See _load_responses_after."""
+        ...
+
+    async def search(self, text, limit, offset) -> List[SearchResult]:
+        """See _search."""
+        ...
+
+    async def suggest(self, command, limit) -> List[str]:
+        """
+        Returns up to limit triggers that look like command, most alike
+        first. Only called if the engine indexes_triggers.
+        """
+        ...
+
+    async def warm_up(self):
+        ...
+
+    def close(self):
+        ...
+
+
+class FlairEngine(Protocol):
+    """Keeps a FlairStore's flairs. Ids are kept (and returned) as strings."""
+    persistent: bool
+
+    async def save(self, date, username, message_id, reaction_id, role_id):
+        ...
+
+    async def get(self, message_id, reaction_id) -> List[str]:
+        ...
+
+    async def list_flair_messages(self) -> List[Tuple[str, str, str]]:
+        """Returns the message id, reaction id and role id of every flair."""
+        ...
+
+    async def delete(self, message_id, reaction_id):
+        ...
+
+    def close(self):
+        ...
+
+
+class SqliteCommands:
+    """Keeps commands in a sqlite database, with full text search indexes (see _search)."""
+    persistent = True
+    indexes_triggers = True
+
+    def __init__(self, path, writer=None, read_pool_size=READ_POOL_SIZE):
+        self._db = _Database(path, read_pool_size, writer)
+        self._db.migrate(COMMAND_MIGRATIONS)
+
+    @classmethod
+    def last_modified(cls, path) -> Optional[float]:
+        return os.path.getmtime(path) if os.path.exists(path) else None
+
+    def load_index(self):
+        return self._db.read_blocking('''SELECT key, trigger, user, date, weight FROM commands WHERE enabled=1;''')
+
+    async def save(self, responses):
+        return await self._db.transaction(_save_responses, responses)
+
+    async def overwrite(self, trigger, responses, max_existing):
+        return await self._db.transaction(_overwrite_responses, trigger, responses, max_existing)
+
+    async def disable(self, trigger):
+        await self._db.transaction(_disable_trigger, trigger)
+
+    async def load_triggers(self, triggers):
+        rows = []
+        # A chunk at a time, to stay under sqlite's limit on query parameters.
+        for i in range(0, len(triggers), BULK_CHUNK_SIZE):
+            chunk = triggers[i:i + BULK_CHUNK_SIZE]
+            rows += await self._db.read(
+                f'''SELECT key, trigger, user, date, weight FROM commands WHERE enabled=1 AND trigger IN ({', '.join('?' * len(chunk))}) ORDER BY key;''',
+                *chunk)
+        return rows
+
+    async def load_response(self, key):
+        return await self._db.read_with(_load_response, key)
+
+    async def load_responses_after(self, key, limit):
+        return await self._db.read_with(_load_responses_after, key, limit)
+
+    async def search(self, text, limit, offset):
+        return await self._db.read_with(_search, text, limit, offset)
+
+    async def suggest(self, command, limit):
+        return await self._db.read_with(_suggest, command, limit)
+
+    async def warm_up(self):
+        await self._db.warm_up()
+
+    def close(self):
+        self._db.close()
+
+
+class SqliteFlairs:
+    persistent = True
+
+    def __init__(self, path, writer=None):
+        self._db = _Database(path, writer=writer)
+        self._db.migrate(FLAIR_MIGRATIONS)
+
+    async def save(self, date, username, message_id, reaction_id, role_id):
+        await self._db.write('''INSERT INTO flairs (date, user, message_id, reaction_id, role_id, enabled) VALUES(?, ?, ?, ?, ?, 1);''',
+                             date, username, message_id, reaction_id, role_id)
+
+    async def get(self, message_id, reaction_id):
+        rows = await self._db.read(
+            '''SELECT role_id FROM flairs where message_id=? AND reaction_id=? AND enabled=1;''', message_id, reaction_id)
+        return [r[0] for r in rows]
+
+    async def list_flair_messages(self):
+        return await self._db.read('''SELECT message_id, reaction_id, role_id FROM flairs WHERE enabled=1;''')
+
+    async def delete(self, message_id, reaction_id):
+        await self._db.write('''UPDATE flairs SET enabled=0 WHERE message_id=? AND reaction_id=?''',
+                             message_id, reaction_id)
+
+    def close(self):
+        self._db.close()
+
+
+def _words(text) -> List[str]:
+    # Roughly what the search index's tokenizer makes of text.
+    return re.findall(r'\w+', text.lower())
+
+
+def _snippet(content, words, size=12) -> str:
+    """Like sqlite's snippet(): up to size words of content from the first match on, with matches in bold."""
+    tokens = content.split()
+    first = next((i for i, t in enumerate(tokens) if not words.isdisjoint(_words(t))), 0)
+    start = max(0, min(first, len(tokens) - size))
+    end = start + size
+    bolded = [re.sub(r'\w+', lambda m: f'**{m.group()}**' if m.group().lower() in words else m.group(), t)
+              for t in tokens[start:end]]
+    return ('...' if start > 0 else '') + ' '.join(bolded) + ('...' if end < len(tokens) else '')
+
+
+class _KeyValue:
+    """
+    The engines that keep everything in a mapping from strings to picklable
+    values. Only ever used from one thread at a time: the event loop's if
+    executor is None, or else the executor's (which must have only one).
+    """
+
+    def __init__(self, mapping, executor: Optional[ThreadPoolExecutor]):
+        self._map = mapping
+        self._executor = executor
+
+    async def _call(self, fn, *args):
+        if self._executor is None:
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
 
-    def save(self, username, command, content, image=None):
+    def _call_blocking(self, fn, *args):
+        if self._executor is None:
+            return fn(*args)
+        return self._executor.submit(fn, *args).result()
+
+    def _sync(self):
+        """Called after every change."""
+        pass
+
+
+class _KeyValueCommands(_KeyValue):
+    """
+    Keeps commands as:
+
+        'next'       the key the next response saved gets
+        'r<key>'     each enabled response, as (date, user, trigger, content,
+                     weight, image name, image hash)
+        't<trigger>' the keys of each trigger's enabled responses
+        'i<hash>'    each image's data and original size
+
+    so summoning a response is a single lookup, and an image one more.
+    Disabled responses are deleted outright. There's no search index, so
+    searches read every response, and CmdStore suggests triggers itself.
+    """
+    indexes_triggers = False
+
+    def _rows(self, triggers) -> List[Tuple[int, str, str, float, float]]:
+        rows = []
+        for trigger in triggers:
+            for key in self._map.get('t' + trigger, []):
+                date, user, _, _, weight, _, _ = self._map[f'r{key}']
+                rows.append((key, trigger, user, date, weight))
+        rows.sort()
+        return rows
+
+    def _triggers(self) -> List[str]:
+        return [k[1:] for k in self._map.keys() if k.startswith('t')]
+
+    def load_index(self):
+        return self._call_blocking(lambda: self._rows(self._triggers()))
+
+    def _save(self, responses):
+        key = self._map.get('next', 1)
+        keys = []
+        added: Dict[str, List[int]] = {}
+        for r in responses:
+            image_hash = None
+            if r.image_data is not None:
+                image_hash = _image_hash(r.image_data)
+                if 'i' + image_hash not in self._map:
+                    self._map['i' + image_hash] = (r.image_data, r.image_original_size)
+            self._map[f'r{key}'] = (r.date, r.user, r.trigger, r.content, r.weight, r.image_name, image_hash)
+            added.setdefault(r.trigger, []).append(key)
+            keys.append(key)
+            key += 1
+        # Responses are only found through their trigger's keys, and 'next'
+        # only moves past them once they're all there, so a save that's cut
+        # short leaves nothing behind that the next one won't overwrite.
+        for trigger, new in added.items():
+            self._map['t' + trigger] = self._map.get('t' + trigger, []) + new
+        self._map['next'] = key
+        self._sync()
+        return keys
+
+    async def save(self, responses):
+        return await self._call(self._save, responses)
+
+    def _disable(self, trigger):
+        keys = self._map.pop('t' + trigger, [])
+        for key in keys:
+            # Images are kept, as sqlite keeps them.
+            del self._map[f'r{key}']
+        self._sync()
+
+    def _overwrite(self, trigger, responses, max_existing):
+        if len(self._map.get('t' + trigger, [])) > max_existing:
+            return None
+        self._disable(trigger)
+        return self._save(responses)
+
+    async def overwrite(self, trigger, responses, max_existing):
+        return await self._call(self._overwrite, trigger, responses, max_existing)
+
+    async def disable(self, trigger):
+        await self._call(self._disable, trigger)
+
+    async def load_triggers(self, triggers):
+        return await self._call(self._rows, triggers)
+
+    def _image(self, image_hash) -> Tuple[Optional[bytes], Optional[int]]:
+        if image_hash is None:
+            return None, None
+        return self._map.get('i' + image_hash, (None, None))
+
+    def _load_response(self, key):
+        record = self._map.get(f'r{key}')
+        if record is None:
+            return None, None, None, None
+        _, _, _, content, _, image_name, image_hash = record
+        data, original_size = self._image(image_hash)
+        if data is None:
+            return content, None, None, None
+        return content, image_name, io.BytesIO(data), original_size
+
+    async def load_response(self, key):
+        return await self._call(self._load_response, key)
+
+    def _load_responses_after(self, key, limit):
+        responses = []
+        last = self._map.get('next', 1)
+        while len(responses) < limit and key + 1 < last:
+            key += 1
+            record = self._map.get(f'r{key}')
+            if record is None:
+                continue
+            date, user, trigger, content, weight, image_name, image_hash = record
+            data, original_size = self._image(image_hash)
+            responses.append(
+                (key, Response(date, user, trigger, content, weight, image_name, data, original_size)))
+        return responses
+
+    async def load_responses_after(self, key, limit):
+        return await self._call(self._load_responses_after, key, limit)
+
+    def _search(self, text, limit, offset):
+        """Finds the same triggers as _search, in roughly the same order."""
+        words = set(_words(text))
+        if len(words) == 0:
+            return []
+        wanted = offset + limit
+
+        results = {}
+        if all(len(w) >= 3 for w in words):
+            for trigger in self._triggers():
+                name = trigger.lower()
+                if all(w in name for w in words):
+                    # Shorter names are closer matches.
+                    results[trigger] = SearchResult(trigger, 0, '', (0, len(trigger)))
+
+        # As with sqlite, only the newest matches are ranked.
+        matched: Dict[str, List] = {}
+        ranked = 0
+        key = self._map.get('next', 1)
+        while key > 1 and ranked < MAX_RANKED_MATCHES:
+            key -= 1
+            record = self._map.get(f'r{key}')
+            if record is None:
+                continue
+            trigger, content = record[2], record[3]
+            in_trigger = _words(trigger)
+            in_content = _words(content)
+            if not words <= set(in_trigger) | set(in_content):
+                continue
+            ranked += 1
+            # The share of each column's words that were searched for.
+            score = sum(w in words for w in in_content) / len(in_content) if in_content else 0
+            if in_trigger:
+                score += SEARCH_TRIGGER_WEIGHT * sum(w in words for w in in_trigger) / len(in_trigger)
+            m = matched.setdefault(trigger, [0, 0.0, key])
+            m[0] += 1
+            if -score < m[1]:
+                m[1], m[2] = -score, key
+
+        best = {}
+        for trigger, (matches, rank, key) in matched.items():
+            rank = results[trigger].rank if trigger in results else (1, rank)
+            results[trigger] = SearchResult(trigger, matches, '', rank)
+            best[trigger] = key
+        page = sorted(results.values(), key=lambda r: r.rank)[offset:wanted]
+        return [r._replace(snippet=_snippet(self._map[f'r{best[r.trigger]}'][3], words)) if r.trigger in best else r
+                for r in page]
+
+    async def search(self, text, limit, offset):
+        return await self._call(self._search, text, limit, offset)
+
+    async def warm_up(self):
+        pass
+
+
+class _KeyValueFlairs(_KeyValue):
+    """
+    Keeps flairs as 'f<message id> <reaction id>', mapped to the (date,
+    user, role id) of each flair on that reaction, so getting a reaction's
+    roles is a single lookup.
+    """
+
+    def _save(self, date, username, message_id, reaction_id, role_id):
+        key = f'f{message_id} {reaction_id}'
+        # Stored as text, as sqlite stores them.
+        self._map[key] = self._map.get(key, []) + [(date, username, str(role_id))]
+        self._sync()
+
+    async def save(self, date, username, message_id, reaction_id, role_id):
+        await self._call(self._save, date, username, message_id, reaction_id, role_id)
+
+    def _get(self, message_id, reaction_id):
+        return [role_id for _, _, role_id in self._map.get(f'f{message_id} {reaction_id}', [])]
+
+    async def get(self, message_id, reaction_id):
+        return await self._call(self._get, message_id, reaction_id)
+
+    def _list_flair_messages(self):
+        flairs = []
+        for key in self._map.keys():
+            # Message ids are numbers, so the first space ends them.
+            message_id, reaction_id = key[1:].split(' ', 1)
+            flairs += [(message_id, reaction_id, role_id) for _, _, role_id in self._map[key]]
+        return flairs
+
+    async def list_flair_messages(self):
+        return await self._call(self._list_flair_messages)
+
+    def _delete(self, message_id, reaction_id):
+        self._map.pop(f'f{message_id} {reaction_id}', None)
+        self._sync()
+
+    async def delete(self, message_id, reaction_id):
+        await self._call(self._delete, message_id, reaction_id)
+
+
+def _no_writer(writer):
+    if writer is not None:
+        raise ValueError("Only the sqlite engine can share a writer.")
+
+
+class MemoryCommands(_KeyValueCommands):
+    """Keeps commands in a dict, for tests and trying things out. Nothing is saved."""
+    persistent = False
+
+    def __init__(self, path=None, writer=None, read_pool_size=None):
+        _no_writer(writer)
+        super().__init__({}, None)
+
+    @classmethod
+    def last_modified(cls, path) -> Optional[float]:
+        return None
+
+    def close(self):
+        pass
+
+
+class MemoryFlairs(_KeyValueFlairs):
+    persistent = False
+
+    def __init__(self, path=None, writer=None):
+        _no_writer(writer)
+        super().__init__({}, None)
+
+    def close(self):
+        pass
+
+
+def dbm_available() -> bool:
+    """Whether the dbm engine can be used. It needs Python built with gdbm or ndbm."""
+    return _fast_dbm is not None
+
+
+def dbm_path(path) -> str:
+    """Where the dbm engine keeps what the sqlite engine would keep at path (plus any suffixes dbm adds)."""
+    return os.path.splitext(path)[0] + '.dbm'
+
+
+class _Shelf:
+    """Opens a shelf (a dbm file of pickles) on a thread of its own, and closes it there."""
+
+    def __init__(self, path):
+        if not dbm_available():
+            raise RuntimeError("The dbm storage engine needs Python built with gdbm or ndbm (dbm.gnu or dbm.ndbm).")
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix=f"{path}-dbm")
+        self._shelf = self._executor.submit(
+            lambda: shelve.Shelf(_fast_dbm.open(dbm_path(path), 'c'), pickle.HIGHEST_PROTOCOL)).result()
+
+    @classmethod
+    def last_modified(cls, path) -> Optional[float]:
+        files = glob.glob(glob.escape(dbm_path(path)) + '*')
+        return max(os.path.getmtime(f) for f in files) if files else None
+
+    def _sync(self):
+        # Every change is written out before it's acknowledged, as sqlite's are.
+        self._shelf.sync()
+
+    def close(self):
+        self._executor.submit(self._shelf.close).result()
+        self._executor.shutdown()
+
+
+class DbmCommands(_Shelf, _KeyValueCommands):
+    """
+    Keeps commands in a dbm file. Summons are point lookups, which dbm does
+    well, but searches read every response, and there are no transactions:
+    a save that's cut short may be lost, though it won't leave anything
+    half-saved behind.
+    """
+    persistent = True
+
+    def __init__(self, path, writer=None, read_pool_size=None):
+        _no_writer(writer)
+        _Shelf.__init__(self, path)
+        _KeyValueCommands.__init__(self, self._shelf, self._executor)
+
+
+class DbmFlairs(_Shelf, _KeyValueFlairs):
+    persistent = True
+
+    def __init__(self, path, writer=None):
+        _no_writer(writer)
+        _Shelf.__init__(self, path)
+        _KeyValueFlairs.__init__(self, self._shelf, self._executor)
+
+
+# The command and flair engine for each engine name.
+ENGINES = {
+    SQLITE_ENGINE: (SqliteCommands, SqliteFlairs),
+    MEMORY_ENGINE: (MemoryCommands, MemoryFlairs),
+    DBM_ENGINE: (DbmCommands, DbmFlairs),
+}
+
+
+def _engine_classes(engine) -> Tuple[type, type]:
+    if engine not in ENGINES:
+        raise ValueError(f"No storage engine named {engine!r}. Pick one of {', '.join(ENGINES)}.")
+    return ENGINES[engine]
+
+
+class _AliasTable:
+    """
+    Picks indexes at random, in proportion to the given weights.
+
+    Uses Vose's alias method: building the table takes O(n), but every pick
+    afterwards takes constant time, no matter how many weights there are.
+    """
+
+    def __init__(self, weights: List[float]):
+        n = len(weights)
+        total = sum(weights)
+        scaled = [w * n / total for w in weights]
+        self._probability = [1.0] * n
+        self._alias = list(range(n))
+
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self._probability[s] = scaled[s]
+            self._alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            if scaled[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+        # Anything left over is (give or take rounding errors) exactly 1, and
+        # keeps the defaults set above.
+
+    def pick(self) -> int:
+        i = random.randrange(len(self._alias))
+        if random.random() < self._probability[i]:
+            return i
+        return self._alias[i]
+
+
+class _Trigger:
+    """Everything CmdStore keeps in memory about one trigger."""
+
+    def __init__(self):
+        # The keys of the trigger's enabled responses, and their weights.
+        self.keys: List[int] = []
+        self.weights: List[float] = []
+        # Who saved the most recent response, and when.
+        self.user = None
+        self.date = 0.0
+        # Built the first time it's needed after responses change.
+        self._sampler: Optional[_AliasTable] = None
+
+    def add(self, key, user, date, weight):
+        self.keys.append(key)
+        self.weights.append(weight)
+        self._sampler = None
+        if date >= self.date:
+            self.user = user
+            self.date = date
+
+    def pick(self) -> int:
+        """Returns the key of a response, picked at random according to the response weights."""
+        if self._sampler is None:
+            self._sampler = _AliasTable(self.weights)
+        return self.keys[self._sampler.pick()]
+
+
+def _pieces(trigger) -> Set[str]:
+    return {trigger[i:i + 3].lower() for i in range(len(trigger) - 2)}
+
+
+class _TriggerPieces:
+    """
+    Maps every piece of three characters to the triggers with it in them,
+    so CmdStore can suggest triggers for engines without an index of their
+    own, without looking at every trigger.
+    """
+
+    def __init__(self):
+        self._triggers: Dict[str, Set[str]] = {}
+
+    def add(self, trigger):
+        for piece in _pieces(trigger):
+            self._triggers.setdefault(piece, set()).add(trigger)
+
+    def remove(self, trigger):
+        for piece in _pieces(trigger):
+            triggers = self._triggers.get(piece)
+            if triggers is not None:
+                triggers.discard(trigger)
+                if not triggers:
+                    del self._triggers[piece]
+
+    def suggest(self, command, limit) -> List[str]:
+        shared: Dict[str, int] = {}
+        for piece in _pieces(command):
+            for trigger in self._triggers.get(piece, ()):
+                shared[trigger] = shared.get(trigger, 0) + 1
+        candidates = sorted(shared, key=lambda t: (-shared[t], t))[:SUGGESTION_CANDIDATES]
+        return difflib.get_close_matches(command, candidates, limit, SUGGESTION_CUTOFF)
+
+
+class _Gate:
+    """
+    Lets any number of shared holders in at once, or one exclusive holder,
+    but never both.
+    """
+
+    def __init__(self):
+        self._cond = asyncio.Condition()
+        self._shared = 0
+        self._exclusive = False
+
+    @contextlib.asynccontextmanager
+    async def shared(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self._exclusive)
+            self._shared += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._shared -= 1
+                self._cond.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: not self._exclusive and self._shared == 0)
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
+
+
+class CmdStore:
+    def __init__(self, db_name, writer=None, read_pool_size=READ_POOL_SIZE, engine=SQLITE_ENGINE):
+        """
+        Opens the commands in db_name, kept by the named engine (see ENGINES).
+        Only the sqlite engine can share a writer, or use more than one thread
+        to read.
+        """
+        self._engine: CommandEngine = _engine_classes(engine)[0](db_name, writer, read_pool_size)
+
+        # Maps each enabled trigger to its responses' keys and a summary of
+        # its history, so summons never have to search (or sort) the commands
+        # table, and listing commands doesn't have to read it at all.
+        # Kept in sync by save() and delete(), and by reload() for changes
+        # made elsewhere.
+        self._triggers: Dict[str, _Trigger] = {}
+        # Triggers with a tombstone (see hide()) rather than responses.
+        self._hidden: Set[str] = set()
+        # Only kept for engines that can't suggest triggers themselves.
+        self._pieces = None if self._engine.indexes_triggers else _TriggerPieces()
+        for key, trigger, user, date, weight in self._engine.load_index():
+            self._index(key, trigger, user, date, weight)
+
+        # Goes up every time a command changes, so callers can tell when
+        # anything they've cached from list_commands() is out of date.
+        self.version = 0
+
+        # Called with the triggers changed, after every change made through
+        # this store.
+        self.listeners: List[Callable[[List[str]], None]] = []
+
+        # Writes hold this shared from before they start until the index is
+        # updated, and reload() holds it exclusively. Otherwise a reload could
+        # read the database before one of our writes commits, and then replace
+        # the index after that write updated it, losing the write.
+        self._index_gate = _Gate()
+
+    async def for_guild(self, guild_id) -> 'CmdStore':
+        """A single store holds every guild's commands. See GuildCmdStores to keep them apart."""
+        return self
+
+    def __contains__(self, command) -> bool:
+        return command in self._triggers
+
+    def hides(self, command) -> bool:
+        """Returns true iff the command has a tombstone (see hide())."""
+        return command in self._hidden
+
+    def _index(self, key, trigger, user, date, weight):
+        if user == HIDDEN_BY:
+            self._hidden.add(trigger)
+            return
+        if trigger not in self._triggers:
+            self._triggers[trigger] = _Trigger()
+            if self._pieces is not None:
+                self._pieces.add(trigger)
+        self._triggers[trigger].add(key, user, date, weight)
+
+    def _unindex(self, trigger):
+        if self._triggers.pop(trigger, None) is not None and self._pieces is not None:
+            self._pieces.remove(trigger)
+        self._hidden.discard(trigger)
+
+    async def warm_up(self, guild_ids: Iterable[int] = ()):
+        """
+        Gets ready to answer the first summons as fast as the rest. The index
+        is loaded when the store is opened, so this only opens connections.
+        """
+        await self._engine.warm_up()
+
+    @metrics.timed(STORAGE_SECONDS, method='CmdStore.save')
+    async def save(self, username, command, content, image: Optional[discord.File] = None, weight=1.0,
+                   original_image_size: Optional[int] = None):
+        """
+        Adds a response to the given command.
+
+        If the command has several responses, each summon picks one at random,
+        with a chance proportional to its weight. If the image was shrunk
+        before saving it, original_image_size is how big it used to be.
+        """
+        image_name, image_data = None, None
         if image is not None:
-            image = _discord_file_to_bytes(image)
-        self._exec('''INSERT INTO commands (date, user, trigger, content, enabled, image) VALUES(strftime('%s.%f', 'now'), ?, ?, ?, 1, ?)''',
-                   username, command, content, image)
+            image_name, image_data = image.filename, image.fp.read()
+        await self.save_many([Response(time.time(), username, command, content, weight,
+                                       image_name, image_data, original_image_size)])
 
-    def get(self, command) -> Tuple[str, Optional[discord.File]]:
-        rows = self._read(
-            '''SELECT content, image FROM commands where trigger=? AND enabled=1 ORDER BY RANDOM() LIMIT 1;''', command)
-        if len(rows) == 0:
+    @metrics.timed(STORAGE_SECONDS, method='CmdStore.save_many')
+    async def save_many(self, responses: Iterable[Response], chunk_size=BULK_CHUNK_SIZE) -> int:
+        """
+        Saves all of the given responses, committing once per chunk_size of
+        them rather than once each. Returns how many were saved.
+
+        The responses are read lazily, so this can import more of them than
+        fit in memory.
+        """
+        saved = 0
+        chunk = []
+        for r in responses:
+            if not (r.weight > 0 and math.isfinite(r.weight)):
+                raise ValueError(f"Response weights must be positive, not {r.weight}.")
+            chunk.append(r)
+            if len(chunk) >= chunk_size:
+                saved += await self._save_chunk(chunk)
+                chunk = []
+        if len(chunk) > 0:
+            saved += await self._save_chunk(chunk)
+        return saved
+
+    @metrics.timed(STORAGE_SECONDS, method='CmdStore.overwrite')
+    async def overwrite(self, username, command, content, image: Optional[discord.File] = None, max_existing=1,
+                        original_image_size: Optional[int] = None) -> bool:
+        """
+        Replaces all of the command's responses with the given one, all in one
+        transaction. Does nothing if the command has more than max_existing
+        responses. Returns true iff the command was overwritten.
+        """
+        image_name, image_data = None, None
+        if image is not None:
+            image_name, image_data = image.filename, image.fp.read()
+        date = time.time()
+        async with self._index_gate.shared():
+            keys = await self._engine.overwrite(
+                command,
+                [Response(date, username, command, content, 1.0, image_name, image_data, original_image_size)],
+                max_existing)
+            if keys is None:
+                return False
+
+            self._unindex(command)
+            self._index(keys[0], command, username, date, 1.0)
+        self._changed([command])
+        return True
+
+    async def _save_chunk(self, chunk: List[Response]) -> int:
+        async with self._index_gate.shared():
+            keys = await self._engine.save(chunk)
+            for key, r in zip(keys, chunk):
+                self._index(key, r.trigger, r.user, r.date, r.weight)
+        self._changed(sorted({r.trigger for r in chunk}))
+        return len(keys)
+
+    def _changed(self, triggers: List[str]):
+        self.version += 1
+        for listener in self.listeners:
+            listener(triggers)
+
+    async def reload(self, triggers: Iterable[str]):
+        """
+        Rereads the given triggers from the database, for when they were
+        changed by something other than this store.
+        """
+        triggers = list(triggers)
+        async with self._index_gate.exclusive():
+            rows = await self._engine.load_triggers(triggers)
+            for t in triggers:
+                self._unindex(t)
+            for key, trigger, user, date, weight in rows:
+                self._index(key, trigger, user, date, weight)
+        self.version += 1
+
+    async def export_trigger(self, command) -> List[Response]:
+        """Returns every enabled response to the given command, oldest first."""
+        responses = []
+        for key, trigger, user, date, weight in sorted(await self._engine.load_triggers([command])):
+            content, image_name, image_data, original_size = await self._engine.load_response(key)
+            if image_data is not None:
+                image_data = image_data.getvalue()
+            responses.append(Response(date, user, trigger, content, weight, image_name, image_data, original_size))
+        return responses
+
+    async def export_commands(self, chunk_size=BULK_CHUNK_SIZE) -> AsyncIterator[Response]:
+        """Yields every enabled response, oldest first, reading chunk_size of them at a time."""
+        last_key = 0
+        while True:
+            chunk = await self._engine.load_responses_after(last_key, chunk_size)
+            for last_key, r in chunk:
+                yield r
+            if len(chunk) < chunk_size:
+                return
+
+    @metrics.timed(STORAGE_SECONDS, method='CmdStore.get')
+    async def get(self, command) -> Tuple[str, Optional[discord.File]]:
+        trigger = self._triggers.get(command)
+        if trigger is None:
             return "", None
 
+        content, image_name, image_data, original_size = await self._engine.load_response(trigger.pick())
+        if content is None:
+            return "", None
+        if original_size is not None:
+            SUMMON_IMAGE_BYTES_SAVED.labels().inc(original_size - len(image_data.getbuffer()))
+
         # Convert image into discord's format, if it is present.
-        image = rows[0][1]
-        if image is not None:
-            image = _bytes_to_discord_file(image)
-        return rows[0][0], image
+        image = None
+        if image_data is not None:
+            # If the filename does not end with a image format, discord will not preview the image.
+            # It doesn't actually matter if the image is a .png or not, discord will still preview it lol.
+            image = discord.File(image_data, filename=image_name)
+        return content, image
 
-    def list_commands(self):
-        return self._read(
-            '''SELECT trigger, user, (strftime('%s.%f')-date) FROM commands WHERE enabled=1 GROUP BY trigger ORDER BY trigger;''')
+    @metrics.timed(STORAGE_SECONDS, method='CmdStore.list_commands')
+    async def list_commands(self) -> List[CommandSummary]:
+        now = time.time()
+        return [CommandSummary(name, t.user, now - t.date, len(t.keys))
+                for name, t in sorted(self._triggers.items())]
 
-    def count(self, command):
-        rows = self._read(
-            '''SELECT COUNT(*) FROM commands where trigger=? AND enabled=1;''', command)
-        if len(rows) == 0:
+    @metrics.timed(STORAGE_SECONDS, method='CmdStore.count')
+    async def count(self, command):
+        trigger = self._triggers.get(command)
+        if trigger is None:
             return 0
-        return int(rows[0][0])
+        return len(trigger.keys)
+
+    @metrics.timed(STORAGE_SECONDS, method='CmdStore.search')
+    async def search(self, text, limit, offset=0) -> List[SearchResult]:
+        """
+        Returns the triggers whose names contain every word in text, then the
+        ones with responses that have every word in text (matched whole),
+        best matches first.
+        """
+        return await self._engine.search(text, limit, offset)
+
+    @metrics.timed(STORAGE_SECONDS, method='CmdStore.suggest')
+    async def suggest(self, command, limit) -> List[str]:
+        """
+        Returns up to limit triggers spelled like the given one, most alike
+        first. Triggers shorter than three characters are never suggested.
+        """
+        if self._pieces is not None:
+            return self._pieces.suggest(command, limit)
+        return await self._engine.suggest(command, limit)
+
+    @metrics.timed(STORAGE_SECONDS, method='CmdStore.delete')
+    async def delete(self, command):
+        async with self._index_gate.shared():
+            await self._engine.disable(command)
+            self._unindex(command)
+        self._changed([command])
+
+    async def hide(self, command):
+        """
+        Replaces the command's responses with a tombstone, which GuildCommands
+        takes to mean the global command of the same name is hidden.
+        """
+        await self.overwrite(HIDDEN_BY, command, '', max_existing=math.inf)
+
+    @property
+    def persistent(self) -> bool:
+        return self._engine.persistent
+
+    def close(self):
+        self._engine.close()
+
+
+def partition_path(data_dir, guild_id: Optional[int]) -> str:
+    """Returns the database holding the given guild's commands, or the global ones if guild_id is None."""
+    name = GLOBAL_PARTITION_NAME if guild_id is None else str(int(guild_id))
+    return os.path.join(data_dir, f"{name}.db")
+
+
+def migrate_to_partitions(legacy_db_name, data_dir) -> bool:
+    """
+    Makes the commands database from before commands were partitioned by guild
+    the global partition, unless there already is one. Returns true iff it was
+    moved.
 
-    def delete(self, command):
-        self._exec('''UPDATE commands SET enabled=0 WHERE trigger=?''', command)
+    Nothing can have either database open while this runs.
+    """
+    global_path = partition_path(data_dir, None)
+    if not os.path.exists(legacy_db_name) or os.path.exists(global_path):
+        return False
+    os.makedirs(data_dir, exist_ok=True)
+    # Leaving WAL mode folds the log back into the database, so there's only
+    # the one file to move. It's switched back on when the store opens it.
+    conn = sqlite3.connect(legacy_db_name)
+    try:
+        conn.execute('''PRAGMA journal_mode=DELETE;''')
+    finally:
+        conn.close()
+    os.replace(legacy_db_name, global_path)
+    return True
 
-    def _exec(self, sql_str, *args):
-        self._cursor.execute(sql_str, args)
-        self._conn.commit()
 
-    def _read(self, sql, *args):
-        self._cursor.execute(sql, args)
-        return self._cursor.fetchall()
+class GuildCommands:
+    """
+    The commands a guild can use: its own, and any global ones it hasn't
+    replaced or hidden. Changes only ever touch the guild's own. Adding
+    responses to a global command copies its responses into the guild's own
+    first, so they aren't lost. Deleting a global command hides it (see
+    CmdStore.hide), so only that guild stops answering.
 
-    def __del__(self):
-        self._conn.close()
+    own is None until the guild first changes something, so guilds that only
+    use global commands never get a database of their own. open_own() opens
+    (or makes) it.
+
+    Can be used in place of a CmdStore, apart from reload() and bulk exports.
+    """
+
+    def __init__(self, own: Optional[CmdStore], shared: CmdStore, open_own: Callable[[], Awaitable[CmdStore]]):
+        self._own = own
+        self._shared = shared
+        self._open_own = open_own
+
+    @property
+    def version(self):
+        return (self._own.version if self._own is not None else None), self._shared.version
+
+    def _owns(self, command) -> bool:
+        """Returns true iff the guild's own version of the command, or its tombstone, replaces the global one."""
+        return self._own is not None and (command in self._own or self._own.hides(command))
+
+    def _store_for(self, command) -> CmdStore:
+        return self._own if self._owns(command) else self._shared
+
+    def __contains__(self, command) -> bool:
+        return command in self._store_for(command)
+
+    async def get(self, command) -> Tuple[str, Optional[discord.File]]:
+        return await self._store_for(command).get(command)
+
+    async def count(self, command):
+        return await self._store_for(command).count(command)
+
+    async def list_commands(self) -> List[CommandSummary]:
+        own = await self._own.list_commands() if self._own is not None else []
+        shared = [c for c in await self._shared.list_commands() if not self._owns(c.trigger)]
+        return sorted(own + shared)
+
+    async def search(self, text, limit, offset=0) -> List[SearchResult]:
+        # Both have to be searched up to the end of the page, since either
+        # could have all of the best matches. (Their rankings aren't quite
+        # comparable, but they're close enough.) Tombstones are searched like
+        # any other response, so they're left out here.
+        own = []
+        if self._own is not None:
+            own = [r for r in await self._own.search(text, offset + limit) if r.trigger in self._own]
+        shared = [r for r in await self._shared.search(text, offset + limit) if not self._owns(r.trigger)]
+        return sorted(own + shared, key=lambda r: r.rank)[offset:offset + limit]
+
+    async def suggest(self, command, limit) -> List[str]:
+        own = []
+        if self._own is not None:
+            own = [t for t in await self._own.suggest(command, limit) if t in self._own]
+        shared = [t for t in await self._shared.suggest(command, limit) if not self._owns(t)]
+        return difflib.get_close_matches(command, set(own + shared), limit, SUGGESTION_CUTOFF)
+
+    async def _own_store(self) -> CmdStore:
+        if self._own is None:
+            self._own = await self._open_own()
+        return self._own
+
+    async def _adopt(self, command) -> CmdStore:
+        """
+        Gets the guild's own store ready for responses to be added to the
+        command, and returns it. A global command's responses are copied into
+        it first, and a hidden one's tombstone is dropped, so it starts afresh.
+        """
+        own = await self._own_store()
+        if own.hides(command):
+            await own.delete(command)
+        elif command not in own and command in self._shared:
+            await own.save_many(await self._shared.export_trigger(command))
+        return own
+
+    async def save(self, username, command, *args, **kwargs):
+        own = await self._adopt(command)
+        return await own.save(username, command, *args, **kwargs)
+
+    async def save_many(self, responses: Iterable[Response], *args, **kwargs) -> int:
+        # Every trigger has to be adopted before its responses are saved,
+        # so unlike CmdStore.save_many, this reads all of them up front.
+        responses = list(responses)
+        for command in sorted({r.trigger for r in responses}):
+            await self._adopt(command)
+        return await (await self._own_store()).save_many(responses, *args, **kwargs)
+
+    async def overwrite(self, username, command, *args, max_existing=1, **kwargs) -> bool:
+        if not self._owns(command) and await self._shared.count(command) > max_existing:
+            return False
+        own = await self._own_store()
+        return await own.overwrite(username, command, *args, max_existing=max_existing, **kwargs)
+
+    async def delete(self, command):
+        if command in self._shared:
+            # Replaces the guild's own version too, if it has one.
+            own = await self._own_store()
+            if not own.hides(command):
+                await own.hide(command)
+        elif self._own is not None:
+            await self._own.delete(command)
+
+
+@dataclass
+class _Partition:
+    store: CmdStore
+    last_used: float
+
+
+class GuildCmdStores:
+    """
+    Commands, partitioned by guild. Each guild's are in their own database
+    under data_dir (see partition_path), so summons and listings only ever
+    touch that guild's index, and its database only has that guild's rows.
+
+    A guild's database is opened, and its index loaded, the first time it's
+    used, and closed again once the guild has been idle for idle_seconds.
+    It's only made when the guild first changes a command, so guilds that
+    only use global commands don't get one. The global partition is always
+    open.
+
+    writer_for(path), if given, returns the writer each database should use
+    in place of its own (see shards.py). Partitions kept by an engine that
+    isn't persistent are never closed, since their commands would be lost.
+    """
+
+    def __init__(self, data_dir, writer_for: Optional[Callable] = None, max_open=MAX_OPEN_PARTITIONS,
+                 idle_seconds=PARTITION_IDLE_SECONDS, clock=time.monotonic, engine=SQLITE_ENGINE):
+        os.makedirs(data_dir, exist_ok=True)
+        self._data_dir = data_dir
+        self._writer_for = writer_for
+        self._engine = engine
+        self._engine_class = _engine_classes(engine)[0]
+        self._max_open = max_open
+        self._idle_seconds = idle_seconds
+        self._clock = clock
+
+        # Called with the guild id (None for the global partition) and the
+        # triggers changed, after every change made through these stores.
+        self.listeners: List[Callable[[Optional[int], List[str]], None]] = []
+
+        self.shared = self._open(None)
+        # The open guild partitions, least recently used first.
+        self._partitions: 'OrderedDict[int, _Partition]' = OrderedDict()
+        # Partitions being opened, so concurrent uses only open them once.
+        self._opening: Dict[int, asyncio.Future] = {}
+        # Guilds known not to have a partition, so summons there don't have to
+        # look for one every time.
+        self._without_partition: Set[int] = set()
+
+    def _open(self, guild_id: Optional[int]) -> CmdStore:
+        path = partition_path(self._data_dir, guild_id)
+        writer = self._writer_for(path) if self._writer_for is not None else None
+        if guild_id is None:
+            store = CmdStore(path, writer, engine=self._engine)
+        else:
+            store = CmdStore(path, writer, PARTITION_READ_POOL_SIZE, self._engine)
+        store.listeners.append(lambda triggers: self._changed(guild_id, triggers))
+        return store
+
+    def _changed(self, guild_id: Optional[int], triggers: List[str]):
+        for listener in self.listeners:
+            listener(guild_id, triggers)
+
+    async def for_guild(self, guild_id: Optional[int]):
+        """
+        Returns the commands the guild can use, as a GuildCommands. Messages
+        from outside any guild (guild_id None) only get the global commands.
+        """
+        if guild_id is None:
+            return self.shared
+        return GuildCommands(await self.partition(guild_id, create=False), self.shared,
+                             lambda: self.partition(guild_id))
+
+    async def partition(self, guild_id: int, create=True) -> Optional[CmdStore]:
+        """
+        Returns the store for the guild's own commands, opening it if needed.
+        Unless create is true, returns None rather than making one for a guild
+        that doesn't have one yet.
+        """
+        now = self._clock()
+        p = self._partitions.get(guild_id)
+        if p is None:
+            opening = self._opening.get(guild_id)
+            if opening is None and not create and not self._has_partition(guild_id):
+                return None
+            self._without_partition.discard(guild_id)
+            if opening is None:
+                # Opening runs migrations and loads the index, so it's kept
+                # off the event loop.
+                opening = asyncio.get_running_loop().run_in_executor(None, self._open, guild_id)
+                self._opening[guild_id] = opening
+                opening.add_done_callback(lambda f: self._opened(guild_id, f))
+            await asyncio.shield(opening)
+            p = self._partitions[guild_id]
+        p.last_used = now
+        self._partitions.move_to_end(guild_id)
+        self._evict(now)
+        return p.store
+
+    def _has_partition(self, guild_id: int) -> bool:
+        if guild_id in self._without_partition:
+            return False
+        if self._engine_class.last_modified(partition_path(self._data_dir, guild_id)) is None:
+            self._without_partition.add(guild_id)
+            return False
+        return True
+
+    def _opened(self, guild_id: int, opening: asyncio.Future):
+        del self._opening[guild_id]
+        if not opening.cancelled() and opening.exception() is None:
+            self._partitions[guild_id] = _Partition(opening.result(), self._clock())
+
+    def _evict(self, now: float):
+        if not self._engine_class.persistent:
+            return
+        # Least recently used first, so once one is kept, so is everything after it.
+        while len(self._partitions) > 0:
+            guild_id, p = next(iter(self._partitions.items()))
+            idle = now - p.last_used
+            if idle < self._idle_seconds and not (
+                    len(self._partitions) > self._max_open and idle >= PARTITION_MIN_IDLE_SECONDS):
+                return
+            del self._partitions[guild_id]
+            # Closing waits for the writer to finish.
+            asyncio.get_running_loop().run_in_executor(None, p.store.close)
+
+    async def warm_up(self, guild_ids: Iterable[int]):
+        """
+        Opens the partitions of as many of the given guilds as can be kept
+        open, most recently changed first, so their first summons don't have
+        to. Guilds without commands of their own are skipped, rather than
+        given empty databases.
+        """
+        def existing():
+            modified = {g: self._engine_class.last_modified(partition_path(self._data_dir, g)) for g in guild_ids}
+            found = [g for g, m in modified.items() if m is not None]
+            found.sort(key=lambda g: modified[g], reverse=True)
+            return found[:self._max_open]
+        found = await asyncio.get_running_loop().run_in_executor(None, existing)
+        stores = await asyncio.gather(*(self.partition(g) for g in found))
+        await asyncio.gather(self.shared.warm_up(), *(s.warm_up() for s in stores))
+
+    def is_open(self, guild_id: int) -> bool:
+        return guild_id in self._partitions
+
+    async def reload(self, guild_id: Optional[int], triggers: Iterable[str]):
+        """
+        Rereads the given triggers of the guild's partition, for when they were
+        changed by something other than these stores. Partitions that aren't
+        open have nothing to reread.
+        """
+        if guild_id is None:
+            await self.shared.reload(triggers)
+            return
+        # Another process may have made the guild's partition.
+        self._without_partition.discard(guild_id)
+        opening = self._opening.get(guild_id)
+        if opening is not None:
+            # It may have read its index before the change.
+            await asyncio.shield(opening)
+        p = self._partitions.get(guild_id)
+        if p is not None:
+            await p.store.reload(triggers)
+
+    def close(self):
+        for p in self._partitions.values():
+            p.store.close()
+        self._partitions.clear()
+        self.shared.close()
 
 
 class FlairStore:
-    def __init__(self, sqlite3_db_name):
-        self._conn = sqlite3.connect(sqlite3_db_name)
-        self._cursor = self._conn.cursor()
-        self._exec('''CREATE TABLE IF NOT EXISTS flairs (key INTEGER PRIMARY KEY, date REAL, user TEXT, message_id TEXT, reaction_id TEXT, role_id TEXT, enabled INTEGER);''')
+    def __init__(self, db_name, writer=None, engine=SQLITE_ENGINE):
+        """Opens the flairs in db_name, kept by the named engine (see ENGINES)."""
+        self._engine: FlairEngine = _engine_classes(engine)[1](db_name, writer)
+
+        # Called with the message ids whose flairs changed, after every
+        # change made through this store.
+        self.listeners: List[Callable[[List[str]], None]] = []
 
-    def save(self, username, message_id, reaction_id, role_id):
+    @metrics.timed(STORAGE_SECONDS, method='FlairStore.save')
+    async def save(self, username, message_id, reaction_id, role_id):
         """Associates the given role_id with the given message and reaction ids."""
-        self._exec('''INSERT INTO flairs (date, user, message_id, reaction_id, role_id, enabled) VALUES(strftime('%s.%f', 'now'), ?, ?, ?, ?, 1);''',
-                   username, message_id, reaction_id, role_id)
+        await self._engine.save(time.time(), username, message_id, reaction_id, role_id)
+        self._changed([message_id])
 
-    def get(self, message_id, reaction_id):
+    @metrics.timed(STORAGE_SECONDS, method='FlairStore.get')
+    async def get(self, message_id, reaction_id):
         """Returns an array containing any role ids associated with the given message and reaction pair."""
-        rows = self._read(
-            '''SELECT role_id FROM flairs where message_id=? AND reaction_id=? AND enabled=1;''', message_id, reaction_id)
-        return [r[0] for r in rows]
+        return await self._engine.get(message_id, reaction_id)
 
-    def list_flair_messages(self):
+    @metrics.timed(STORAGE_SECONDS, method='FlairStore.list_flair_messages')
+    async def list_flair_messages(self):
         """Lists the messages that have one or more flairs associated with them."""
-        return self._read('''SELECT message_id, reaction_id, role_id FROM flairs WHERE enabled=1;''')
-
-    def delete(self, message_id, reaction_id):
-        self._exec('''UPDATE flairs SET enabled=0 WHERE message_id=? AND reaction_id=?''',
-                   message_id, reaction_id)
+        return await self._engine.list_flair_messages()
 
-    def _exec(self, sql_str, *args):
-        self._cursor.execute(sql_str, args)
-        self._conn.commit()
+    @metrics.timed(STORAGE_SECONDS, method='FlairStore.delete')
+    async def delete(self, message_id, reaction_id):
+        await self._engine.delete(message_id, reaction_id)
+        self._changed([message_id])
 
-    def _read(self, sql, *args):
-        self._cursor.execute(sql, args)
-        return self._cursor.fetchall()
+    def _changed(self, message_ids: List[str]):
+        for listener in self.listeners:
+            listener(message_ids)
 
-    def __del__(self):
-        self._conn.close()
+    def close(self):
+        self._engine.close()
@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for storage.py.
+
+Run with: python3 storage_bench.py <benchmark> [options]
+Every benchmark works on a scratch database that is deleted afterwards.
+"""
+import argparse
+import asyncio
+import glob
+import os
+import random
+import sqlite3
+import statistics
+import time
+
+import storage
+from storage import CmdStore
+
+# Make sure this doesn't coincide with a sqlite db file that's really used.
+BENCH_DB = 'bench_db_please_ignore.db'
+BENCH_FLAIR_DB = 'bench_flair_db_please_ignore.db'
+
+
+def _remove_db(name=BENCH_DB):
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(name + suffix):
+            os.remove(name + suffix)
+    for path in glob.glob(glob.escape(storage.dbm_path(name)) + '*'):
+        os.remove(path)
+
+
+def _summarize(name, seconds):
+    """Prints latency percentiles (in microseconds) for the given samples."""
+    seconds = sorted(seconds)
+    p50 = seconds[len(seconds) // 2] * 1e6
+    p99 = seconds[min(len(seconds) - 1, int(len(seconds) * 0.99))] * 1e6
+    print(f"{name:<40} n={len(seconds):<7} mean={statistics.mean(seconds)*1e6:9.1f}us "
+          f"p50={p50:9.1f}us p99={p99:9.1f}us")
+
+
+async def _loop_lag(stop: asyncio.Event, lags):
+    """Records how late the event loop wakes us up, until stop is set."""
+    interval = 0.001
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+def bench_async(args):
+    """
+    Compares the async store against the blocking calls it replaced.
+
+    The blocking path opens one connection and commits every statement
+    directly on the event loop, which is what CmdStore used to do.
+    """
+    _remove_db()
+    conn = sqlite3.connect(BENCH_DB)
+    conn.execute('''CREATE TABLE IF NOT EXISTS commands (key INTEGER PRIMARY KEY, date REAL, user TEXT, trigger TEXT, content TEXT, enabled INTEGER, image BLOB);''')
+    conn.commit()
+
+    async def sync_path():
+        saves, gets, lags = [], [], []
+        stop = asyncio.Event()
+        ticker = asyncio.create_task(_loop_lag(stop, lags))
+        for i in range(args.n):
+            start = time.perf_counter()
+            conn.execute('''INSERT INTO commands (date, user, trigger, content, enabled, image) VALUES(strftime('%s.%f', 'now'), ?, ?, ?, 1, ?)''',
+                         ('bench', f"sync{i % args.triggers}", 'content', None))
+            conn.commit()
+            saves.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            conn.execute('''SELECT content, image FROM commands where trigger=? AND enabled=1 ORDER BY RANDOM() LIMIT 1;''',
+                         (f"sync{i % args.triggers}",)).fetchall()
+            gets.append(time.perf_counter() - start)
+            # Give the ticker a chance to run, like other events would.
+            await asyncio.sleep(0)
+        stop.set()
+        await ticker
+        return saves, gets, lags
+
+    async def async_path(store):
+        saves, gets, lags = [], [], []
+        stop = asyncio.Event()
+        ticker = asyncio.create_task(_loop_lag(stop, lags))
+        for i in range(args.n):
+            start = time.perf_counter()
+            await store.save('bench', f"async{i % args.triggers}", 'content')
+            saves.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await store.get(f"async{i % args.triggers}")
+            gets.append(time.perf_counter() - start)
+        stop.set()
+        await ticker
+        return saves, gets, lags
+
+    saves, gets, lags = asyncio.run(sync_path())
+    conn.close()
+    _summarize("blocking save", saves)
+    _summarize("blocking get", gets)
+    _summarize("event loop lag (blocking)", lags or [0])
+
+    store = CmdStore(BENCH_DB)
+    saves, gets, lags = asyncio.run(async_path(store))
+    store.close()
+    _summarize("async save", saves)
+    _summarize("async get", gets)
+    _summarize("event loop lag (async)", lags or [0])
+    _remove_db()
+
+
+def _time_query(conn, sql, arg_fn, n):
+    samples = []
+    for _ in range(n):
+        args = arg_fn()
+        start = time.perf_counter()
+        conn.execute(sql, args).fetchall()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_indexes(args):
+    """
+    Times the queries behind CmdStore.get, CmdStore.count and FlairStore.get
+    at several table sizes, before and after the indexing migrations.
+    """
+    for rows in [int(r) for r in args.rows.split(',')]:
+        _remove_db()
+        _remove_db(BENCH_FLAIR_DB)
+        conn = sqlite3.connect(BENCH_DB)
+        flair_conn = sqlite3.connect(BENCH_FLAIR_DB)
+
+        # Everything up to, but not including, the index migrations.
+        storage._migrate(conn, storage.COMMAND_MIGRATIONS[:storage.COMMAND_MIGRATIONS.index(storage._index_commands)])
+        storage._migrate(flair_conn, storage.FLAIR_MIGRATIONS[:storage.FLAIR_MIGRATIONS.index(storage._index_flairs)])
+        with conn:
+            conn.executemany('''INSERT INTO commands (date, user, trigger, content, enabled) VALUES(0, 'bench', ?, 'content', ?)''',
+                             ((f"t{i % args.triggers}", int(i % 10 != 0)) for i in range(rows)))
+        with flair_conn:
+            flair_conn.executemany('''INSERT INTO flairs (date, user, message_id, reaction_id, role_id, enabled) VALUES(0, 'bench', ?, ?, ?, 1)''',
+                             ((str(i // 4), str(i % 4), str(i)) for i in range(rows)))
+
+        def trigger():
+            return (f"t{random.randrange(args.triggers)}",)
+
+        def reaction():
+            i = random.randrange(rows)
+            return (str(i // 4), str(i % 4))
+
+        queries = [
+            ("CmdStore.get", conn, '''SELECT key FROM commands WHERE trigger=? AND enabled=1;''', trigger),
+            ("CmdStore.count", conn, '''SELECT COUNT(*) FROM commands WHERE trigger=? AND enabled=1;''', trigger),
+            ("FlairStore.get", flair_conn, '''SELECT role_id FROM flairs where message_id=? AND reaction_id=? AND enabled=1;''', reaction),
+        ]
+        for label in ("before", "after"):
+            if label == "after":
+                storage._migrate(conn, storage.COMMAND_MIGRATIONS)
+                storage._migrate(flair_conn, storage.FLAIR_MIGRATIONS)
+            for name, c, sql, arg_fn in queries:
+                _summarize(f"{name} {rows} rows ({label})",
+                           _time_query(c, sql, arg_fn, args.n))
+        conn.close()
+        flair_conn.close()
+    _remove_db()
+    _remove_db(BENCH_FLAIR_DB)
+
+
+def bench_sampling(args):
+    """
+    Compares picking a random response with ORDER BY RANDOM() against
+    CmdStore's alias tables, for triggers with few and many responses.
+    """
+    _remove_db()
+    store = CmdStore(BENCH_DB)
+    sizes = [int(r) for r in args.responses.split(',')]
+
+    async def fill():
+        for size in sizes:
+            for i in range(size):
+                await store.save('bench', f"t{size}", f"response {i}", weight=random.uniform(0.1, 10))
+    asyncio.run(fill())
+
+    conn = sqlite3.connect(BENCH_DB)
+    for size in sizes:
+        trigger = f"t{size}"
+        _summarize(f"ORDER BY RANDOM() ({size} responses)",
+                   _time_query(conn, '''SELECT content, image_hash FROM commands where trigger=? AND enabled=1 ORDER BY RANDOM() LIMIT 1;''',
+                               lambda: (trigger,), args.n))
+
+        # The first pick after a change builds the alias table.
+        t = store._triggers[trigger]
+        start = time.perf_counter()
+        t.pick()
+        _summarize(f"alias table build ({size} responses)", [time.perf_counter() - start])
+
+        samples = []
+        for _ in range(args.n):
+            start = time.perf_counter()
+            t.pick()
+            samples.append(time.perf_counter() - start)
+        _summarize(f"alias table pick ({size} responses)", samples)
+
+        async def gets():
+            samples = []
+            for _ in range(args.n):
+                start = time.perf_counter()
+                await store.get(trigger)
+                samples.append(time.perf_counter() - start)
+            return samples
+        _summarize(f"CmdStore.get ({size} responses)", asyncio.run(gets()))
+    conn.close()
+    store.close()
+    _remove_db()
+
+
+def bench_writes(args):
+    """
+    Measures write throughput with several writers at once, with and without
+    WAL and group commit.
+    """
+    configs = [
+        ("rollback journal, commit per write", 'DELETE', 1),
+        ("WAL, commit per write", 'WAL', 1),
+        ("WAL, group commit", 'WAL', storage.GROUP_COMMIT_MAX_WRITES),
+    ]
+    defaults = (storage.JOURNAL_MODE, storage.GROUP_COMMIT_MAX_WRITES)
+    for name, journal_mode, max_writes in configs:
+        storage.JOURNAL_MODE = journal_mode
+        storage.GROUP_COMMIT_MAX_WRITES = max_writes
+        _remove_db()
+        store = CmdStore(BENCH_DB)
+
+        async def writer(i, latencies):
+            for j in range(args.n // args.writers):
+                start = time.perf_counter()
+                await store.save('bench', f"t{(i * args.n + j) % args.triggers}", 'content')
+                latencies.append(time.perf_counter() - start)
+
+        async def run():
+            latencies = []
+            start = time.perf_counter()
+            await asyncio.gather(*(writer(i, latencies) for i in range(args.writers)))
+            return time.perf_counter() - start, latencies
+
+        commits = store._engine._db._writer.commits
+        elapsed, latencies = asyncio.run(run())
+        commits = store._engine._db._writer.commits - commits
+        print(f"{name}: {len(latencies) / elapsed:.0f} writes/s, {commits} commits")
+        _summarize("  save latency", latencies)
+        store.close()
+
+    storage.JOURNAL_MODE, storage.GROUP_COMMIT_MAX_WRITES = defaults
+    _remove_db()
+
+
+def bench_search(args):
+    """
+    Times CmdStore.search and CmdStore.suggest against a store with as many
+    responses as the largest of --rows, spread over --triggers triggers.
+    Response words are drawn from a vocabulary with a few very common words
+    and a long tail of rare ones, like real chat.
+    """
+    rows = max(int(r) for r in args.rows.split(','))
+    rng = random.Random(0)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9)))
+                  for _ in range(20000)]
+    weights = [1 / (i + 1) for i in range(len(vocabulary))]
+    triggers = [f"{rng.choice(vocabulary)}{i}" for i in range(args.triggers)]
+
+    def responses():
+        for i in range(rows):
+            words = rng.choices(vocabulary, weights, k=rng.randint(3, 15))
+            yield storage.Response(0, 'bench', triggers[i % len(triggers)], ' '.join(words))
+
+    _remove_db()
+    store = CmdStore(BENCH_DB)
+    start = time.perf_counter()
+    asyncio.run(store.save_many(responses(), chunk_size=5000))
+    print(f"Saved and indexed {rows} responses in {time.perf_counter() - start:.1f}s")
+
+    common, rare = vocabulary[0], vocabulary[-1]
+    typo = triggers[0][:2] + triggers[0][3:]
+    cases = [
+        (f"search for the most common word ('{common}')", lambda: store.search(common, 10)),
+        (f"search for a rare word ('{rare}')", lambda: store.search(rare, 10)),
+        ("search for two common words", lambda: store.search(f"{common} {vocabulary[1]}", 10)),
+        (f"search for part of a trigger ('{triggers[0][:4]}')", lambda: store.search(triggers[0][:4], 10)),
+        ("search, 5th page", lambda: store.search(vocabulary[5], 10, offset=40)),
+        (f"suggest ('{typo}' for '{triggers[0]}')", lambda: store.suggest(typo, 3)),
+    ]
+
+    async def run():
+        for name, call in cases:
+            samples = []
+            for _ in range(args.n):
+                start = time.perf_counter()
+                await call()
+                samples.append(time.perf_counter() - start)
+            _summarize(name, samples)
+    asyncio.run(run())
+    store.close()
+    _remove_db()
+
+
+def bench_engines(args):
+    """
+    Compares the storage engines at what the bot does most (summons, saves,
+    opening a store and flair lookups), and at searching, with --triggers
+    triggers of five responses each.
+    """
+    async def run(engine):
+        _remove_db()
+        _remove_db(BENCH_FLAIR_DB)
+        start = time.perf_counter()
+        store = CmdStore(BENCH_DB, engine=engine)
+        await store.save_many(storage.Response(0, 'bench', f"t{i % args.triggers}", f"response {i} to t{i % args.triggers}")
+                              for i in range(args.triggers * 5))
+        print(f"{engine}: saved {args.triggers * 5} responses in {time.perf_counter() - start:.2f}s")
+
+        async def timed(name, call, n=args.n):
+            samples = []
+            for i in range(n):
+                start = time.perf_counter()
+                await call(i)
+                samples.append(time.perf_counter() - start)
+            _summarize(f"  {name}", samples)
+
+        await timed("CmdStore.get", lambda i: store.get(f"t{i % args.triggers}"))
+        await timed("CmdStore.save", lambda i: store.save('bench', f"t{i % args.triggers}", 'content'))
+        await timed("CmdStore.search", lambda i: store.search(f"t{i % args.triggers}", 10), n=max(1, args.n // 100))
+        await timed("CmdStore.suggest", lambda i: store.suggest(f"t{i % args.triggers}x", 3), n=max(1, args.n // 100))
+        store.close()
+
+        if storage.ENGINES[engine][0].persistent:
+            start = time.perf_counter()
+            CmdStore(BENCH_DB, engine=engine).close()
+            _summarize("  reopen", [time.perf_counter() - start])
+
+        flairs = storage.FlairStore(BENCH_FLAIR_DB, engine=engine)
+        for i in range(args.triggers):
+            await flairs.save('bench', i, 'emoji', i)
+        await timed("FlairStore.get", lambda i: flairs.get(i % args.triggers, 'emoji'))
+        flairs.close()
+
+    for engine in storage.ENGINES:
+        if engine == storage.DBM_ENGINE and not storage.dbm_available():
+            print(f"{engine}: skipped, since Python was built without gdbm or ndbm.")
+            continue
+        asyncio.run(run(engine))
+    _remove_db()
+    _remove_db(BENCH_FLAIR_DB)
+
+
+BENCHMARKS = {
+    'async': bench_async,
+    'engines': bench_engines,
+    'indexes': bench_indexes,
+    'sampling': bench_sampling,
+    'search': bench_search,
+    'writes': bench_writes,
+}
+
+
+def _main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('-n', type=int, default=2000,
+                        help="Number of operations to time.")
+    parser.add_argument('--triggers', type=int, default=100,
+                        help="Number of distinct triggers to spread operations over.")
+    parser.add_argument('--writers', type=int, default=20,
+                        help="Number of concurrent writers.")
+    parser.add_argument('--rows', default='10000,100000,1000000',
+                        help="Comma separated table sizes to benchmark at.")
+    parser.add_argument('--responses', default='2,200,20000',
+                        help="Comma separated numbers of responses per trigger to benchmark at.")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,814 @@
+#!/usr/bin/env python3
+import asyncio
+import glob
+import io
+import os
+import pickle
+import random
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tarfile
+import time
+import unittest
+from unittest.mock import patch
+
+import discord
+
+import storage
+import transfer
+from storage import CmdStore, FlairStore, GuildCmdStores, Response
+
+# Make sure this doesn't coincide with a sqlite db file that's really used.
+TEST_DB = 'test_storage_db_please_ignore.db'
+TEST_EXPORT = 'test_export_please_ignore'
+TEST_DATA_DIR = 'test_partitions_please_ignore'
+
+
+COPY_DB = 'test_storage_copy_db_please_ignore.db'
+
+
+def _remove_db(name):
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(name + suffix):
+            os.remove(name + suffix)
+    for path in glob.glob(glob.escape(storage.dbm_path(name)) + '*'):
+        os.remove(path)
+
+
+def _remove_test_db():
+    _remove_db(TEST_DB)
+    _remove_db(COPY_DB)
+    shutil.rmtree(TEST_DATA_DIR, ignore_errors=True)
+    for suffix in ('.jsonl', '.tar'):
+        if os.path.exists(TEST_EXPORT + suffix):
+            os.remove(TEST_EXPORT + suffix)
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class CmdStoreTest(unittest.TestCase):
+    def setUp(self):
+        # TEST_DB should be deleted in tearDown, but if the test was interrupted
+        # it might not have been.
+        _remove_test_db()
+        self.stores = []
+
+    def tearDown(self):
+        for s in self.stores:
+            s.close()
+        _remove_test_db()
+
+    def open_store(self, name=TEST_DB) -> CmdStore:
+        s = CmdStore(name)
+        self.stores.append(s)
+        return s
+
+    def read_db(self, sql):
+        conn = sqlite3.connect(TEST_DB)
+        try:
+            return conn.execute(sql).fetchall()
+        finally:
+            conn.close()
+
+
+class TestMigrations(CmdStoreTest):
+    def test_applies_each_migration_once(self):
+        self.open_store().close()
+        self.assertEqual(self.read_db('SELECT version FROM schema_version;'),
+                         [(len(storage.COMMAND_MIGRATIONS),)])
+
+        # Reopening shouldn't apply anything again.
+        conn = sqlite3.connect(TEST_DB)
+        self.assertEqual(storage._migrate(conn, storage.COMMAND_MIGRATIONS), 0)
+        conn.close()
+
+    def test_only_vacuums_after_migrations_free_space(self):
+        self.open_store().close()
+        conn = sqlite3.connect(TEST_DB)
+        conn.execute('''CREATE TABLE scratch (data BLOB);''')
+        conn.executemany('''INSERT INTO scratch VALUES(?);''', [(b'x' * 10000,)] * 20)
+        conn.commit()
+        conn.execute('''DROP TABLE scratch;''')
+        conn.commit()
+        conn.close()
+        free_pages = self.read_db('PRAGMA freelist_count;')
+        self.assertGreater(free_pages[0][0], 0)
+
+        self.open_store().close()
+        self.assertEqual(self.read_db('PRAGMA freelist_count;'), free_pages)
+
+        # A migration that frees space gets it given back.
+        def freeing(conn):
+            conn.execute('''DROP TABLE scratch;''')
+        conn = sqlite3.connect(TEST_DB)
+        conn.execute('''CREATE TABLE scratch (data BLOB);''')
+        conn.executemany('''INSERT INTO scratch VALUES(?);''', [(b'x' * 10000,)] * 40)
+        conn.commit()
+        storage._migrate(conn, storage.COMMAND_MIGRATIONS + [freeing])
+        conn.close()
+        self.assertEqual(self.read_db('PRAGMA freelist_count;'), [(0,)])
+
+    def test_failed_migration_is_rolled_back(self):
+        def broken(conn):
+            conn.execute('''CREATE TABLE half_done (x INTEGER);''')
+            raise RuntimeError("oops")
+
+        conn = sqlite3.connect(TEST_DB)
+        with self.assertRaises(RuntimeError):
+            storage._migrate(conn, storage.FLAIR_MIGRATIONS + [broken])
+        conn.close()
+
+        self.assertEqual(self.read_db('SELECT version FROM schema_version;'),
+                         [(len(storage.FLAIR_MIGRATIONS),)])
+        self.assertEqual(self.read_db(
+            "SELECT name FROM sqlite_master WHERE name='half_done';"), [])
+
+
+class TestImages(CmdStoreTest):
+    def test_identical_images_are_stored_once(self):
+        s = self.open_store()
+        for trigger in ('a', 'b', 'c'):
+            _run(s.save('user', trigger, '',
+                        discord.File(io.BytesIO(b'same image'), 'cat.png')))
+        _run(s.save('user', 'd', '',
+                    discord.File(io.BytesIO(b'other image'), 'dog.png')))
+
+        self.assertEqual(self.read_db('SELECT COUNT(*) FROM images;'), [(2,)])
+
+        content, image = _run(s.get('b'))
+        self.assertEqual(content, '')
+        self.assertEqual(image.filename, 'cat.png')
+        self.assertEqual(image.fp.read(), b'same image')
+
+    def test_counts_bytes_saved_by_shrunk_images(self):
+        s = self.open_store()
+        _run(s.save('user', 'cat', '', discord.File(io.BytesIO(b'small'), 'cat.png'),
+                    original_image_size=100))
+        saved = storage.SUMMON_IMAGE_BYTES_SAVED.labels()
+        before = saved.value
+
+        _, image = _run(s.get('cat'))
+        _run(s.get('cat'))
+
+        self.assertEqual(image.fp.read(), b'small')
+        self.assertEqual(saved.value - before, 2 * (100 - len(b'small')))
+        exported = _run(_collect(s.export_commands()))
+        self.assertEqual([r.image_original_size for r in exported], [100])
+
+    def test_migrates_pickled_images(self):
+        # Build a database the way older versions of CmdStore did.
+        conn = sqlite3.connect(TEST_DB)
+        conn.execute('''CREATE TABLE commands (key INTEGER PRIMARY KEY, date REAL, user TEXT, trigger TEXT, content TEXT, enabled INTEGER, image BLOB);''')
+        for trigger, name in (('a', 'a.png'), ('b', 'b.gif')):
+            conn.execute('''INSERT INTO commands (date, user, trigger, content, enabled, image) VALUES(0, 'user', ?, 'hi', 1, ?)''',
+                         (trigger, pickle.dumps(storage.File(name, b'old image'))))
+        # Dated the way older versions did it, too.
+        conn.execute('''INSERT INTO commands (date, user, trigger, content, enabled, image) VALUES(strftime('%s.%f', 'now'), 'user', 'c', 'text only', 1, NULL)''')
+        conn.commit()
+        conn.close()
+
+        s = self.open_store()
+
+        self.assertEqual(self.read_db('SELECT COUNT(*) FROM images;'), [(1,)])
+        self.assertEqual(self.read_db(
+            'SELECT COUNT(*) FROM commands WHERE image IS NOT NULL;'), [(0,)])
+        for trigger, name in (('a', 'a.png'), ('b', 'b.gif')):
+            content, image = _run(s.get(trigger))
+            self.assertEqual(content, 'hi')
+            self.assertEqual(image.filename, name)
+            self.assertEqual(image.fp.read(), b'old image')
+        self.assertEqual(_run(s.get('c')), ('text only', None))
+        summaries = _run(s.list_commands())
+        self.assertEqual([c.trigger for c in summaries], ['a', 'b', 'c'])
+        self.assertLess(summaries[2].elapsed_seconds, 60)
+
+
+class TestWeights(CmdStoreTest):
+    # Chi-squared critical values at p=0.001, by degrees of freedom. A correct
+    # sampler fails at most one in a thousand runs, and since the random seed
+    # is fixed, not even that.
+    CRITICAL_VALUES = {2: 13.816, 4: 18.467}
+
+    def assertFollowsWeights(self, store, trigger, weights_by_content, samples=4000):
+        counts = {c: 0 for c in weights_by_content}
+        for _ in range(samples):
+            content, _ = _run(store.get(trigger))
+            counts[content] += 1
+
+        total = sum(weights_by_content.values())
+        chi_squared = 0
+        for c, w in weights_by_content.items():
+            expected = samples * w / total
+            chi_squared += (counts[c] - expected) ** 2 / expected
+        self.assertLess(chi_squared,
+                        self.CRITICAL_VALUES[len(weights_by_content) - 1],
+                        msg=f"Got {counts} for weights {weights_by_content}")
+
+    def test_samples_by_weight(self):
+        random.seed(1234)
+        s = self.open_store()
+        weights = {'rare': 0.5, 'normal': 1, 'common': 8.5}
+        for content, weight in weights.items():
+            _run(s.save('user', 'test', content, weight=weight))
+
+        self.assertFollowsWeights(s, 'test', weights)
+
+        # Adding a response should rebuild the sampler.
+        weights.update({'new': 3, 'newer': 1})
+        _run(s.save('user', 'test', 'new', weight=3))
+        _run(s.save('user', 'test', 'newer'))
+        self.assertFollowsWeights(s, 'test', weights)
+
+    def test_weights_survive_restart(self):
+        random.seed(1234)
+        s = self.open_store()
+        weights = {'a': 1, 'b': 2, 'c': 3}
+        for content, weight in weights.items():
+            _run(s.save('user', 'test', content, weight=weight))
+        s.close()
+
+        self.assertFollowsWeights(self.open_store(), 'test', weights)
+
+    def test_rejects_bad_weights(self):
+        s = self.open_store()
+        for weight in (0, -1, float('nan'), float('inf')):
+            with self.assertRaises(ValueError):
+                _run(s.save('user', 'test', 'content', weight=weight))
+        self.assertEqual(_run(s.count('test')), 0)
+
+
+# Overwrites the 'test' command over and over, until killed.
+OVERWRITE_FOREVER = '''
+import asyncio, sys
+from storage import CmdStore
+
+async def main():
+    s = CmdStore(sys.argv[1])
+    i = 0
+    while True:
+        # Several at once, so they get committed together.
+        await asyncio.gather(*(s.overwrite('user', 'test', f'response {i}-{j}')
+                               for j in range(5)))
+        i += 1
+        if i == 10:
+            print('ready', flush=True)
+
+asyncio.run(main())
+'''
+
+
+class TestWrites(CmdStoreTest):
+    def test_uses_wal(self):
+        self.open_store()
+        self.assertEqual(self.read_db('PRAGMA journal_mode;'), [('wal',)])
+
+    def test_concurrent_writes_share_commits(self):
+        s = self.open_store()
+        commits = s._engine._db._writer.commits
+
+        async def save_all():
+            await asyncio.gather(*(s.save('user', f"test{i}", 'content')
+                                   for i in range(50)))
+        with patch('storage.GROUP_COMMIT_WINDOW_SECONDS', 0.05):
+            _run(save_all())
+
+        self.assertLess(s._engine._db._writer.commits - commits, 5)
+        for i in range(50):
+            self.assertEqual(_run(s.get(f"test{i}")), ('content', None))
+
+    def test_failed_write_doesnt_affect_batch(self):
+        s = self.open_store()
+
+        async def save_all():
+            return await asyncio.gather(
+                s.save('user', 'good1', 'content'),
+                s.save('user', 'bad', 'content', weight=float('nan')),
+                s._engine._db.write('''INSERT INTO no_such_table VALUES(1);'''),
+                s.save('user', 'good2', 'content'),
+                return_exceptions=True)
+        with patch('storage.GROUP_COMMIT_WINDOW_SECONDS', 0.05):
+            results = _run(save_all())
+
+        self.assertIsInstance(results[1], ValueError)
+        self.assertIsInstance(results[2], sqlite3.OperationalError)
+        self.assertEqual(self.read_db(
+            'SELECT trigger FROM commands ORDER BY trigger;'), [('good1',), ('good2',)])
+
+    def test_overwrite_refuses_random_commands(self):
+        s = self.open_store()
+        _run(s.save('user', 'test', 'a'))
+        _run(s.save('user', 'test', 'b'))
+
+        self.assertFalse(_run(s.overwrite('user', 'test', 'c')))
+        self.assertEqual(_run(s.count('test')), 2)
+
+        self.assertTrue(_run(s.overwrite('user', 'test', 'c', max_existing=2)))
+        self.assertEqual(_run(s.count('test')), 1)
+        self.assertEqual(_run(s.get('test')), ('c', None))
+
+    def test_overwrite_survives_being_killed(self):
+        for _ in range(5):
+            _remove_test_db()
+            p = subprocess.Popen([sys.executable, '-c', OVERWRITE_FOREVER, TEST_DB],
+                                 stdout=subprocess.PIPE,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+            self.assertEqual(p.stdout.readline().strip(), b'ready')
+            time.sleep(random.uniform(0, 0.05))
+            p.send_signal(signal.SIGKILL)
+            p.wait()
+            p.stdout.close()
+
+            # Whatever was committed last, there should be exactly one
+            # response.
+            self.assertEqual(self.read_db(
+                'SELECT COUNT(*) FROM commands WHERE enabled=1;'), [(1,)])
+            s = self.open_store()
+            self.assertEqual(_run(s.count('test')), 1)
+            content, _ = _run(s.get('test'))
+            self.assertTrue(content.startswith('response'))
+            s.close()
+
+
+class TestBulk(CmdStoreTest):
+    def responses(self, n):
+        for i in range(n):
+            image_name, image_data = None, None
+            if i % 3 == 0:
+                image_name, image_data = f"{i}.png", f"image {i % 2}".encode()
+            yield Response(float(i), f"user{i}", f"trigger{i % 7}", f"content {i}",
+                           float(i % 4 + 1), image_name, image_data)
+
+    def test_save_many_commits_in_chunks(self):
+        s = self.open_store()
+        commits = s._engine._db._writer.commits
+
+        self.assertEqual(_run(s.save_many(self.responses(25), chunk_size=10)), 25)
+
+        self.assertEqual(s._engine._db._writer.commits - commits, 3)
+        self.assertEqual(sum([_run(s.count(f"trigger{i}")) for i in range(7)]), 25)
+
+    def test_round_trips(self):
+        expected = sorted(self.responses(50))
+        src = self.open_store()
+        _run(src.save_many(expected))
+
+        for path, export, read in (
+                (TEST_EXPORT + '.tar', self.export_tar, self.read_tar),
+                (TEST_EXPORT + '.jsonl', self.export_jsonl, self.read_jsonl)):
+            _remove_db(COPY_DB)
+            dst = self.open_store(COPY_DB)
+            _run(export(src, path))
+            self.assertEqual(_run(read(dst, path)), 50)
+
+            self.assertEqual(sorted(_run(_collect(dst.export_commands(chunk_size=7)))),
+                             expected)
+            dst.close()
+
+    async def export_tar(self, store, path):
+        await transfer.export_tar(store, path)
+
+    async def read_tar(self, store, path):
+        with tarfile.open(path) as tar:
+            return await store.save_many(transfer.read_tar(tar))
+
+    async def export_jsonl(self, store, path):
+        with open(path, 'w') as f:
+            await transfer.export_jsonl(store, f)
+
+    async def read_jsonl(self, store, path):
+        with open(path) as f:
+            return await store.save_many(transfer.read_jsonl(f))
+
+
+class TestSearch(CmdStoreTest):
+    def test_ranks_trigger_matches_first(self):
+        s = self.open_store()
+        _run(s.save('user', 'cat', 'meow'))
+        _run(s.save('user', 'pets', 'my cat is called cat'))
+        _run(s.save('user', 'dog', 'woof'))
+
+        results = _run(s.search('cat', 10))
+        self.assertEqual([r.trigger for r in results], ['cat', 'pets'])
+        self.assertIn('**cat**', results[1].snippet)
+        self.assertEqual(_run(s.search('cat', 10, offset=1))[0].trigger, 'pets')
+        self.assertEqual([r.trigger for r in _run(s.search('pet', 10))], ['pets'])
+        self.assertEqual(_run(s.search('cat woof', 10)), [])
+        self.assertEqual(_run(s.search('"*(', 10)), [])
+
+    def test_counts_matching_responses(self):
+        s = self.open_store()
+        _run(s.save_many(Response(0, 'user', 'greeting', w) for w in ('hello there', 'hello you', 'bye')))
+        self.assertEqual([(r.trigger, r.matches) for r in _run(s.search('hello', 10))],
+                         [('greeting', 2)])
+
+    def test_forgets_disabled_responses(self):
+        s = self.open_store()
+        _run(s.save('user', 'cat', 'meow'))
+        _run(s.save('user', 'dog', 'woof'))
+        _run(s.overwrite('user', 'cat', 'purr'))
+        _run(s.delete('dog'))
+
+        self.assertEqual(_run(s.search('meow', 10)), [])
+        self.assertEqual(_run(s.search('woof', 10)), [])
+        self.assertEqual([r.trigger for r in _run(s.search('purr', 10))], ['cat'])
+        self.assertEqual(_run(s.suggest('dgo', 3)), [])
+        self.assertEqual(self.read_db('SELECT COUNT(*) FROM trigger_names;'), [(1,)])
+
+    def test_ranks_only_the_newest_matches(self):
+        s = self.open_store()
+        _run(s.save('user', 'cats', 'meow'))
+        _run(s.save_many(Response(0, 'user', f'old{i}', 'cat cat cat') for i in range(3)))
+        _run(s.save_many(Response(0, 'user', f'new{i}', 'a cat and some other words') for i in range(3)))
+        with patch('storage.MAX_RANKED_MATCHES', 3):
+            results = _run(s.search('cat', 10))
+        # Triggers named with the words are found however old they are.
+        self.assertEqual([(r.trigger, r.matches, r.snippet) for r in results[:1]], [('cats', 0, '')])
+        self.assertEqual(sorted(r.trigger for r in results[1:]), ['new0', 'new1', 'new2'])
+
+    def test_indexes_existing_commands(self):
+        conn = sqlite3.connect(TEST_DB)
+        storage._migrate(conn, storage.COMMAND_MIGRATIONS[:-1])
+        conn.execute('''INSERT INTO commands (date, user, trigger, content, enabled, weight) VALUES(0, 'user', 'cat', 'meow', 1, 1), (0, 'user', 'old', 'meow', 0, 1)''')
+        conn.commit()
+        conn.close()
+
+        s = self.open_store()
+        self.assertEqual([r.trigger for r in _run(s.search('meow', 10))], ['cat'])
+        self.assertEqual(_run(s.suggest('cta', 3)), [])
+        self.assertEqual(_run(s.suggest('catt', 3)), ['cat'])
+
+    def test_suggests_similar_triggers(self):
+        s = self.open_store()
+        for t in ('hello', 'help', 'yellow', 'goodbye'):
+            _run(s.save('user', t, 'content'))
+        self.assertEqual(_run(s.suggest('helo', 3)), ['hello', 'help'])
+        self.assertEqual(_run(s.suggest('xyz', 3)), [])
+        self.assertEqual(_run(s.suggest('"he', 3)), [])
+
+
+class TestSearchWithoutTrigrams(TestSearch):
+    """The same searches, as they're done with SQLite older than 3.34."""
+
+    def setUp(self):
+        super().setUp()
+        without = patch('storage.HAS_TRIGRAM_TOKENIZER', False)
+        without.start()
+        self.addCleanup(without.stop)
+
+    def test_keeps_names_in_a_plain_table(self):
+        s = self.open_store()
+        _run(s.save('user', '100%_sure', 'yes'))
+        _run(s.save('user', '100_percent', 'yes'))
+        self.assertEqual(self.read_db("SELECT type FROM sqlite_master WHERE name='trigger_names';"), [('table',)])
+        # LIKE's wildcards are matched as they are.
+        self.assertEqual([r.trigger for r in _run(s.search('100', 10))], ['100%_sure', '100_percent'])
+        self.assertEqual(_run(s.suggest('100%_sur', 3)), ['100%_sure'])
+
+
+class TestPartitions(CmdStoreTest):
+    def open_stores(self, **kwargs) -> GuildCmdStores:
+        s = GuildCmdStores(TEST_DATA_DIR, **kwargs)
+        self.stores.append(s)
+        return s
+
+    def test_guilds_have_their_own_commands(self):
+        s = self.open_stores()
+        one, two = _run(s.for_guild(1)), _run(s.for_guild(2))
+        _run(one.save('user', 'hi', 'hello'))
+        _run(s.shared.save('user', 'bye', 'goodbye'))
+
+        self.assertEqual(_run(one.get('hi'))[0], 'hello')
+        self.assertEqual(_run(two.get('hi'))[0], '')
+        # Global commands work everywhere, until a guild has its own.
+        self.assertEqual(_run(two.get('bye'))[0], 'goodbye')
+        _run(two.overwrite('user', 'bye', 'later'))
+        self.assertEqual(_run(two.get('bye'))[0], 'later')
+        self.assertEqual(_run(one.get('bye'))[0], 'goodbye')
+
+        self.assertEqual([c.trigger for c in _run(one.list_commands())], ['bye', 'hi'])
+        self.assertEqual([r.trigger for r in _run(one.search('bye', 10))], ['bye'])
+        self.assertEqual([r.snippet for r in _run(two.search('bye', 10))], ['later'])
+        self.assertEqual(_run(two.suggest('by', 3)), [])
+        self.assertEqual(_run(one.suggest('byee', 3)), ['bye'])
+        self.assertEqual([c.responses for c in _run(two.list_commands())], [1])
+        self.assertEqual(_run(s.shared.count('hi')), 0)
+
+    def test_closes_idle_partitions(self):
+        now = [0.0]
+        s = self.open_stores(clock=lambda: now[0], idle_seconds=100, max_open=2)
+        _run(_run(s.for_guild(1)).save('user', 'hi', 'hello'))
+
+        now[0] = 150
+        _run(s.partition(2))
+        self.assertFalse(s.is_open(1))
+        # It's reopened as it was.
+        self.assertEqual(_run(_run(s.for_guild(1)).get('hi'))[0], 'hello')
+
+        # Going over max_open closes the least recently used, once it's been
+        # idle for a little while.
+        _run(s.partition(3))
+        self.assertTrue(all(s.is_open(g) for g in (1, 2, 3)))
+        now[0] += storage.PARTITION_MIN_IDLE_SECONDS
+        _run(s.partition(1))
+        _run(s.partition(4))
+        self.assertEqual([g for g in (1, 2, 3, 4) if s.is_open(g)], [1, 4])
+
+    def test_warm_up_opens_recently_changed_partitions(self):
+        s = self.open_stores()
+        for g in (1, 2, 3):
+            _run(_run(s.partition(g)).save('user', 'hi', 'hello'))
+        for g, mtime in ((1, 300), (2, 100), (3, 200)):
+            os.utime(storage.partition_path(TEST_DATA_DIR, g), (mtime, mtime))
+
+        fresh = self.open_stores(max_open=2)
+        _run(fresh.warm_up([1, 2, 3, 4]))
+        self.assertEqual([g for g in (1, 2, 3, 4) if fresh.is_open(g)], [1, 3])
+        # Guilds without commands of their own don't get a database.
+        self.assertFalse(os.path.exists(storage.partition_path(TEST_DATA_DIR, 4)))
+
+    def test_reload_skips_closed_partitions(self):
+        s = self.open_stores()
+        other = self.open_stores()
+        _run(other.partition(1))
+        _run(_run(s.partition(1)).save('user', 'hi', 'hello'))
+
+        _run(other.reload(2, ['hi']))
+        self.assertFalse(other.is_open(2))
+        _run(other.reload(1, ['hi']))
+        self.assertEqual(_run(_run(other.for_guild(1)).get('hi'))[0], 'hello')
+
+    def test_moves_legacy_commands_to_global_partition(self):
+        legacy = self.open_store()
+        _run(legacy.save('user', 'hi', 'hello'))
+        legacy.close()
+        self.stores.remove(legacy)
+
+        self.assertTrue(storage.migrate_to_partitions(TEST_DB, TEST_DATA_DIR))
+        self.assertFalse(os.path.exists(TEST_DB))
+        self.assertFalse(storage.migrate_to_partitions(TEST_DB, TEST_DATA_DIR))
+
+        s = self.open_stores()
+        self.assertEqual(_run(_run(s.for_guild(1)).get('hi'))[0], 'hello')
+
+    def migrated_stores(self) -> GuildCmdStores:
+        legacy = self.open_store()
+        _run(legacy.save('user', 'hi', 'hello'))
+        _run(legacy.save('user', 'pick', 'a', weight=2.0))
+        _run(legacy.save('user', 'pick', 'b'))
+        legacy.close()
+        self.stores.remove(legacy)
+        storage.migrate_to_partitions(TEST_DB, TEST_DATA_DIR)
+        return self.open_stores()
+
+    def test_deletes_migrated_commands_from_guilds(self):
+        s = self.migrated_stores()
+        one, two = _run(s.for_guild(1)), _run(s.for_guild(2))
+        _run(one.save('user', 'pick', 'c'))
+
+        # Only the guild that deleted them stops answering.
+        _run(one.delete('hi'))
+        _run(one.delete('pick'))
+        for t in ('hi', 'pick'):
+            self.assertNotIn(t, one)
+            self.assertEqual(_run(one.get(t))[0], '')
+        self.assertEqual(_run(two.get('hi'))[0], 'hello')
+        self.assertEqual(_run(s.shared.count('pick')), 2)
+        self.assertEqual(_run(one.list_commands()), [])
+        self.assertEqual(_run(one.search('hi', 10)), [])
+        self.assertEqual(_run(one.suggest('pickk', 3)), [])
+        self.assertEqual(_run(two.suggest('pickk', 3)), ['pick'])
+
+        # Which lasts, and other processes see it too.
+        fresh = self.open_stores()
+        self.assertNotIn('hi', _run(fresh.for_guild(1)))
+        self.assertIn('hi', _run(fresh.for_guild(2)))
+
+        # Saving it again starts afresh.
+        _run(one.save('user', 'hi', 'hey'))
+        self.assertEqual(_run(one.count('hi')), 1)
+        self.assertEqual(_run(one.get('hi'))[0], 'hey')
+        _run(one.delete('hi'))
+        self.assertNotIn('hi', one)
+
+    def test_only_makes_partitions_for_changes(self):
+        s = self.migrated_stores()
+        path = storage.partition_path(TEST_DATA_DIR, 4242)
+        guild = _run(s.for_guild(4242))
+        self.assertEqual(_run(guild.get('hi'))[0], 'hello')
+        self.assertEqual(_run(guild.suggest('pickk', 3)), ['pick'])
+        _run(guild.delete('missing'))
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(s.is_open(4242))
+
+        _run(guild.save('user', 'new', 'response'))
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(_run(_run(s.for_guild(4242)).get('new'))[0], 'response')
+
+    def test_adding_to_migrated_commands_keeps_their_responses(self):
+        s = self.migrated_stores()
+        one = _run(s.for_guild(1))
+        _run(one.save('user', 'pick', 'c'))
+        _run(one.save_many([Response(1.0, 'user', 'hi', 'hi there')]))
+
+        self.assertEqual([(r.content, r.weight) for r in _run(_run(s.partition(1)).export_trigger('pick'))],
+                         [('a', 2.0), ('b', 1.0), ('c', 1.0)])
+        self.assertEqual(_run(one.count('hi')), 2)
+        # The global commands are left as they were.
+        self.assertEqual(_run(s.shared.count('pick')), 2)
+        self.assertEqual(_run(_run(s.for_guild(2)).count('hi')), 1)
+
+    def test_wont_overwrite_migrated_commands_with_several_responses(self):
+        s = self.migrated_stores()
+        one = _run(s.for_guild(1))
+        self.assertFalse(_run(one.overwrite('user', 'pick', 'c')))
+        self.assertTrue(_run(one.overwrite('user', 'hi', 'hey')))
+        self.assertEqual(_run(one.count('pick')), 2)
+
+
+class EngineConformance:
+    """
+    What every storage engine has to do, whichever it is. Mixed into a test
+    case for each engine below.
+    """
+    engine = None
+
+    def setUp(self):
+        _remove_test_db()
+        self.stores = []
+
+    def tearDown(self):
+        for s in self.stores:
+            s.close()
+        _remove_test_db()
+
+    def open_store(self) -> CmdStore:
+        s = CmdStore(TEST_DB, engine=self.engine)
+        self.stores.append(s)
+        return s
+
+    def test_summons_saved_responses(self):
+        s = self.open_store()
+        _run(s.save('user', 'text', 'hello'))
+        _run(s.save('user', 'pic', 'look', discord.File(io.BytesIO(b'image'), filename='pic.png'),
+                    original_image_size=100))
+        _run(s.save('user', 'same pic', '', discord.File(io.BytesIO(b'image'), filename='same.png')))
+
+        self.assertEqual(_run(s.get('text')), ('hello', None))
+        content, image = _run(s.get('pic'))
+        self.assertEqual((content, image.filename, image.fp.read()), ('look', 'pic.png', b'image'))
+        self.assertEqual(_run(s.get('same pic'))[1].filename, 'same.png')
+        self.assertEqual(_run(s.get('missing')), ('', None))
+        self.assertEqual([(c.trigger, c.responses) for c in _run(s.list_commands())],
+                         [('pic', 1), ('same pic', 1), ('text', 1)])
+
+    def test_overwrites_and_deletes(self):
+        s = self.open_store()
+        _run(s.save('user', 'one', 'a'))
+        _run(s.save_many(Response(0, 'user', 'many', c) for c in ('a', 'b')))
+
+        self.assertTrue(_run(s.overwrite('user', 'one', 'b')))
+        self.assertFalse(_run(s.overwrite('user', 'many', 'c')))
+        self.assertEqual(_run(s.get('one'))[0], 'b')
+        self.assertEqual(_run(s.count('many')), 2)
+
+        _run(s.delete('many'))
+        self.assertEqual(_run(s.count('many')), 0)
+        self.assertEqual(_run(s.get('many')), ('', None))
+        _run(s.save('user', 'many', 'again'))
+        self.assertEqual(_run(s.get('many'))[0], 'again')
+
+    def test_exports_what_was_saved(self):
+        s = self.open_store()
+        responses = [Response(float(i), 'user', f't{i % 3}', f'c{i}', float(i + 1),
+                              'i.png' if i % 2 else None, b'data' if i % 2 else None, 10 if i % 2 else None)
+                     for i in range(10)]
+        self.assertEqual(_run(s.save_many(responses, chunk_size=4)), 10)
+        _run(s.delete('t0'))
+
+        self.assertEqual(_run(_collect(s.export_commands(chunk_size=3))),
+                         [r for r in responses if r.trigger != 't0'])
+
+    def test_reopens_with_what_was_saved(self):
+        s = self.open_store()
+        _run(s.save('user', 'hi', 'hello', weight=2))
+        _run(s.save('user', 'bye', 'goodbye'))
+        _run(s.delete('bye'))
+        s.close()
+        self.stores.remove(s)
+
+        reopened = self.open_store()
+        if reopened.persistent:
+            self.assertEqual(_run(reopened.get('hi'))[0], 'hello')
+            self.assertEqual([c.trigger for c in _run(reopened.list_commands())], ['hi'])
+        else:
+            self.assertEqual(_run(reopened.list_commands()), [])
+
+    def test_reloads_triggers(self):
+        s = self.open_store()
+        _run(s.save('user', 'hi', 'hello'))
+        _run(s.reload(['hi', 'missing']))
+        self.assertEqual(_run(s.count('hi')), 1)
+        self.assertNotIn('missing', s)
+
+    def test_searches(self):
+        s = self.open_store()
+        _run(s.save('user', 'cat', 'meow'))
+        _run(s.save('user', 'pets', 'my cat is called cat'))
+        _run(s.save_many(Response(0, 'user', 'greeting', w) for w in ('hello there', 'hello you', 'bye')))
+        _run(s.save('user', 'dog', 'woof'))
+        _run(s.delete('dog'))
+
+        results = _run(s.search('cat', 10))
+        self.assertEqual([(r.trigger, r.matches) for r in results], [('cat', 1), ('pets', 1)])
+        self.assertIn('**cat**', results[1].snippet)
+        self.assertEqual([r.trigger for r in _run(s.search('cat', 10, offset=1))], ['pets'])
+        self.assertEqual([r.trigger for r in _run(s.search('pet', 10))], ['pets'])
+        self.assertEqual([(r.trigger, r.matches) for r in _run(s.search('hello', 10))], [('greeting', 2)])
+        self.assertEqual(_run(s.search('woof', 10)), [])
+        self.assertEqual(_run(s.search('cat woof', 10)), [])
+        self.assertEqual(_run(s.search('"*(', 10)), [])
+
+    def test_suggests_similar_triggers(self):
+        s = self.open_store()
+        for t in ('hello', 'help', 'yellow', 'goodbye'):
+            _run(s.save('user', t, 'content'))
+        self.assertEqual(_run(s.suggest('helo', 3)), ['hello', 'help'])
+        self.assertEqual(_run(s.suggest('xyz', 3)), [])
+        self.assertEqual(_run(s.suggest('"he', 3)), [])
+
+        _run(s.delete('hello'))
+        _run(s.overwrite('user', 'help', 'content'))
+        self.assertEqual(_run(s.suggest('helo', 3)), ['help'])
+
+    def test_partitions(self):
+        s = GuildCmdStores(TEST_DATA_DIR, engine=self.engine)
+        self.stores.append(s)
+        _run(_run(s.for_guild(1)).save('user', 'hi', 'hello'))
+        _run(s.shared.save('user', 'bye', 'goodbye'))
+        self.assertEqual(_run(_run(s.for_guild(1)).get('hi'))[0], 'hello')
+        self.assertEqual(_run(_run(s.for_guild(2)).get('bye'))[0], 'goodbye')
+        self.assertEqual(_run(_run(s.for_guild(2)).get('hi'))[0], '')
+        _run(_run(s.for_guild(2)).delete('bye'))
+        self.assertNotIn('bye', _run(s.for_guild(2)))
+        self.assertEqual(_run(_run(s.for_guild(1)).get('bye'))[0], 'goodbye')
+        _run(s.warm_up([1, 2]))
+
+    def test_flairs(self):
+        f = FlairStore(TEST_DB, engine=self.engine)
+        self.stores.append(f)
+        _run(f.save('user', 1, 'emoji', 10))
+        _run(f.save('user', 1, 'emoji', 11))
+        _run(f.save('user', 2, 'other emoji', 12))
+
+        self.assertEqual(_run(f.get(1, 'emoji')), ['10', '11'])
+        self.assertEqual(_run(f.get(1, 'other emoji')), [])
+        self.assertEqual(sorted(_run(f.list_flair_messages())),
+                         [('1', 'emoji', '10'), ('1', 'emoji', '11'), ('2', 'other emoji', '12')])
+        _run(f.delete(1, 'emoji'))
+        self.assertEqual(_run(f.get(1, 'emoji')), [])
+        self.assertEqual(_run(f.list_flair_messages()), [('2', 'other emoji', '12')])
+
+
+class TestSqliteEngine(EngineConformance, unittest.TestCase):
+    engine = storage.SQLITE_ENGINE
+
+
+class TestMemoryEngine(EngineConformance, unittest.TestCase):
+    engine = storage.MEMORY_ENGINE
+
+    def test_keeps_partitions_open(self):
+        s = GuildCmdStores(TEST_DATA_DIR, idle_seconds=0, engine=self.engine)
+        self.stores.append(s)
+        _run(_run(s.for_guild(1)).save('user', 'hi', 'hello'))
+        _run(s.partition(2))
+        self.assertTrue(s.is_open(1))
+
+
+@unittest.skipUnless(storage.dbm_available(), "Python was built without gdbm or ndbm.")
+class TestDbmEngine(EngineConformance, unittest.TestCase):
+    engine = storage.DBM_ENGINE
+
+    def test_cant_share_writers(self):
+        with self.assertRaises(ValueError):
+            CmdStore(TEST_DB, writer=object(), engine=self.engine)
+
+
+class TestWithoutDbm(unittest.TestCase):
+    @unittest.skipIf(storage.dbm_available(), "Python was built with gdbm or ndbm.")
+    def test_refuses_to_use_dbm_dumb(self):
+        with self.assertRaises(RuntimeError):
+            CmdStore(TEST_DB, engine=storage.DBM_ENGINE)
+        self.assertEqual(glob.glob(glob.escape(storage.dbm_path(TEST_DB)) + '*'), [])
+
+
+async def _collect(iterator):
+    return [x async for x in iterator]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,2 +1,12 @@
 #!/bin/bash
+set -e
 pipenv run python3 cmd_setter_test.py > /dev/null
+pipenv run python3 storage_test.py > /dev/null
+pipenv run python3 flairs_test.py > /dev/null
+pipenv run python3 metrics_test.py > /dev/null
+pipenv run python3 ratelimit_test.py > /dev/null
+pipenv run python3 shards_test.py > /dev/null
+pipenv run python3 images_test.py > /dev/null
+pipenv run python3 warmup_test.py > /dev/null
+pipenv run python3 channels_test.py > /dev/null
+pipenv run python3 reconcile_test.py > /dev/null
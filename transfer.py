@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Exports and imports commands, to move them between deployments.
+
+Export everything (images included) to a file:
+    python3 transfer.py export commands.jsonl
+    python3 transfer.py export commands.tar
+
+Import from a file made by export, adding to whatever commands exist already:
+    python3 transfer.py import commands.jsonl
+
+JSONL files hold one response per line, with images base64 encoded inline.
+Tar archives hold a commands.jsonl that refers to images stored alongside it
+as images/<sha256>, so each image is only stored once.
+
+Commands are exported from, and imported into, the global commands that every
+guild can use, unless --guild picks a single guild's.
+
+Stop the bot before importing. It only reads a guild's database when it opens
+it, so it may not notice the new commands until it's restarted anyway.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+import tempfile
+from typing import Iterator
+
+from main import COMMAND_DATA_DIR, COMMAND_DB_NAME, STORAGE_ENGINE_ENV_VAR
+from storage import ENGINES, SQLITE_ENGINE, CmdStore, Response, migrate_to_partitions, partition_path
+
+TAR_COMMANDS_NAME = 'commands.jsonl'
+TAR_IMAGE_DIR = 'images'
+
+
+def _to_json(r: Response, **image_fields) -> str:
+    return json.dumps({
+        'date': r.date,
+        'user': r.user,
+        'trigger': r.trigger,
+        'content': r.content,
+        'weight': r.weight,
+        'image_name': r.image_name,
+        'image_original_size': r.image_original_size,
+        **image_fields,
+    })
+
+
+def _from_json(line: str, image_data=None) -> Response:
+    d = json.loads(line)
+    if 'image' in d and d['image'] is not None:
+        image_data = base64.b64decode(d['image'])
+    return Response(d['date'], d['user'], d['trigger'], d['content'],
+                    d.get('weight', 1.0), d.get('image_name'), image_data, d.get('image_original_size'))
+
+
+def _is_tar(path: str) -> bool:
+    return '.tar' in path or path.endswith('.tgz')
+
+
+async def export_jsonl(store: CmdStore, out) -> int:
+    exported = 0
+    async for r in store.export_commands():
+        image = None
+        if r.image_data is not None:
+            image = base64.b64encode(r.image_data).decode('ascii')
+        out.write(_to_json(r, image=image) + '\n')
+        exported += 1
+    return exported
+
+
+async def export_tar(store: CmdStore, path: str) -> int:
+    exported = 0
+    written_images = set()
+    mode = 'w:gz' if path.endswith('gz') else 'w'
+    # Tar members have to be written whole, with their size up front. Images
+    # are written as they come up, and the (much smaller) command list is
+    # spooled to disk and added at the end.
+    with tarfile.open(path, mode) as tar, tempfile.TemporaryFile('w+b') as commands:
+        async for r in store.export_commands():
+            image_hash = None
+            if r.image_data is not None:
+                image_hash = hashlib.sha256(r.image_data).hexdigest()
+                if image_hash not in written_images:
+                    info = tarfile.TarInfo(f"{TAR_IMAGE_DIR}/{image_hash}")
+                    info.size = len(r.image_data)
+                    tar.addfile(info, io.BytesIO(r.image_data))
+                    written_images.add(image_hash)
+            commands.write((_to_json(r, image_hash=image_hash) + '\n').encode())
+            exported += 1
+
+        info = tarfile.TarInfo(TAR_COMMANDS_NAME)
+        info.size = commands.tell()
+        commands.seek(0)
+        tar.addfile(info, commands)
+    return exported
+
+
+def read_jsonl(f) -> Iterator[Response]:
+    for line in f:
+        if line.strip():
+            yield _from_json(line)
+
+
+def read_tar(tar: tarfile.TarFile) -> Iterator[Response]:
+    commands = tar.extractfile(TAR_COMMANDS_NAME)
+    for line in commands:
+        if not line.strip():
+            continue
+        image_hash = json.loads(line).get('image_hash')
+        image_data = None
+        if image_hash is not None:
+            image_data = tar.extractfile(
+                f"{TAR_IMAGE_DIR}/{image_hash}").read()
+        yield _from_json(line, image_data)
+
+
+def _db_name(args) -> str:
+    if args.db is not None:
+        return args.db
+    if args.engine == SQLITE_ENGINE:
+        migrate_to_partitions(COMMAND_DB_NAME, COMMAND_DATA_DIR)
+    return partition_path(COMMAND_DATA_DIR, args.guild)
+
+
+async def _export(args):
+    db_name = _db_name(args)
+    store = CmdStore(db_name, engine=args.engine)
+    try:
+        if _is_tar(args.path):
+            n = await export_tar(store, args.path)
+        elif args.path == '-':
+            n = await export_jsonl(store, sys.stdout)
+        else:
+            with open(args.path, 'w') as f:
+                n = await export_jsonl(store, f)
+    finally:
+        store.close()
+    print(f"Exported {n} responses from {db_name}.", file=sys.stderr)
+
+
+async def _import(args):
+    db_name = _db_name(args)
+    store = CmdStore(db_name, engine=args.engine)
+    try:
+        if _is_tar(args.path):
+            with tarfile.open(args.path) as tar:
+                n = await store.save_many(read_tar(tar), chunk_size=args.chunk_size)
+        elif args.path == '-':
+            n = await store.save_many(read_jsonl(sys.stdin), chunk_size=args.chunk_size)
+        else:
+            with open(args.path) as f:
+                n = await store.save_many(read_jsonl(f), chunk_size=args.chunk_size)
+    finally:
+        store.close()
+    print(f"Imported {n} responses into {db_name}.", file=sys.stderr)
+
+
+def _main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--guild', type=int,
+                        help="The id of the guild whose commands to use, rather than the global ones.")
+    parser.add_argument('--db',
+                        help=f"The command database to use, in place of one in {COMMAND_DATA_DIR}.")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default=os.environ.get(STORAGE_ENGINE_ENV_VAR, SQLITE_ENGINE),
+                        help=f"The storage engine the commands are kept by. Defaults to ${STORAGE_ENGINE_ENV_VAR}, or sqlite.")
+    subparsers = parser.add_subparsers(dest='action', required=True)
+
+    export_parser = subparsers.add_parser('export')
+    export_parser.add_argument('path', help="Where to export to. Ends in .tar (or .tar.gz) for a tar archive, otherwise JSONL. '-' for stdout.")
+    export_parser.set_defaults(run=_export)
+
+    import_parser = subparsers.add_parser('import')
+    import_parser.add_argument('path', help="What to import. Ends in .tar (or .tar.gz) for a tar archive, otherwise JSONL. '-' for stdin.")
+    import_parser.add_argument('--chunk-size', type=int, default=1000,
+                               help="How many responses to commit at a time.")
+    import_parser.set_defaults(run=_import)
+
+    args = parser.parse_args()
+    asyncio.run(args.run(args))
+
+
+if __name__ == '__main__':
+    _main()
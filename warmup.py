@@ -0,0 +1,79 @@
+"""
+Warms the bot's caches up when it connects, before it answers anything, so
+the first summons and reactions after a restart are no slower than the rest.
+
+The cogs add phases (loading the flair map, opening guilds' command databases
+and so on), which all run at once. Events are held back until every phase
+has finished, or the deadline passes. Phases still running then carry on in
+the background, and the bot answers without them.
+"""
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+import metrics
+
+# How long events are held back for warm-up, at most.
+WARMUP_DEADLINE_SECONDS = 30
+
+WARMUP_SECONDS = metrics.histogram(
+    'newton_warmup_seconds', "Time taken by each phase of warming up when the bot connects, and by all of them.", ['phase'])
+
+# Called with the guilds the bot is in.
+Phase = Callable[[Sequence], Awaitable]
+
+
+class Warmup:
+    def __init__(self, deadline=WARMUP_DEADLINE_SECONDS):
+        self._deadline = deadline
+        self._phases: List[Tuple[str, Phase]] = []
+        self._ready = asyncio.Event()
+
+        # How long each phase took the last time they ran, in seconds. None
+        # for phases that failed, or didn't finish before the deadline.
+        self.timings: Dict[str, Optional[float]] = {}
+        self.total: Optional[float] = None
+
+    def add_phase(self, name, phase: Phase):
+        self._phases.append((name, phase))
+
+    def is_ready(self) -> bool:
+        return self._ready.is_set()
+
+    async def wait(self):
+        """Returns once the first warm-up has finished, or run past its deadline."""
+        await self._ready.wait()
+
+    async def run(self, guilds: Sequence):
+        """
+        Runs every phase at once, and waits for them, up to the deadline.
+        Runs again on every reconnect, since the caches may have gone stale,
+        but only the first run holds events back.
+        """
+        start = time.perf_counter()
+        self.timings = {name: None for name, _ in self._phases}
+        self.total = None
+        tasks = [asyncio.ensure_future(self._run_phase(name, phase, guilds, start))
+                 for name, phase in self._phases]
+        if len(tasks) > 0:
+            await asyncio.wait(tasks, timeout=self._deadline)
+        self.total = time.perf_counter() - start
+        WARMUP_SECONDS.labels(phase='total').observe(self.total)
+        self._ready.set()
+
+    async def _run_phase(self, name, phase: Phase, guilds, start):
+        try:
+            await phase(guilds)
+        except Exception as e:
+            print(f"Warm-up phase {name} failed: {e}")
+            return
+        elapsed = time.perf_counter() - start
+        self.timings[name] = elapsed
+        WARMUP_SECONDS.labels(phase=name).observe(elapsed)
+        if self.total is not None and elapsed > self.total:
+            print(f"Warm-up phase {name} finished late, after {elapsed:.2f}s.")
+
+    def summary(self) -> str:
+        phases = ', '.join(f"{name} {t:.2f}s" if t is not None else f"{name} unfinished"
+                           for name, t in self.timings.items())
+        return f"Warmed up in {self.total:.2f}s ({phases})."
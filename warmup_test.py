@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import asyncio
+import unittest
+
+from warmup import Warmup
+
+
+def _run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class TestWarmup(unittest.TestCase):
+    def test_runs_phases_at_once(self):
+        w = Warmup()
+        running = []
+
+        async def phase(name, guilds):
+            running.append(name)
+            await asyncio.sleep(0.05)
+            # Both started before either finished.
+            self.assertEqual(sorted(running), ['a', 'b'])
+            self.assertEqual(guilds, ['guild'])
+        w.add_phase('a', lambda guilds: phase('a', guilds))
+        w.add_phase('b', lambda guilds: phase('b', guilds))
+
+        self.assertFalse(w.is_ready())
+        _run(w.run(['guild']))
+        self.assertTrue(w.is_ready())
+        self.assertEqual(sorted(w.timings), ['a', 'b'])
+        self.assertTrue(all(0.05 <= t < 0.1 for t in w.timings.values()))
+        self.assertLess(w.total, 0.1)
+        self.assertIn('a 0.0', w.summary())
+
+    def test_holds_waiters_until_done(self):
+        w = Warmup()
+        finished = asyncio.Event()
+
+        async def phase(guilds):
+            await asyncio.sleep(0.05)
+            finished.set()
+        w.add_phase('slow', phase)
+
+        async def wait_then_check():
+            await w.wait()
+            return finished.is_set()
+
+        async def main():
+            waiter = asyncio.ensure_future(wait_then_check())
+            await asyncio.sleep(0)
+            await w.run([])
+            return await waiter
+        self.assertTrue(_run(main()))
+
+    def test_stops_waiting_at_deadline(self):
+        w = Warmup(deadline=0.05)
+        finished = asyncio.Event()
+
+        async def stuck(guilds):
+            await asyncio.sleep(0.2)
+            finished.set()
+
+        async def broken(guilds):
+            raise RuntimeError("no")
+        w.add_phase('stuck', stuck)
+        w.add_phase('broken', broken)
+
+        _run(w.run([]))
+        self.assertTrue(w.is_ready())
+        self.assertLess(w.total, 0.2)
+        self.assertEqual(w.timings, {'stuck': None, 'broken': None})
+        self.assertIn('stuck unfinished', w.summary())
+
+        # Unfinished phases carry on in the background.
+        _run(finished.wait())
+        self.assertIsNotNone(w.timings['stuck'])
+
+
+if __name__ == '__main__':
+    unittest.main()